@@ -2,6 +2,17 @@ __version__ = "0.3.3"
 
 import sys
 
+# The spectrum fits and the treatment (widget and `brimview-treat`) need the "processing" extra
+try:
+    import HDF5_BLS_treat
+    import scipy
+except ModuleNotFoundError as e:
+    raise ModuleNotFoundError(
+        f"{e.msg}: install the processing dependencies of BrimView with "
+        "`pip install brimview-widgets[processing]`",
+        name=e.name,
+    ) from e
+
 from .bls_file_input import BlsFileInput
 from .bls_data_visualizer import BlsDataVisualizer
 from .bls_spectrum import BlsSpectrumVisualizer
@@ -11,6 +22,7 @@ from .bls_metadata import BlsMetadata
 from .debug_report_widget import DebugReport
 from .environment import running_from_pyodide
 from .bls_statistics import BlsStatistics
+from .bls_label_statistics import BlsLabelStatistics
 
 # Keep treatment widget out of the wasm package
 if running_from_pyodide:
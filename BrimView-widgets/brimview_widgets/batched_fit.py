@@ -0,0 +1,230 @@
+"""
+Batched Levenberg-Marquardt solver for the multi-peak fit.
+
+Fitting a map spectrum by spectrum means one small `curve_fit` call per spectrum, each paying
+the Python and scipy overhead. Here all the spectra of a block advance in lockstep: the model,
+its analytic Jacobian and the damped normal equations are evaluated for the whole block with
+NumPy, and each spectrum keeps its own damping factor and convergence flag, so the spectra
+that have converged drop out of the iterations.
+
+The fitted problem is the one recorded by `multi_fit_all_inelastic` (see `MultiPeakProblem`):
+one lineshape per inelastic peak, with a single offset, on the union of the peak windows.
+Bounds are handled by stepping back from them: a parameter whose step would cross a bound
+only goes part of the way to it, so that the iterates stay strictly feasible (a peak whose
+amplitude reaches 0 can't move anymore). The few spectra that don't converge within
+`MAX_ITERATIONS`, or where a peak vanished, are fitted again, one by one, with `curve_fit`.
+"""
+
+import numpy as np
+
+from .warm_start import MultiPeakProblem
+
+# Maximum number of iterations of each spectrum
+MAX_ITERATIONS = 100
+# Relative decrease of the cost, and relative step, under which a spectrum has converged
+FTOL = 1e-8
+XTOL = 1e-8
+# Damping above which a spectrum is considered stuck
+MAX_DAMPING = 1e10
+# Fraction of the distance to a bound travelled by a step that would cross it
+BOUND_STEP = 0.5
+
+BATCHED_MODELS = ["Lorentzian", "DHO", "Gaussian"]
+
+
+def _lineshape(model: str, nu, a, nu0, gamma):
+    """
+    Value of one peak without offset, and its derivatives with respect to (a, nu0, gamma).
+    `nu` is (1, n) and the parameters are (N, 1) arrays.
+    """
+    match model:
+        case "Lorentzian":
+            h = gamma / 2
+            dx = nu - nu0
+            D = dx**2 + h**2
+            L = h**2 / D
+            d_nu0 = a * 2 * h**2 * dx / D**2
+            d_gamma = a * h * dx**2 / D**2
+            mask = None
+        case "DHO":
+            N = (gamma * nu0) ** 2
+            diff = nu**2 - nu0**2
+            D = diff**2 + (gamma * nu) ** 2
+            L = N / D
+            d_nu0 = a * 2 * nu0 * (gamma**2 * D + 2 * N * diff) / D**2
+            d_gamma = a * 2 * gamma * (nu0**2 * D - N * nu**2) / D**2
+            # Only one peak of the doublet, on the side of nu0
+            mask = np.where(nu0 < 0, nu <= 0, nu >= 0)
+            L, d_nu0, d_gamma = L * mask, d_nu0 * mask, d_gamma * mask
+        case "Gaussian":
+            s = 2 * np.log(2) / gamma
+            dx = nu - nu0
+            L = np.exp(-(dx**2) / (2 * s**2))
+            d_nu0 = a * L * dx / s**2
+            d_gamma = -a * L * dx**2 / (s**2 * gamma)
+            mask = None
+        case _:
+            raise ValueError(f"The batched solver does not support the model '{model}'")
+    return a * L, (L, d_nu0, d_gamma), mask
+
+
+class BatchedMultiPeakFit:
+    """
+    Batched version of `MultiPeakProblem.fit`.
+
+    The free parameters of each spectrum are the offset and (amplitude, shift, linewidth)
+    of each peak; the offsets of the other peaks are fixed to 0, as in `multi_fit_all_inelastic`.
+    """
+
+    def __init__(self, problem: MultiPeakProblem, frequency: np.ndarray):
+        self.problem = problem
+        self.n_peaks = problem.n_peaks
+        self.problem_frequency = np.asarray(frequency, dtype=float)
+        self.nu = self.problem_frequency[problem.fit_index][None, :]
+        free = np.r_[0, [4 * k + j for k in range(self.n_peaks) for j in (1, 2, 3)]]
+        self._free = free
+        self.lower = problem.lower[free]
+        self.upper = problem.upper[free]
+
+    @property
+    def n_parameters(self) -> int:
+        return len(self._free)
+
+    def residuals_and_jacobian(self, P: np.ndarray, y: np.ndarray, jacobian: bool = True):
+        """Residuals (N, n) of the model for the (N, n_parameters) parameters, and the (N, n, n_parameters) Jacobian"""
+        model = self.problem.fit_model
+        f = np.zeros_like(y)
+        J = np.empty(y.shape + (self.n_parameters,)) if jacobian else None
+        for k in range(self.n_peaks):
+            a, nu0, gamma = (P[:, 1 + 3 * k + j, None] for j in range(3))
+            value, derivatives, mask = _lineshape(model, self.nu, a, nu0, gamma)
+            f += value
+            if k == 0:
+                offset = np.ones_like(y) if mask is None else mask.astype(float)
+                f += P[:, :1] * offset
+                if jacobian:
+                    J[..., 0] = offset
+            if jacobian:
+                for j, d in enumerate(derivatives):
+                    J[..., 1 + 3 * k + j] = d
+        return y - f, J
+
+    def _step_within_bounds(self, P: np.ndarray, step: np.ndarray) -> np.ndarray:
+        P_new = P + step
+        below, above = P_new <= self.lower, P_new >= self.upper
+        lower = np.broadcast_to(self.lower, P.shape)
+        upper = np.broadcast_to(self.upper, P.shape)
+        P_new[below] = P[below] + BOUND_STEP * (lower[below] - P[below])
+        P_new[above] = P[above] + BOUND_STEP * (upper[above] - P[above])
+        return P_new
+
+    def fit(self, PSD: np.ndarray, p0: np.ndarray = None):
+        """
+        Fit a (N, n_freq) block of spectra.
+
+        Parameters
+        ----------
+        p0 : (N, n_peaks * 4) array, optional
+            Initial guess, by default `MultiPeakProblem.default_guess`.
+
+        Returns
+        -------
+        (popt, std, n_iterations)
+            `popt` and `std` are (N, n_peaks, 4) arrays of (offset, amplitude, shift, linewidth)
+            and their standard deviations, NaN where the fit failed.
+        """
+        PSD = np.asarray(PSD, dtype=float)
+        y = PSD[:, self.problem.fit_index]
+        if p0 is None:
+            p0 = self.problem.default_guess(PSD)
+        P = np.clip(np.asarray(p0, dtype=float)[:, self._free], self.lower, self.upper)
+        n_spectra, n_points = y.shape
+
+        damping = np.full(n_spectra, 1e-3)
+        # Growth factor of the damping after consecutive rejected steps (Nielsen's update)
+        growth = np.full(n_spectra, 2.0)
+        n_iterations = np.zeros(n_spectra, dtype=int)
+        converged = np.zeros(n_spectra, dtype=bool)
+        # Spectra with NaN can't be fitted
+        active = np.all(np.isfinite(y), axis=-1) & np.all(np.isfinite(P), axis=-1)
+        failed = ~active
+
+        r, _ = self.residuals_and_jacobian(P, y, jacobian=False)
+        cost = np.einsum("ij,ij->i", r, r)
+        for _ in range(MAX_ITERATIONS):
+            index = np.flatnonzero(active)
+            if len(index) == 0:
+                break
+            Pa, ya = P[index], y[index]
+            r, J = self.residuals_and_jacobian(Pa, ya)
+            JtJ = np.einsum("nxi,nxj->nij", J, J)
+            g = np.einsum("nxi,nx->ni", J, r)
+
+            # Marquardt scaling of the damping, with a floor for parameters without effect
+            diag = np.einsum("nii->ni", JtJ)
+            diag = np.maximum(diag, 1e-12 * diag.max(axis=-1, keepdims=True) + 1e-300)
+            A = JtJ + (damping[index, None] * diag)[..., None] * np.eye(self.n_parameters)
+            try:
+                step = np.linalg.solve(A, g[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(A, g)])
+
+            P_new = self._step_within_bounds(Pa, step)
+            r_new, _ = self.residuals_and_jacobian(P_new, ya, jacobian=False)
+            cost_new = np.einsum("ij,ij->i", r_new, r_new)
+            n_iterations[index] += 1
+
+            # Gain ratio: actual over predicted decrease of the cost
+            predicted = np.einsum("ni,ni->n", step, g + damping[index, None] * diag * step)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                gain = (cost[index] - cost_new) / predicted
+            accept = np.isfinite(cost_new) & (cost_new <= cost[index])
+            small_decrease = cost[index] - cost_new <= FTOL * cost[index]
+            small_step = np.all(np.abs(P_new - Pa) <= XTOL * (np.abs(Pa) + XTOL), axis=-1)
+
+            accepted = index[accept]
+            P[accepted] = P_new[accept]
+            cost[accepted] = cost_new[accept]
+            shrink = np.maximum(1 / 3, 1 - (2 * np.nan_to_num(gain, nan=0.0) - 1) ** 3)
+            damping[index] = np.where(accept, damping[index] * shrink, damping[index] * growth[index])
+            growth[index] = np.where(accept, 2.0, growth[index] * 2)
+
+            done = accept & (small_decrease | small_step)
+            converged[index[done]] = True
+            stuck = damping[index] > MAX_DAMPING
+            # A spectrum whose damping blew up is at a minimum if no step can decrease its cost
+            converged[index[stuck & ~done]] = True
+            active[index[done | stuck]] = False
+
+        # The slow ones, and those stuck with a vanishing peak, are left to curve_fit
+        amplitudes = P[:, 1::3]
+        vanished = np.any(amplitudes <= 1e-6 * np.abs(y).max(axis=-1, keepdims=True), axis=-1)
+        converged &= ~vanished
+        popt = np.full((n_spectra, self.n_peaks * 4), np.nan)
+        std = np.full_like(popt, np.nan)
+        retried = np.zeros(n_spectra, dtype=bool)
+        for i in np.flatnonzero(~failed & ~converged):
+            p, e, _ = self.problem.fit(self.problem_frequency, PSD[i], p0[i])
+            if p is not None:
+                popt[i], std[i], retried[i] = p, e, True
+        failed |= ~converged
+
+        # Covariance as in curve_fit (absolute_sigma=False)
+        ok = np.flatnonzero(~failed)
+        if len(ok):
+            r, J = self.residuals_and_jacobian(P[ok], y[ok])
+            JtJ = np.einsum("nxi,nxj->nij", J, J)
+            s_sq = np.einsum("ij,ij->i", r, r) / max(n_points - self.n_parameters, 1)
+            with np.errstate(invalid="ignore"):
+                cov = np.linalg.pinv(JtJ) * s_sq[:, None, None]
+                std_free = np.sqrt(np.einsum("nii->ni", cov))
+            popt[ok] = 0.0
+            std[ok] = 0.0
+            popt[ok[:, None], self._free] = P[ok]
+            std[ok[:, None], self._free] = std_free
+
+        failed &= ~retried
+        popt = popt.reshape(n_spectra, self.n_peaks, 4)
+        std = std.reshape(n_spectra, self.n_peaks, 4)
+        popt[..., 3] = np.abs(popt[..., 3])
+        return popt, std, n_iterations
@@ -22,6 +22,7 @@ from .logging import logger
 import brimfile as bls
 from .bls_file_input import BlsFileInput
 from .utils import only_on_change, catch_and_notify
+from .coordinate_mapper import CoordinateMapper
 from .widgets import HorizontalEditableIntSlider
 import colorcet as cc
 import pandas as pd
@@ -91,6 +92,12 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
     # The numpy array to be displayed
     img_data = param.Array(default=None, instantiate=False, precedence=-1)
     mask = param.Parameter(default=None, instantiate=False, precedence=-1)
+    lasso_mode = param.Selector(
+        default="Replace",
+        objects=["Replace", "Union", "Subtract"],
+        label="Lasso mode",
+        doc="How a new lasso selection is combined with the current mask",
+    )
 
     img_axis_1 = param.Selector(
         default="x", objects=["x", "y", "z"], label="Horizontal axis"
@@ -600,8 +607,17 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
 
             return mask
 
-        logger.debug("Updating selection mask")
-        self.mask = lasso_to_mask(geometry, mask_shape)
+        logger.debug(f"Updating selection mask ({self.lasso_mode})")
+        new_mask = lasso_to_mask(geometry, mask_shape)
+        if self.lasso_mode == "Replace" or self.mask is None:
+            if self.lasso_mode == "Subtract":
+                # Nothing to subtract from
+                return
+            self.mask = new_mask
+        elif self.lasso_mode == "Union":
+            self.mask = self.mask | new_mask
+        else:
+            self.mask = self.mask & ~new_mask
 
     @(
         param.depends(
@@ -641,6 +657,16 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
         mask = self._plot_mask()
         return data * mask
 
+    def coordinate_mapper(self) -> CoordinateMapper:
+        """Mapper between the currently displayed frame and the data indices"""
+        return CoordinateMapper(
+            horizontal_axis=self.img_axis_1,
+            vertical_axis=self.img_axis_2,
+            slice_axis=self.img_axis_3,
+            slice_index=self.img_axis_3_slice,
+            pixel_size=(self.z_px.value, self.y_px.value, self.x_px.value),
+        )
+
     def _update_click_param(self, x, y):
         """
         This function takes the (x,y) coordinate from a click on the displayed picture,
@@ -648,33 +674,9 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
         """
         logger.debug(f"Clicked {time.time()}")
 
-        # Getting (z, y, x) in the choosen coordinate system (either px or real_units)
-        horizontal_coord = x
-        vertical_coord = y
-        match self.img_axis_1:
-            case "x":
-                x = horizontal_coord
-            case "y":
-                y = horizontal_coord
-            case "z":
-                z = horizontal_coord
-
-        match self.img_axis_2:
-            case "x":
-                x = vertical_coord
-            case "y":
-                y = vertical_coord
-            case "z":
-                z = vertical_coord
-
-        match self.img_axis_3:
-            # self.img_axis_3_slice is an index, so we need to convert it into the units used
-            case "x":
-                x = self.img_axis_3_slice * self.x_px.value
-            case "y":
-                y = self.img_axis_3_slice * self.y_px.value
-            case "z":
-                z = self.img_axis_3_slice * self.z_px.value
+        mapper = self.coordinate_mapper()
+        (z_index, y_index, x_index) = mapper.physical_to_data_indices(x, y).tolist()
+        (z, y, x) = mapper.to_physical((z_index, y_index, x_index)).tolist()
 
         # === weird WORKAROUND ===
         # - this function is being called by stream from Holoview
@@ -693,11 +695,7 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
 
         def _panel_update():
 
-            self.dataset_zyx_click = (
-                round(z / self.z_px.value),
-                round(y / self.y_px.value),
-                round(x / self.x_px.value),
-            )
+            self.dataset_zyx_click = (z_index, y_index, x_index)
             unit = f"(z={z} {self.z_px.units}, y={y} {self.y_px.units}, x={x} {self.x_px.units})"
             index = f"(z={ self.dataset_zyx_click[0]}, y={ self.dataset_zyx_click[1]}, x={self.dataset_zyx_click[2]})"
             user_msg = f"Clicked on pixel: <br/> 🌍: {unit} <br/> 🔢: {index}"
@@ -911,8 +909,15 @@ class BlsDataVisualizer(WidgetBase, PyComponent):
             margin=5,
         )
 
+        lasso_mode_widget = pn.widgets.RadioButtonGroup.from_param(
+            self.param.lasso_mode,
+            button_type="light",
+            visible=_GUI_ROI_SELECTION,
+            margin=5,
+        )
+
         main_card = pn.Card(
-            pn.Row(self.img_axis_3_slice_widget, align="center"),
+            pn.Row(self.img_axis_3_slice_widget, lasso_mode_widget, align="center"),
             pn.pane.HoloViews(self._plot_masked_data, sizing_mode="stretch_width"),
             self.result_options,
             axis_options,
@@ -2,19 +2,39 @@ import panel as pn
 import holoviews as hv
 import param
 import asyncio
-import scipy
+import datetime
 import time
 
 import numpy as np
 import brimfile as bls
 from HDF5_BLS_treat import treat as bls_treat
-import scipy.optimize
 
 from .utils import catch_and_notify
+from .brimfile_compat import spatial_map
 from .logging import logger
 
+from .progress_channel import ProgressChannel
 from .progress_widget import ProgressWidget
+from .psd_access import PSDBlockReader, describe_psd
+from .spectral_utils import (
+    RunningSpectrumStats,
+    common_frequency_axis,
+    resample_spectra,
+)
 from .bls_file_input import BlsFileInput
+from .job_queue import JobCancelled, TreatmentJob, get_scheduler
+from .result_writer import AnalysisResultsWriter
+from .treatment_checkpoint import DEFAULT_CHECKPOINT_DIR, discard_checkpoint
+from .treatment_engine import (
+    ENGINES,
+    PeakConfig,
+    TreatmentConfig,
+    TreatmentResult,
+    TreatState,
+    default_n_workers,
+    estimate_treatment,
+    treat_data,
+)
 
 
 class BrillouinPeakEstimate(pn.viewable.Viewer):
@@ -129,6 +149,52 @@ class BLSTreatOptions(pn.viewable.Viewer):
         default=_available_models[0],
     )
     threshold_noise = param.Number(default=0.05)
+    engine = param.Selector(
+        objects=ENGINES,
+        default="Process pool",
+        doc=(
+            "'Process pool' fits blocks of spectra in parallel, in separate processes; "
+            "'Batched' fits all the spectra of a chunk at once with a vectorised solver"
+        ),
+    )
+    n_workers = param.Integer(
+        default=default_n_workers(),
+        bounds=(1, None),
+        label="Number of workers",
+        doc="Capped to the share of the server's worker processes available to each treatment",
+    )
+    preview = param.Boolean(
+        default=True,
+        label="Coarse preview first",
+        doc=(
+            "Fit a regular subsample of the spectra first, to show a coarse shift map "
+            "within seconds, which is then refined as the full treatment proceeds"
+        ),
+    )
+    warm_start = param.Boolean(
+        default=False,
+        label="Neighbour warm start",
+        doc=(
+            "Walk the spectra row by row and start each fit from the fitted parameters "
+            "of its neighbours instead of the generic initial guess"
+        ),
+    )
+    checkpoint = param.Boolean(
+        default=True,
+        label="Checkpoint and resume",
+        doc=(
+            "Save the fitted chunks to a scratch folder while the treatment runs, "
+            "so that an interrupted treatment resumes where it stopped"
+        ),
+    )
+    save_partial = param.Boolean(
+        default=True,
+        label="Save partial results when cancelled",
+        doc=(
+            "When a running treatment is cancelled, save the spectra fitted so far "
+            "as an analysis group, with NaN for the spectra that were not fitted"
+        ),
+    )
 
     def __init__(self, **params):
         super().__init__(**params)
@@ -137,6 +203,17 @@ class BLSTreatOptions(pn.viewable.Viewer):
         return pn.Card(
             pn.widgets.Select.from_param(self.param.model_fit),
             pn.widgets.NumberInput.from_param(self.param.threshold_noise),
+            pn.widgets.Select.from_param(self.param.engine),
+            pn.widgets.IntInput.from_param(
+                self.param.n_workers,
+                disabled=self.param.engine.rx() != "Process pool",
+            ),
+            pn.widgets.Checkbox.from_param(self.param.preview),
+            pn.widgets.Checkbox.from_param(
+                self.param.warm_start, disabled=self.param.engine.rx() == "Batched"
+            ),
+            pn.widgets.Checkbox.from_param(self.param.checkpoint),
+            pn.widgets.Checkbox.from_param(self.param.save_partial),
             title="General fitting options",
             margin=5,
         )
@@ -168,6 +245,7 @@ class BlsDoTreatment(pn.viewable.Viewer):
     def __init__(self, Bh5file: BlsFileInput, **params):
         # This needs to be called before some pn.depends(init=True) functions
         self.plot_pane = pn.pane.HoloViews()
+        self.preview_pane = pn.pane.HoloViews(visible=False)
 
         self._bls_treatment_lock = asyncio.Lock()
         super().__init__(**params)
@@ -178,6 +256,10 @@ class BlsDoTreatment(pn.viewable.Viewer):
 
         self.progress_widget = ProgressWidget(step_interval=100, min_interval=1)
         self.spectrum_processing_limit = None
+        self.treatment_state: TreatState = None
+        self.treatment_result: TreatmentResult = None
+        self.treatment_job: TreatmentJob = None
+        self.results_writer: AnalysisResultsWriter = None
 
     def button_click(self, event):
         """
@@ -191,7 +273,76 @@ class BlsDoTreatment(pn.viewable.Viewer):
         self.data_processed = False
         # await self._process_data()
         await self._bls_treatement()
-        await self._save_bls_treatment()
+        # Nothing to save if the treatment failed or was cancelled
+        if self.treatment_result is not None:
+            await self._save_bls_treatment()
+
+    @catch_and_notify(prefix="<b>Estimate treatment: </b>")
+    async def estimate_duration(self, event):
+        """Fit a small random sample with the current settings, and extrapolate the duration"""
+        if self.bls_data is None:
+            return
+        scheduler = get_scheduler()
+        self.btn_estimate.disabled = True
+        # The sample is fitted by the shared worker processes: like a treatment, the estimate
+        # waits for its turn in the queue
+        job = scheduler.submit(label=f"{self.bls_data.get_name()} (estimate)")
+        queue = asyncio.ensure_future(self._follow_estimate_queue(job))
+        try:
+            async with scheduler.run(job):
+                queue.cancel()
+                self.estimate_pane.object = "Estimating the duration of the treatment..."
+                estimate = await estimate_treatment(
+                    self.bls_data,
+                    self.treatment_config(),
+                    engine=self.bls_options.engine,
+                    n_workers=scheduler.worker_share(self.bls_options.n_workers),
+                    max_spectra=self.spectrum_processing_limit,
+                    executor=job.executor,
+                )
+        except JobCancelled:
+            self.estimate_pane.object = "Estimate cancelled"
+            return
+        except Exception:
+            self.estimate_pane.object = ""
+            raise
+        finally:
+            queue.cancel()
+            self.btn_estimate.disabled = self.bls_data is None
+        workers = (
+            f", {estimate.n_workers} workers" if estimate.engine == "Process pool" else ""
+        )
+        lines = [
+            f"**Estimated duration: {datetime.timedelta(seconds=round(estimate.total_time))}** "
+            f"({estimate.engine}{workers}, {estimate.n_spectra} spectra)",
+            f"- Fitting: {1e3 * estimate.fit_time:.2f} ms per spectrum and worker",
+            f"- Reading: {1e3 * estimate.read_time:.3f} ms per spectrum",
+            f"- Failed fits: {100 * estimate.failure_rate:.0f}% of {estimate.n_sampled} sampled spectra",
+        ]
+        if estimate.failure_rate > 0.1:
+            lines.append("\nMany fits failed: check the peak positions and bounds.")
+        self.estimate_pane.object = "\n".join(lines)
+
+    async def _follow_estimate_queue(self, job: TreatmentJob, interval: float = 0.5):
+        """Show the position of the estimate in the queue, see `ProgressWidget.follow_queue`"""
+        while (position := job.position) > 0:
+            self.estimate_pane.object = f"Estimate queued: position {position} in the queue"
+            await asyncio.sleep(interval)
+
+    def cancel_treatment(self, event):
+        """
+        Cancel the treatment of this session. A running treatment stops after the blocks
+        being fitted (see `save_partial`); clicking again aborts it without waiting.
+        """
+        job = self.treatment_job
+        if job is None:
+            return
+        if job.stop_event.is_set():
+            job.cancel()
+        else:
+            job.stop()
+            self.btn_cancel.name = "Abort"
+            self.progress_widget.label.object += " -- Stopping after the current blocks..."
 
     @catch_and_notify(prefix="<b>Treatment: </b>")
     async def _bls_treatement(self):
@@ -201,92 +352,81 @@ class BlsDoTreatment(pn.viewable.Viewer):
         async with self._bls_treatment_lock:
             if self.bls_data is None:
                 return
-            (PSD, frequency, PSD_units, frequency_units) = self.bls_data.get_PSD_as_spatial_map(broadcast_frequency=True)
-            self._psd_shape = PSD.shape # Storing original shape to unflatten later
-            PSD_flat = PSD.reshape(-1, PSD.shape[-1])
-            freq_flat = frequency.reshape(-1, frequency.shape[-1])
-
-            if self.spectrum_processing_limit is not None:
-                # Limit the number of spectra to process
-                PSD_flat = PSD_flat[: self.spectrum_processing_limit]
-                freq_flat = freq_flat[: self.spectrum_processing_limit]
-
-            # Converting to 1D freq array    
-            freq_flat = freq_flat[0, :]  # Assuming the frequency is the same across all spectra, we take the first one
-            
-            # bls_treat expects the frequency to be ordered from low to high
-            # brimfile array can be anything, so we sort it just in case
-            sort_indices = np.argsort(freq_flat)
-            freq_flat = freq_flat[sort_indices]
-            PSD_flat = PSD_flat[:, sort_indices]
-            logger.debug("Frequency axis for BLS treatment: %s", freq_flat)
-            self.bls_treat = bls_treat.Treat(frequency=freq_flat, PSD=PSD_flat)
-
-            # import matplotlib.pyplot as plt  # DEBUG remove later
-
-            # Manual type hinting
-            peaks: list[BrillouinPeakEstimate] = self.peaks_for_treament.peaks
-
-            positions = [peak.position for peak in peaks]
-            window_points = [peak.normalizing_window for peak in peaks]
-            # Adding the points to the treat object
-            for p, w in zip(positions, window_points):
-                logger.debug(f"Adding point for normalization: position={p}, window={w}")
-                self.bls_treat.add_point(
-                    position_center_window=p, type_pnt="Other", window_width=w
-                )
-            # Applying the normalization: the lowest 5% of the data is averaged to extract the offset and then the intensity array is divided by the average of the intensity of the two peaks so as to normalize the amplitude of the peaks to 1
-            # self.bls_treat.normalize_data(
-            #     threshold_noise=self.bls_options.threshold_noise
-            # )  # Note: This function clears the points stored in memory of the treat module
-
-            # Selecting the points for the fitting
-            positions = [peak.position for peak in peaks]
-            window_fit = [peak.fitting_window for peak in peaks]
-            tpe_points = [
-                peak.type_pnt for peak in peaks
-            ]  # The types of peaks that we fit - important to then combine the results into one value per spectrum
-            for p, w, t in zip(positions, window_fit, tpe_points):
-                self.bls_treat.add_point(
-                    position_center_window=p, type_pnt=t, window_width=w
+            self.treatment_result = None
+            # Treatments of all the sessions share the same worker processes, and wait
+            # in a queue when too many of them run at the same time
+            scheduler = get_scheduler()
+            job = scheduler.submit(label=self.bls_data.get_name())
+            self.treatment_job = job
+            self.btn_cancel.disabled = False
+            queue = asyncio.ensure_future(self.progress_widget.follow_queue(job))
+            progress = None
+            try:
+                async with scheduler.run(job):
+                    queue.cancel()
+                    # The total is set by treat_data, once it knows how many spectra it will fit
+                    progress = ProgressChannel(total=0)
+                    self.progress_widget.start(
+                        total=100, task=f"Fitting ({self.bls_options.engine})"
+                    )
+                    follow = asyncio.ensure_future(self.progress_widget.follow(progress))
+                    # The results are written to the file chunk by chunk, as they are fitted
+                    self.results_writer = AnalysisResultsWriter(
+                        self.bls_data, self.bls_options.model_fit
+                    )
+                    t0 = time.time()
+                    try:
+                        # The PSD is streamed chunk by chunk, it is never loaded in memory as a whole
+                        self.treatment_state, self.treatment_result = await treat_data(
+                            self.bls_data,
+                            self.treatment_config(),
+                            engine=self.bls_options.engine,
+                            n_workers=scheduler.worker_share(self.bls_options.n_workers),
+                            max_spectra=self.spectrum_processing_limit,
+                            checkpoint_dir=self._checkpoint_dir(),
+                            progress=progress,
+                            preview_callback=(
+                                self.show_preview if self.bls_options.preview else None
+                            ),
+                            executor=job.executor,
+                            stop=job.stop_event,
+                            writer=self.results_writer,
+                        )
+                    except BaseException:
+                        self.results_writer.discard()
+                        raise
+                    finally:
+                        progress.close()
+                        await follow
+            except JobCancelled:
+                # Nothing was fitted if the job was cancelled while in the queue
+                self.progress_widget.finish(
+                    "Cancelled", completed=progress.done if progress is not None else 0
                 )
-
-            # Defining the model for fitting the peaks
-            logger.debug(self.bls_options.model_fit)
-            self.bls_treat.define_model(
-                model=self.bls_options.model_fit, elastic_correction=False
-            )  # You can also try with "Lorentzian" model and add elastic corrections by setting the parameter to True for both lineshapes.
-
-            # Estimating the linewidth from selected peaks
-            self.bls_treat.estimate_width_inelastic_peaks(max_width_guess=2)
-
-            # Fitting all the selected inelastic peaks with multiple peaks fitting
-            bound_shift = [
-                [peak.bound_shift[0], peak.bound_shift[1]] for peak in peaks
-            ]  # Boundaries for the shift
-            bound_linewidth = [
-                [peak.bound_linewidth[0], peak.bound_linewidth[1]] for peak in peaks
-            ]  # Boundaries for the linewidth
-            self.bls_treat.multi_fit_all_inelastic(
-                guess_offset=True,
-                update_point_position=True,
-                bound_shift=bound_shift,
-                bound_linewidth=bound_linewidth,
-            )
-
-            self.bls_treat._progress_callback = self.progress_widget.update
-            self.progress_widget.start(
-                total=100
-            )  # Values doesn't matter, will be overwritten by callback function
-            t0 = time.time()
-            # TODO: convert this into an async function / generator, that yields the current iteration ?
-            await asyncio.to_thread(self.bls_treat.apply_algorithm_on_all)
+                pn.state.notifications.info("Treatment cancelled", duration=4000)
+                return
+            finally:
+                queue.cancel()
+                self.treatment_job = None
+                self.btn_cancel.disabled = True
+                self.btn_cancel.name = "Cancel"
             tf = time.time() - t0
-            self.progress_widget.finish()
+            if self.treatment_result.stopped:
+                self.progress_widget.finish("Stopped", completed=progress.done)
+                if not self.bls_options.save_partial:
+                    self.results_writer.discard()
+                    self.treatment_result = None
+                    pn.state.notifications.info("Treatment stopped", duration=4000)
+                    return
+                pn.state.notifications.info(
+                    "Treatment stopped, saving the spectra fitted so far", duration=4000
+                )
+            else:
+                self.progress_widget.finish()
 
-            logger.debug(f"shift: {self.bls_treat.shift.shape}")
-            logger.debug(f"amplitude: {self.bls_treat.amplitude.shape}")
-            logger.debug(f"linewidth: {self.bls_treat.linewidth}")
+            logger.debug(f"shift: {self.treatment_result.shift.shape}")
+            logger.debug(f"amplitude: {self.treatment_result.amplitude.shape}")
+            logger.debug(f"linewidth: {self.treatment_result.linewidth}")
 
             # Combining the two fitted peaks together here weighing the result on the standard deviation of the shift
             # self.bls_treat.combine_results_FSR(
@@ -298,171 +438,130 @@ class BlsDoTreatment(pn.viewable.Viewer):
 
             logger.info(f"Time for fitting all spectra: {tf:.2f} s")
 
-            logger.debug(self.bls_treat.shift)
+            logger.debug(self.treatment_result.shift)
             logger.info(
-                f"Average time for a single spectrum: {1e3*tf/np.prod(len(self.bls_treat.shift)):.2f} ms"
+                f"Average time for a single spectrum: {1e3*tf/self.treatment_result.n_spectra:.2f} ms"
             )
 
     @catch_and_notify(prefix="<b>Save treatment: </b>")
     async def _save_bls_treatment(self):
-        if self.bls_treat is None:
+        if self.treatment_result is None:
             raise ValueError("No BLS treatment available.")
-        logger.debug(f"shift: {self.bls_treat.shift.shape}")
-        logger.debug(f"amplitude: {self.bls_treat.amplitude.shape}")
-        logger.debug(f"linewidth: {self.bls_treat.linewidth.shape}")
-
-        fitted_peaks = []
-        model = self.bls_options.model_fit
-        match model:
-            case "Lorentzian":
-                model = bls.Data.AnalysisResults.FitModel.Lorentzian
-            case "Lorentzian elastic":
-                model = bls.Data.AnalysisResults.FitModel.Undefined
-            case "DHO":
-                model = bls.Data.AnalysisResults.FitModel.DHO
-            case "DHO elastic":
-               model = bls.Data.AnalysisResults.FitModel.Undefined
-            case "Gaussian":
-                model = bls.Data.AnalysisResults.FitModel.Gaussian
-            case _:
-                model = bls.Data.AnalysisResults.FitModel.Undefined
-
-        time_str = time.strftime("%Y%m%d-%H%M%S")
-        name = f"BrimView_{model}_{time_str}"
-        for (
-            shift,
-            amplitude,
-            linewidth,
-            offset,
-        ) in zip(  # they are in the shape (n_spectra, n_peaks)
-            self.bls_treat.shift.T,
-            self.bls_treat.amplitude.T,
-            self.bls_treat.linewidth.T,
-            self.bls_treat.offset.T,
-        ):
-            # unflattening the results
-            if self.spectrum_processing_limit:
-                self.n_spectra = np.prod(self._psd_shape[:-1])
-                # Add 0 to the end of the flat arrays to match the original shape, for the spectra that were not processed
-                logger.debug(
-                    "Peak shapes before padding - shift: %s, amplitude: %s, linewidth: %s, offset: %s",
-                    shift.shape,
-                    amplitude.shape,
-                    linewidth.shape,
-                    offset.shape,
-                )
-                shift = np.pad(shift, ((0, self.n_spectra - shift.shape[0])), mode="constant", constant_values=0.0)
-                amplitude = np.pad(amplitude, ((0, self.n_spectra - amplitude.shape[0])), mode="constant", constant_values=0.0)
-                linewidth = np.pad(linewidth, ((0, self.n_spectra - linewidth.shape[0])), mode="constant", constant_values=0.0)
-                offset = np.pad(offset, ((0, self.n_spectra - offset.shape[0])), mode="constant", constant_values=0.0)
-            
-            shift = shift.reshape(self._psd_shape[:-1])  
-            amplitude = amplitude.reshape(self._psd_shape[:-1])
-            linewidth = linewidth.reshape(self._psd_shape[:-1])
-            offset = offset.reshape(self._psd_shape[:-1])
-            
-            fitted_peaks.append(
-                {
-                    "shift": shift,
-                    "shift_units": "GHz",
-                    "width": linewidth,
-                    "width_units": "Hz",
-                    "amplitude": amplitude,
-                    "amplitude_units": "a.u.",
-                    "offset": offset,
-                    "offset_unit": "u.a",
-                }
+        logger.debug(f"shift: {self.treatment_result.shift.shape}")
+        logger.debug(f"amplitude: {self.treatment_result.amplitude.shape}")
+        logger.debug(f"linewidth: {self.treatment_result.linewidth.shape}")
+
+        # The results are already in the file, they only need their final name
+        name = self.results_writer.finish(stopped=self.treatment_result.stopped)
+        logger.info(f"Treatment saved as {name}")
+        # The results are safely in the file now, the checkpoint is not needed anymore,
+        # unless the treatment was stopped and can still be resumed
+        if self._checkpoint_dir() is not None and not self.treatment_result.stopped:
+            discard_checkpoint(
+                self._checkpoint_dir(), self.bls_data, self.treatment_state
             )
-        if len(fitted_peaks) == 1:
-            self.bls_data.create_analysis_results_group(
-                (fitted_peaks[0]),
-                fit_model=model,
-                name=name,
-            )
-        elif len(fitted_peaks) == 2:
-            # If fitted_peak[1] offset is 0, then use the offset of fitted_peak[0] for both peaks, otherwise we have to save the offset of the two peaks separately
-            peak_anti_stokes = fitted_peaks[0]
-            peak_stokes = fitted_peaks[1].copy()
-            if np.allclose(peak_stokes["offset"], 0.0):
-                peak_stokes["offset"] = peak_anti_stokes["offset"].copy()
-
-            self.bls_data.create_analysis_results_group(
-                peak_anti_stokes,
-                peak_stokes,
-                fit_model=model,
-                name=name,
-            )
-        else:
-            raise Exception("More than 2 peaks fitted, unsure how to save that")
         self.bls_reload_file()
 
+    def show_preview(self, shift: np.ndarray):
+        """
+        Show the (provisional) shift map of the first peak, for the middle z slice.
+        `shift` is in the layout of the PSD dataset, see `TreatmentResult`.
+        """
+        psd = describe_psd(self.bls_data)
+        values = shift[:, 0]
+        if psd.sparse:
+            sparse_map = spatial_map(self.bls_data)
+            image = np.where(sparse_map >= 0, values[sparse_map], np.nan)
+        else:
+            # Extra (parameter) dimensions, if any, are shown at their first index
+            image = values.reshape(psd.spatial_shape)
+            image = image[(slice(None),) * 3 + (0,) * (image.ndim - 3)]
+        z = image.shape[0] // 2
+        self.preview_pane.object = hv.Image(
+            image[z],
+            kdims=["x", "y"],
+            vdims=[hv.Dimension("Shift", unit="GHz")],
+        ).opts(
+            cmap="viridis",
+            colorbar=True,
+            tools=["hover"],
+            title=f"Preview: shift of {self.peaks_for_treament.peaks[0].name} (z={z})",
+        )
+        self.preview_pane.visible = True
+
+    def _checkpoint_dir(self) -> str:
+        return DEFAULT_CHECKPOINT_DIR if self.bls_options.checkpoint else None
+
+    def treatment_config(self) -> TreatmentConfig:
+        """The current peaks and fitting options, as a GUI-independent configuration"""
+        peaks: list[BrillouinPeakEstimate] = self.peaks_for_treament.peaks
+        return TreatmentConfig(
+            peaks=[
+                PeakConfig(
+                    position=peak.position,
+                    normalizing_window=peak.normalizing_window,
+                    fitting_window=peak.fitting_window,
+                    type_pnt=peak.type_pnt,
+                    bound_shift=tuple(peak.bound_shift),
+                    bound_linewidth=tuple(peak.bound_linewidth),
+                )
+                for peak in peaks
+            ],
+            model_fit=self.bls_options.model_fit,
+            warm_start=self.bls_options.warm_start,
+        )
+
     @param.depends("bls_data", watch=True)
     def _update_widget(self):
         if self.bls_data is None:
             self.mean_spectra_button.disabled = True
             self.btn_process_data.disabled = True
+            self.btn_estimate.disabled = True
         else:
             self.mean_spectra_button.disabled = False
             self.btn_process_data.disabled = False
-            (PSD, frequency, PSD_units, frequency_units) = self.bls_data.get_PSD_as_spatial_map(broadcast_frequency=True)
-            self.mean_spectra_n_samples.end = np.prod(PSD.shape[:-1])
+            self.btn_estimate.disabled = False
+            # Only the metadata is needed here, the spectra are read when processing starts
+            psd = describe_psd(self.bls_data)
+            self.mean_spectra_n_samples.end = psd.n_spectra
             self.mean_spectra_n_samples.start = 1
-            logger.debug(PSD.shape)
+            logger.debug(psd.shape)
 
     @catch_and_notify(prefix="<b>Compute mean spectra: </b>")
-    def compute_mean_spectra(self, event):
-        (PSD, frequency, PSD_units, frequency_units) = self.bls_data.get_PSD_as_spatial_map(broadcast_frequency=True)
-
-        logger.debug(f"PSD shape : {PSD.shape}")
-        logger.debug(f"freq shape : {frequency.shape}")
-
-        # generate average PSD - last dimension is the frequency
-        num_spectra = np.prod(PSD.shape[:-1])
-        n_data_points = PSD.shape[-1]
-        freq_min = np.nanmin(frequency)
-        freq_max = np.nanmax(frequency)
-        common_freq = np.linspace(freq_min, freq_max, n_data_points)  # shape (71,)
-
-        # Flattening 
-        PSD_flat = PSD.reshape(-1, PSD.shape[-1])
-        freq_flat = frequency.reshape(-1, frequency.shape[-1])
-
-        # we're sampling some spectra
-        flat_indices = np.random.choice(
-            num_spectra, size=self.mean_spectra_n_samples.value, replace=False
-        )
-
-        interpolated_psd = np.empty(
-            (len(flat_indices), len(common_freq))
-        )  # TODO - this might not work with data with more dimensions
-        self.progress_widget.start(
-            total=len(flat_indices), task="Computing mean spectra"
+    async def compute_mean_spectra(self, event):
+        n_samples = self.mean_spectra_n_samples.value
+        self.progress_widget.start(total=n_samples, task="Computing mean spectra")
+        # Reading the sampled chunks is the slow part (remote files), keep it off the event loop
+        reader, samples = await asyncio.to_thread(self._sample_spectra, n_samples)
+
+        # A common frequency axis is only needed if the spectra don't share one
+        common_freq = common_frequency_axis(
+            np.concatenate(
+                [np.atleast_2d(frequency) for _, frequency in samples]
+            ),
+            reader.n_freq,
         )
-
-        for i, flat_idx in enumerate(flat_indices):
-            f = freq_flat[flat_idx]
-            p =  PSD_flat[flat_idx]
-            interp_func = scipy.interpolate.interp1d(
-                f, p, kind="linear", bounds_error=False, fill_value="extrapolate"
-            )
-            interpolated_psd[i, :] = interp_func(common_freq)
-            self.progress_widget.update(i)
-            # UI stuff
-            # self.progress.value = i  # Yield control to the event loop to update the UI
-            # await asyncio.sleep(0)  # allow UI to update
-
+        stats = RunningSpectrumStats(len(common_freq))
+        n_done = 0
+        for PSD, frequency in samples:
+            stats.update(resample_spectra(frequency, PSD, common_freq))
+            n_done += len(PSD)
+            self.progress_widget.update(n_done)
         self.progress_widget.finish()
-        mean_spectrum = np.mean(interpolated_psd, axis=0)  # shape (71,)
-        std_spectrum = np.nanstd(interpolated_psd, axis=0)
+        logger.debug(f"Mean spectrum computed from {stats.n_spectra} spectra")
 
         self.mean_spectra = (
             common_freq,
-            mean_spectrum,
-            std_spectrum,
-            frequency_units,
-            PSD_units,
+            stats.mean_or_nan(),
+            stats.std(),
+            reader.frequency_units,
+            reader.PSD_units,
         )
 
+    def _sample_spectra(self, n_samples: int) -> tuple[PSDBlockReader, list]:
+        reader = PSDBlockReader(self.bls_data)
+        return reader, list(reader.sample(n_samples))
+
     @param.depends(
         "mean_spectra",
         "peaks_for_treament.param",
@@ -512,6 +611,22 @@ class BlsDoTreatment(pn.viewable.Viewer):
             disabled=True,
         )
 
+        self.btn_estimate = pn.widgets.Button(
+            name="Estimate duration",
+            width=150,
+            on_click=self.estimate_duration,
+            disabled=True,
+        )
+        self.estimate_pane = pn.pane.Markdown("")
+
+        self.btn_cancel = pn.widgets.Button(
+            name="Cancel",
+            button_type="danger",
+            width=100,
+            on_click=self.cancel_treatment,
+            disabled=True,
+        )
+
         self.mean_spectra_n_samples = pn.widgets.IntInput(
             name="Number of spectra to use", value=50, start=1, end=1000, step=50
         )
@@ -529,7 +644,9 @@ class BlsDoTreatment(pn.viewable.Viewer):
                 self.peaks_for_treament,
                 self.bls_options,
             ),
-            self.btn_process_data,
+            pn.Row(self.btn_process_data, self.btn_estimate, self.btn_cancel),
+            self.estimate_pane,
             self.progress_widget,
+            self.preview_pane,
             # title="Create new Treatment",
         )
@@ -0,0 +1,492 @@
+import asyncio
+import io
+import warnings
+
+import panel as pn
+from panel.widgets.base import WidgetBase
+from panel.custom import PyComponent
+from bokeh.models.widgets.tables import ScientificFormatter
+import param
+import holoviews as hv
+import numpy as np
+import pandas as pd
+
+from .utils import catch_and_notify
+from .bls_data_visualizer import BlsDataVisualizer
+from .bls_types import bls_param
+from .environment import running_from_pyodide
+from .logging import logger
+from .progress_channel import ProgressChannel
+from .progress_widget import follow_tqdm
+from .psd_access import (
+    SpectraReader,
+    QuantityMaps,
+    describe_psd,
+    preloaded_map,
+    quantity_maps,
+)
+from .spectral_utils import resample_spectra, RunningSpectrumStats
+
+try:
+    import scipy.ndimage
+
+    _CONNECTED_COMPONENTS = True
+except ImportError:
+    _CONNECTED_COMPONENTS = False
+
+try:
+    import tifffile
+
+    _TIFF_LABELS = True
+except ImportError:
+    _TIFF_LABELS = False
+
+# Number of labelled pixels whose quantities are read at once
+_QUANTITY_BATCH_SIZE = 65_536
+
+
+# === Vectorised per-label reductions ===
+# Everything is computed with np.bincount over (map/frequency bin, label) pairs,
+# so the cost doesn't depend on the number of labels.
+
+
+def threshold_labels(image: np.ndarray, threshold: float, connected: bool = True):
+    """
+    Derive a label image from a quantity map.
+
+    Pixels above `threshold` are selected; if `connected` (and scipy is available),
+    each connected region gets its own label, otherwise they all get the label 1.
+    NaN pixels are never selected. 0 is the background.
+    """
+    with np.errstate(invalid="ignore"):
+        mask = np.asarray(image) > threshold
+    if connected and _CONNECTED_COMPONENTS:
+        labels, _ = scipy.ndimage.label(mask)
+        return labels
+    return mask.astype(np.int64)
+
+
+def read_label_image(content: bytes, filename: str) -> np.ndarray:
+    """Read an integer label image from a .npy or .tif(f) file content."""
+    if filename.lower().endswith(".npy"):
+        labels = np.load(io.BytesIO(content), allow_pickle=False)
+    elif filename.lower().endswith((".tif", ".tiff")):
+        if not _TIFF_LABELS:
+            raise ImportError("tifffile is needed to read .tif label images")
+        labels = tifffile.imread(io.BytesIO(content))
+    else:
+        raise ValueError(f"Unsupported label image format: {filename}")
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError(f"Label images must contain integers, got {labels.dtype}")
+    return labels
+
+
+def label_index(labels: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns
+    -------
+    (label_ids, pixels, inverse)
+        label_ids: (n_labels,) sorted non-zero labels;
+        pixels: flat indices of the labelled pixels;
+        inverse: position in `label_ids` of the label of each of these pixels.
+    """
+    flat = np.asarray(labels).ravel()
+    pixels = np.flatnonzero(flat > 0)
+    label_ids, inverse = np.unique(flat[pixels], return_inverse=True)
+    return label_ids, pixels, inverse.ravel()
+
+
+def _label_moments(inverse: np.ndarray, values: np.ndarray, n_labels: int) -> RunningSpectrumStats:
+    """
+    Count, mean and sum of squared deviations of each (map, label) pair,
+    for the (n_maps, n) `values` of pixels with labels at positions `inverse`.
+    """
+    n_maps = len(values)
+    # One bin per (map, label) pair
+    index = np.arange(n_maps)[:, None] * n_labels + inverse[None, :]
+    valid = ~np.isnan(values)
+    index, values = index[valid], values[valid]
+
+    n_bins = n_maps * n_labels
+    count = np.bincount(index, minlength=n_bins)
+    total = np.bincount(index, weights=values, minlength=n_bins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, 0.0)
+    # Two-pass variance within the batch, for numerical stability
+    m2 = np.bincount(index, weights=(values - mean[index]) ** 2, minlength=n_bins)
+    return RunningSpectrumStats.from_moments(count, mean, m2)
+
+
+def label_quantity_statistics(
+    labels: np.ndarray,
+    maps: QuantityMaps,
+    preloaded: dict = None,
+    progress: ProgressChannel = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Per-label statistics of all the quantity maps.
+
+    The values of the labelled pixels are read a batch of pixels at a time
+    (see `QuantityMaps.iter_values_at`); the statistics of each batch are computed
+    for all the maps and labels at once, and merged.
+
+    Parameters
+    ----------
+    labels : (z, y, x) int array
+        0 is the background, any other value a region.
+    maps : QuantityMaps
+    preloaded : dict, optional
+        See `QuantityMaps.values_at`.
+    progress : ProgressChannel, optional
+        Counts the batches of pixels read.
+
+    Returns
+    -------
+    (label_ids, pixel_count, mean, variance)
+        label_ids and pixel_count have shape (n_labels,);
+        mean and variance have shape (n_maps, n_labels), NaN values being ignored.
+    """
+    label_ids, pixels, inverse = label_index(labels)
+    n_maps, n_labels = len(maps), len(label_ids)
+    pixel_count = np.bincount(inverse, minlength=n_labels)
+
+    z, y, x = np.unravel_index(pixels, np.shape(labels))
+    stats = RunningSpectrumStats(n_maps * n_labels)
+    if progress is not None:
+        progress.extend(-(-len(pixels) // _QUANTITY_BATCH_SIZE))
+    for positions, values in maps.iter_values_at(
+        z, y, x, _QUANTITY_BATCH_SIZE, preloaded
+    ):
+        stats.merge(_label_moments(inverse[positions], values, n_labels))
+        if progress is not None:
+            progress.advance(1)
+    return (
+        label_ids,
+        pixel_count,
+        stats.mean_or_nan().reshape(n_maps, n_labels),
+        (stats.std() ** 2).reshape(n_maps, n_labels),
+    )
+
+
+def label_mean_spectra(
+    data, labels: np.ndarray, progress: ProgressChannel = None
+) -> tuple:
+    """
+    Mean spectrum of every label, reading the PSD of the labelled pixels chunk by chunk.
+
+    Parameters
+    ----------
+    data : bls.Data
+    labels : (z, y, x) int array
+    progress : ProgressChannel, optional
+        Counts the batches of chunks read.
+
+    Returns
+    -------
+    (label_ids, frequency, mean_spectra, PSD_units, frequency_units)
+        mean_spectra has shape (n_labels, n_freq).
+    """
+    label_ids, pixels, inverse = label_index(labels)
+    z, y, x = np.unravel_index(pixels, np.shape(labels))
+    reader = SpectraReader(data, z, y, x)
+    if reader.shared_frequency is not None:
+        frequency = np.sort(reader.shared_frequency)
+    else:
+        frequency = np.linspace(*reader.frequency_range(), reader.n_freq)
+
+    n_freq = len(frequency)
+    n_bins = len(label_ids) * n_freq
+    count = np.zeros(n_bins)
+    total = np.zeros(n_bins)
+    if progress is not None:
+        progress.extend(len(reader))
+    for positions, PSD, batch_frequency in reader:
+        resampled = resample_spectra(batch_frequency, PSD, frequency).ravel()
+        # One bin per (label, frequency) pair
+        index = (inverse[positions][:, None] * n_freq + np.arange(n_freq)).ravel()
+        valid = ~np.isnan(resampled)
+        count += np.bincount(index[valid], minlength=n_bins)
+        total += np.bincount(index[valid], weights=resampled[valid], minlength=n_bins)
+        if progress is not None:
+            progress.advance(1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_spectra = np.where(count > 0, total / count, np.nan)
+    return (
+        label_ids,
+        frequency,
+        mean_spectra.reshape(len(label_ids), n_freq),
+        reader.PSD_units,
+        reader.frequency_units,
+    )
+
+
+class BlsLabelStatistics(WidgetBase, PyComponent):
+    """
+    Widget to compute statistics of every region of a label image (segmentation),
+    either loaded from a file or derived by thresholding the displayed quantity map.
+    """
+
+    # === References to external objects ===
+    bls_data = param.ClassSelector(
+        class_=bls_param,
+        default=None,
+        precedence=-1,
+        doc="The current selected BLS file/data",
+        allow_refs=True,
+    )
+    displayed_dataset = param.ClassSelector(
+        class_=hv.Dataset,
+        default=None,
+        precedence=-1,
+        doc="Quantity map currently loaded by the data visualizer",
+        allow_refs=True,
+    )
+    displayed_quantity = param.Parameter(default=None, precedence=-1, allow_refs=True)
+    displayed_peak = param.Parameter(default=None, precedence=-1, allow_refs=True)
+
+    # === User parameters ===
+    label_source = param.Selector(
+        default="Threshold",
+        objects=["Threshold", "Label image"],
+        label="Labels from",
+    )
+    threshold = param.Number(
+        default=0.0,
+        label="Threshold",
+        doc="Pixels of the displayed quantity above this value are labelled",
+    )
+    connected_regions = param.Boolean(
+        default=True,
+        label="Split into connected regions",
+        doc="Give each connected region of the thresholded map its own label (needs scipy)",
+    )
+    compute_spectra = param.Boolean(
+        default=False,
+        label="Mean spectra",
+        doc="Also compute the mean spectrum of every label (reads the spectra of all the labelled pixels)",
+    )
+
+    def __init__(self, result_plot: BlsDataVisualizer, **params):
+        self.spinner = pn.indicators.LoadingSpinner(
+            value=False, size=20, name="Idle", visible=True
+        )
+        params["name"] = "Label Statistics"
+        self.tooltip = "Computes statistics of every region of a segmentation: either load a label image (.npy or .tif, 0 being the background) with the same shape as the data, or threshold the displayed quantity map."
+        super().__init__(**params)
+
+        # === Linking to other widgets ===
+        self.bls_data: bls_param = bls_param(
+            file=result_plot.param.bls_file,
+            data=result_plot.param.bls_data,
+            analysis=result_plot.param.bls_analysis,
+        )
+        self.displayed_dataset = result_plot.param.img_dataset
+        self.displayed_quantity = result_plot.param.result_quantity
+        self.displayed_peak = result_plot.param.result_peak
+
+        self.css_classes.append("card")
+
+        self.threshold_widgets = pn.Row(
+            pn.widgets.FloatInput.from_param(self.param.threshold, width=150),
+            pn.widgets.Checkbox.from_param(
+                self.param.connected_regions, disabled=not _CONNECTED_COMPONENTS
+            ),
+        )
+        self.label_file_input = pn.widgets.FileInput(
+            accept=".npy,.tif,.tiff", multiple=False, visible=False
+        )
+        self.compute_button = pn.widgets.Button(
+            name="Compute label statistics", button_type="primary"
+        )
+        self.compute_button.on_click(self.update_widget)
+        self.tqdm = pn.widgets.Tqdm(visible=False)
+        self.status = pn.pane.Markdown("")
+        self.label_tabulator_widget = pn.widgets.Tabulator(
+            pd.DataFrame(),
+            show_index=False,
+            disabled=True,
+            pagination="remote",
+            page_size=20,
+            layout="fit_data_table",
+            sizing_mode="stretch_width",
+            visible=False,
+        )
+        self.spectra_plot_widget = pn.pane.HoloViews(
+            None, sizing_mode="stretch_width", visible=False
+        )
+
+        self._update_source_widgets()
+
+    # === Data access ===
+
+    def displayed_map(self) -> dict:
+        """The map already loaded by the data visualizer (see `preloaded_map`)"""
+        return preloaded_map(
+            self.displayed_dataset, self.displayed_quantity, self.displayed_peak
+        )
+
+    @pn.depends("displayed_dataset", watch=True)
+    def _suggest_threshold(self):
+        """Start from the median of the displayed map, which at least gives some regions"""
+        for img in self.displayed_map().values():
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                median = np.nanmedian(img)
+            if np.isfinite(median):
+                self.threshold = float(median)
+
+    def get_labels(self, shape: tuple, displayed_map: dict) -> np.ndarray:
+        """
+        The label image, with the (z, y, x) shape of the data;
+        `displayed_map` is the thresholded map (see `displayed_map`).
+        """
+        if self.label_source == "Threshold":
+            (displayed,) = displayed_map.values()
+            return threshold_labels(displayed, self.threshold, self.connected_regions)
+
+        if self.label_file_input.value is None:
+            raise ValueError("No label image loaded")
+        labels = read_label_image(
+            self.label_file_input.value, self.label_file_input.filename
+        )
+        if labels.shape != shape:
+            # A single slice can be given as a 2D image
+            if labels.size != np.prod(shape):
+                raise ValueError(
+                    f"The label image has shape {labels.shape}, but the data has shape {shape}"
+                )
+            labels = labels.reshape(shape)
+        return labels
+
+    # === Computation ===
+
+    @catch_and_notify(prefix="<b>Label statistics: </b>")
+    async def update_widget(self, event=None):
+        if self.bls_data is None or not self.bls_data.is_loaded():
+            raise ValueError("No data loaded")
+
+        self.loading = True
+        self.tqdm.visible = True
+        # As in `BlsStatistics.update_widget`: the inputs are gathered on the event loop,
+        # and the progress of the computation is polled from here
+        analysis, displayed = self.bls_data.analysis, self.displayed_map()
+        progress = ProgressChannel(total=0)
+        follow = asyncio.ensure_future(
+            follow_tqdm(self.tqdm, progress, desc="Label statistics")
+        )
+        try:
+            if running_from_pyodide:
+                # No threads in pyodide: the computation runs inline
+                df, spectra = self.compute_label_statistics(
+                    analysis, displayed, progress
+                )
+            else:
+                df, spectra = await asyncio.to_thread(
+                    self.compute_label_statistics, analysis, displayed, progress
+                )
+        finally:
+            progress.close()
+            follow.cancel()
+            self.tqdm.visible = False
+            self.loading = False
+
+        self.status.object = f"{len(df)} labels"
+        self.label_tabulator_widget.formatters = {
+            name: ScientificFormatter(precision=3) for name in df.columns[2:]
+        }
+        self.label_tabulator_widget.value = df
+        self.label_tabulator_widget.visible = True
+        if spectra is not None:
+            self.spectra_plot_widget.object = self.plot_label_spectra(*spectra)
+        self.spectra_plot_widget.visible = spectra is not None
+
+    def compute_label_statistics(
+        self, analysis, displayed: dict, progress: ProgressChannel = None
+    ) -> tuple[pd.DataFrame, tuple]:
+        """
+        Statistics table of the labels and, if asked, their mean spectra.
+        Meant to run in a worker thread: the widgets are never updated from here.
+        """
+        maps = quantity_maps(analysis)
+        labels = self.get_labels(describe_psd(self.bls_data.data).image_shape, displayed)
+        label_ids, pixel_count, mean, variance = label_quantity_statistics(
+            labels, maps, displayed, progress
+        )
+        logger.info(f"Computed statistics of {len(label_ids)} labels")
+
+        columns = {"Label": label_ids, "Pixels": pixel_count}
+        for i, (quantity_name, peak_name, units) in enumerate(maps.labels):
+            # The contrasts have no units
+            suffix = f" [{units}]" if units is not None else ""
+            columns[f"{quantity_name} {peak_name} mean{suffix}"] = mean[i]
+            columns[f"{quantity_name} {peak_name} std{suffix}"] = np.sqrt(variance[i])
+        df = pd.DataFrame(columns)
+
+        spectra = None
+        if self.compute_spectra:
+            spectra = label_mean_spectra(self.bls_data.data, labels, progress=progress)
+        return df, spectra
+
+    def plot_label_spectra(
+        self, label_ids, frequency, mean_spectra, PSD_units, frequency_units
+    ) -> hv.Image:
+        """All the mean spectra as a single image (label vs frequency), to scale to many labels"""
+        return hv.Image(
+            (frequency, np.arange(len(label_ids)), mean_spectra),
+            kdims=[
+                hv.Dimension("Frequency", unit=frequency_units),
+                hv.Dimension("Label index"),
+            ],
+            vdims=[hv.Dimension("PSD", unit=PSD_units)],
+        ).opts(
+            cmap="viridis",
+            colorbar=True,
+            tools=["hover"],
+            title="Mean spectrum of each label",
+            responsive=True,
+            min_height=300,
+        )
+
+    # === Panel display method / GUI logic===
+
+    @pn.depends("label_source", watch=True)
+    def _update_source_widgets(self):
+        self.threshold_widgets.visible = self.label_source == "Threshold"
+        self.label_file_input.visible = self.label_source == "Label image"
+
+    @pn.depends("loading", watch=True)
+    def loading_spinner(self):
+        """
+        Controls an additional spinner UI, see `BlsStatistics.loading_spinner`.
+        """
+        if self.loading:
+            self.spinner.value = True
+            self.spinner.name = "Loading..."
+        else:
+            self.spinner.value = False
+            self.spinner.name = "Idle"
+
+    def __panel__(self):
+        card = pn.Card(
+            pn.Row(
+                pn.widgets.RadioButtonGroup.from_param(
+                    self.param.label_source, button_type="light"
+                ),
+                pn.widgets.TooltipIcon(value=self.tooltip),
+            ),
+            self.threshold_widgets,
+            self.label_file_input,
+            pn.Row(
+                pn.widgets.Checkbox.from_param(self.param.compute_spectra),
+                self.compute_button,
+                self.spinner,
+            ),
+            self.tqdm,
+            self.status,
+            self.label_tabulator_widget,
+            self.spectra_plot_widget,
+            title="Label Statistics",
+            collapsed=True,
+            sizing_mode="stretch_width",
+        )
+        return card
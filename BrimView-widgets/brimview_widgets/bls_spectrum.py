@@ -23,6 +23,7 @@ from .logging import logger
 from panel.widgets.base import WidgetBase
 from panel.custom import PyComponent
 from .bls_types import bls_param
+from .coordinate_mapper import as_zyx_points
 from .widgets import SwitchWithLabels
 
 from bokeh.models.widgets.tables import HTMLTemplateFormatter
@@ -228,9 +229,7 @@ class BlsSpectrumVisualizer(WidgetBase, PyComponent):
         Returns:
             (z, y, x): as int/pixel coordinates
         """
-        z = self.dataset_zyx_coord[0]
-        y = self.dataset_zyx_coord[1]
-        x = self.dataset_zyx_coord[2]
+        ((z, y, x),) = as_zyx_points(self.dataset_zyx_coord).tolist()
         return (z, y, x)
 
 
@@ -1,7 +1,20 @@
 from brimview_widgets.utils import catch_and_notify
 from .bls_data_visualizer import BlsDataVisualizer
 from .logging import logger
+from .environment import running_from_pyodide
 from .bls_types import bls_param
+from .coordinate_mapper import CoordinateMapper
+from .psd_access import SpectraReader, QuantityMaps, quantity_maps, preloaded_map
+from .progress_channel import ProgressChannel
+from .progress_widget import follow_tqdm
+from .spectral_utils import (
+    has_shared_frequency_axis,
+    common_frequency_axis,
+    resample_spectra,
+    RunningSpectrumStats,
+    QuantileSketch,
+    SpectralDensity,
+)
 
 import panel as pn
 from panel.widgets.base import WidgetBase
@@ -10,12 +23,157 @@ from bokeh.models.widgets.tables import ScientificFormatter
 import param
 import holoviews as hv
 import numpy as np
-import scipy
 import xarray as xr
 import pandas as pd
+import brimfile as bls
+import asyncio
+import warnings
+from typing import Callable
+from dataclasses import dataclass, field, replace
 
 
-ZYXPoints = list[tuple[int, int, int]]
+# (N, 3) int array of (z, y, x) data indices
+ZYXPoints = np.ndarray
+
+# Above this many selected pixels, "Auto" aggregation switches to streaming
+STREAMING_THRESHOLD = 50_000
+# Number of pixels whose quantities are read at once when streaming
+_QUANTITY_BATCH_SIZE = 65_536
+# Number of PSD bins of the spectral density view
+DENSITY_PSD_BINS = 100
+
+# Removing spectra from running statistics (`RunningSpectrumStats.subtract`) loses a bit
+# of precision every time: the statistics of a ROI are recomputed from scratch after
+# this many incremental edits, or when an edit removes more than this fraction of its pixels
+_MAX_INCREMENTAL_EDITS = 16
+_MAX_REMOVED_FRACTION = 0.5
+# Relative difference between the incremental and the recomputed statistics above which
+# the drift is reported
+_DRIFT_TOLERANCE = 1e-6
+
+
+# Pixels are identified by a single integer in the incremental updates;
+# 20 bits per axis (~1M pixels) is plenty for any realistic image
+_AXIS_BITS = 20
+_FLAT_SHAPE = (1 << _AXIS_BITS,) * 3
+
+
+def _flat_index(points: ZYXPoints) -> np.ndarray:
+    return np.unique(np.ravel_multi_index(tuple(points.T), _FLAT_SHAPE))
+
+
+def _unflat_index(index: np.ndarray) -> ZYXPoints:
+    return np.stack(np.unravel_index(index, _FLAT_SHAPE), axis=-1).astype(np.intp)
+
+
+def _is_small_edit(previous: np.ndarray, added: np.ndarray, removed: np.ndarray) -> bool:
+    """
+    Whether the statistics of the pixels `previous` are worth updating incrementally
+    (rather than recomputed) to add the pixels `added` and remove the pixels `removed`
+    """
+    n_pixels = len(previous) + len(added) - len(removed)
+    return (
+        len(added) + len(removed) < n_pixels
+        and len(removed) <= _MAX_REMOVED_FRACTION * len(previous)
+    )
+
+
+class RoiComputationSuperseded(Exception):
+    """Raised inside a ROI computation when a newer ROI has been selected"""
+
+
+def _batch_done(check_cancelled: Callable[[], None], progress: ProgressChannel):
+    """Called by the ROI computations after each batch they read"""
+    if progress is not None:
+        progress.advance(1)
+    if check_cancelled is not None:
+        check_cancelled()
+
+
+@dataclass
+class SpectrumAggregate:
+    """
+    Running statistics of the spectra of a ROI, resampled on a fixed frequency axis,
+    together with the pixels they were computed on.
+    """
+
+    data: bls.Data
+    frequency: np.ndarray
+    stats: RunningSpectrumStats
+    PSD_units: str
+    frequency_units: str
+    # Whether all the spectra share the same frequency axis. If not, the common axis
+    # depends on the pixels in the ROI, so the aggregate can't be updated incrementally
+    shared_frequency: bool
+    # Sorted flat indices of the pixels (see `_flat_index`)
+    index: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.intp))
+    # Number of incremental edits since the statistics were computed from scratch
+    n_edits: int = 0
+
+    def can_be_updated(self, data: bls.Data) -> bool:
+        return self.data is data and self.shared_frequency
+
+
+@dataclass
+class RoiInputs:
+    """
+    What a ROI computation needs from the widget, gathered on the event loop
+    so that the computation itself can run in a worker thread (see `BlsStatistics.compute_roi`).
+    """
+
+    points: ZYXPoints
+    data: bls.Data
+    analysis: bls.Data.AnalysisResults
+    # Whether the spectra and quantities are aggregated by streaming (see `BlsStatistics.use_streaming`)
+    streaming: bool
+    # `BlsStatistics.spectrum_view`
+    view: str
+    # See `BlsStatistics.displayed_map`
+    displayed_map: dict
+    # Written by the computation, polled by the event loop to show the progress
+    progress: ProgressChannel
+
+
+@dataclass
+class QuantityAggregate:
+    """
+    Statistics of the quantity maps of a ROI, together with the pixels they were computed on.
+
+    With exact aggregation the values themselves are kept, so that pixels can be added
+    or removed without reading the others again. With streaming aggregation only running
+    moments and a quantile sketch per map are kept; the sketches can be merged but can't
+    forget values, so only the edits that add pixels are incremental.
+    """
+
+    maps: QuantityMaps
+    # Sorted flat indices of the pixels (see `_flat_index`)
+    index: np.ndarray
+    # Exact aggregation: (n_maps, n_pixels) values, in the order of `index`
+    values: np.ndarray = None
+    # Streaming aggregation: moments of each map, and one sketch per map
+    moments: RunningSpectrumStats = None
+    sketches: list[QuantileSketch] = None
+
+    @property
+    def streaming(self) -> bool:
+        return self.values is None
+
+    def can_be_updated(self, maps: QuantityMaps, streaming: bool) -> bool:
+        return self.maps is maps and self.streaming == streaming
+
+
+@dataclass
+class SavedRoi:
+    """A named ROI, with its statistics computed once and cached"""
+
+    name: str
+    points: ZYXPoints
+    spectrum: SpectrumAggregate
+    quantities: pd.DataFrame
+
+    @property
+    def n_pixels(self) -> int:
+        return len(self.points)
 
 
 class BlsStatistics(WidgetBase, PyComponent):
@@ -32,6 +190,18 @@ class BlsStatistics(WidgetBase, PyComponent):
         allow_refs=True,
     )
 
+    displayed_dataset = param.ClassSelector(
+        class_=hv.Dataset,
+        default=None,
+        precedence=-1,
+        doc="Quantity map currently loaded by the data visualizer",
+        allow_refs=True,
+    )
+    displayed_quantity = param.Parameter(
+        default=None, precedence=-1, allow_refs=True
+    )
+    displayed_peak = param.Parameter(default=None, precedence=-1, allow_refs=True)
+
     img_mask = param.Parameter(
         default=None,
         precedence=-1,
@@ -50,12 +220,49 @@ class BlsStatistics(WidgetBase, PyComponent):
     img_axis_3_slice = param.Integer(
         default=0, label="3rd axis slice selector", allow_refs=True
     )
+    img_slices = param.List(default=[0], precedence=-1, allow_refs=True)
+
+    # === 3D ROI ===
+    roi_depth = param.Selector(
+        default="Current slice",
+        objects=["Current slice", "Slice range", "Per-slice lassos"],
+        label="ROI depth",
+        doc=(
+            "'Current slice': the lasso of the displayed slice only. "
+            "'Slice range': the lasso is extruded through a range of slices along the 3rd axis. "
+            "'Per-slice lassos': the lassos drawn on several slices are combined."
+        ),
+    )
+    slice_range = param.Range(default=(0, 0), label="Slice range")
+
+    aggregation = param.Selector(
+        default="Auto",
+        objects=["Auto", "Exact", "Streaming"],
+        doc=(
+            "How the statistics are computed. 'Exact' loads all the selected spectra and quantities "
+            "in memory; 'Streaming' processes them chunk by chunk in bounded memory, with approximate "
+            "median and percentiles of the quantities. 'Auto' streams above a given number of selected pixels."
+        ),
+    )
+
+    spectrum_view = param.Selector(
+        default="Mean ± std",
+        objects=["Mean ± std", "Density"],
+        label="Spectrum view",
+        doc=(
+            "'Density' shows a 2D histogram of all the spectra of the ROI, "
+            "which reveals e.g. bimodal populations hidden by the mean."
+        ),
+    )
+
+    # === Multi-ROI comparison ===
+    roi_name = param.String(default="ROI 1", label="ROI name")
 
     # === Internal state ===
-    selected_points = param.List(
-        default=[],
+    selected_points = param.Array(
+        default=np.empty((0, 3), dtype=np.intp),
         precedence=-1,
-        doc="List of selected points (z, y, x ) in data coordinates",
+        doc="(N, 3) array of the selected points (z, y, x) in data coordinates",
     )
 
     def __init__(self, result_plot: BlsDataVisualizer, **params):
@@ -63,7 +270,9 @@ class BlsStatistics(WidgetBase, PyComponent):
             value=False, size=20, name="Idle", visible=True
         )
         params["name"] = "Group Statistics"
-        self.tooltip = "Use the **Lasso Select** tool to select a region in the image. This widget will compute the average spectrum and other quantities for the selected region."
+        # Saved ROIs to compare (by name). Needed before the links below trigger the watchers
+        self._saved_rois: dict[str, SavedRoi] = {}
+        self.tooltip = "Use the **Lasso Select** tool to select a region in the image. This widget will compute the average spectrum and other quantities for the selected region. The region can be extended in 3D, either through a range of slices or by drawing a lasso on several slices."
         super().__init__(**params)
 
         # === Linking to other widgets ===
@@ -74,11 +283,16 @@ class BlsStatistics(WidgetBase, PyComponent):
             analysis=result_plot.param.bls_analysis,
         )
 
+        self.displayed_dataset = result_plot.param.img_dataset
+        self.displayed_quantity = result_plot.param.result_quantity
+        self.displayed_peak = result_plot.param.result_peak
+
         self.img_mask = result_plot.param.mask
         self.img_axis_1 = result_plot.param.img_axis_1
         self.img_axis_2 = result_plot.param.img_axis_2
         self.img_axis_3 = result_plot.param.img_axis_3
         self.img_axis_3_slice = result_plot.param.img_axis_3_slice
+        self.img_slices = result_plot.param.slices
 
         # === Some panel setup ===
         # Because we're not a pn.Viewer anymore, by default we lost the "card" display
@@ -94,56 +308,118 @@ class BlsStatistics(WidgetBase, PyComponent):
 
         self.tqdm = pn.widgets.Tqdm(visible=False)
 
+        # Spectrum statistics of the last ROI, to only process the changes of the next one
+        self._roi_spectrum: SpectrumAggregate = None
+        # Same for the quantity statistics
+        self._roi_quantity_stats: QuantityAggregate = None
+        # Incremented on every ROI change, to drop the results of superseded computations
+        self._roi_generation = 0
+        # Lasso of each slice, in "Per-slice lassos" mode: _slice_masks[slice_index] = 2D mask
+        self._slice_masks: dict[int, np.ndarray] = {}
+
+        self.slice_range_widget = pn.widgets.IntRangeSlider.from_param(
+            self.param.slice_range, start=0, end=1, step=1, visible=False
+        )
+        self.clear_roi_button = pn.widgets.Button(
+            name="Clear other slices", button_type="light", visible=False
+        )
+        self.clear_roi_button.on_click(self._clear_slice_masks)
+        self._update_slice_range()
+
+        # Last published ROI results
+        self._roi_points: ZYXPoints = np.empty((0, 3), dtype=np.intp)
+        self._roi_quantities: pd.DataFrame = None
+
+        self.save_roi_button = pn.widgets.Button(
+            name="Save ROI", button_type="primary", disabled=True
+        )
+        self.save_roi_button.on_click(self.save_current_roi)
+        self.roi_list_widget = pn.widgets.Tabulator(
+            self._roi_list_dataframe(),
+            show_index=False,
+            disabled=True,
+            buttons={"Remove": "✖"},
+            layout="fit_columns",
+            sizing_mode="stretch_width",
+        )
+        self.roi_list_widget.on_click(self._on_roi_list_click)
+        self.comparison_plot_widget = pn.pane.HoloViews(
+            None, sizing_mode="stretch_width"
+        )
+        self.comparison_tabulator_widget = self.comparison_tabulator()
+
         # === Typing hints ===
         self.bls_data: bls_param
         self.img_mask: xr.DataArray
-        self.selected_points: list[tuple[int, int, int]]
+        self.selected_points: ZYXPoints
 
-    @pn.depends("img_mask")
+    @pn.depends("selected_points")
     def mask_status(self):
-        if self.img_mask is None:
+        if len(self.selected_points) == 0:
             return "No selection in the image. Use the lasso tool to select a region."
         else:
-            num_selected = np.count_nonzero(self.img_mask)
-            total_pixels = self.img_mask.size
-            pct_selected = 100 * num_selected / total_pixels
-            return f"Selected pixels: {num_selected} ({pct_selected:.2f}%)"
+            num_selected = len(self.selected_points)
+            mapper = self.coordinate_mapper()
+            num_slices = len(np.unique(mapper.to_display_indices(self.selected_points)[2]))
+            return f"Selected pixels: {num_selected} (in {num_slices} slice(s))"
 
-    @pn.depends("img_mask", watch=True)
+    @pn.depends("img_mask", "roi_depth", "slice_range", watch=True)
     def update_selected_points(self):
-        """Update the list of selected points based on the current image mask."""
-        if self.img_mask is None:
-            self.selected_points = []
+        """Update the selected points based on the current image mask and ROI depth."""
+        mapper = self.coordinate_mapper()
+        if self.roi_depth == "Per-slice lassos":
+            # Changing slice resets the mask of the visualizer, but we keep the stored lassos
+            if self.img_mask is not None:
+                mask = np.asarray(self.img_mask)
+                if mask.any():
+                    self._slice_masks[self.img_axis_3_slice] = mask
+                else:
+                    # The lasso of this slice was cleared
+                    self._slice_masks.pop(self.img_axis_3_slice, None)
+            self.selected_points = mapper.masks_to_data_indices(self._slice_masks)
+        elif self.img_mask is None:
+            self.selected_points = np.empty((0, 3), dtype=np.intp)
+        elif self.roi_depth == "Slice range":
+            (start, end) = self.slice_range
+            self.selected_points = mapper.mask_to_data_indices(
+                self.img_mask, np.arange(start, end + 1)
+            )
         else:
-            self.selected_points = self.mask_to_list(self.img_mask)
-
-    def mask_to_list(self, mask: xr.DataArray) -> list[tuple[int, int, int]]:
-        """Convert a 2D mask DataArray to a list of selected points (z, y, x)."""
-        selected_points = []
-        mask_indices = np.argwhere(mask.values)
-        for idx in mask_indices:
-            y_displayed, x_displayed = idx
-            # Assuming single z slice for simplicity; extend as needed
-
-            # TODO: Maybe it's time now to create a proper coordinate mapper class?
-            # Initialize coordinates and map each logical axis exactly once
-            x = y = z = None
-            axis_mappings = [
-                (self.img_axis_1, x_displayed, None),
-                (self.img_axis_2, y_displayed, None),
-                (self.img_axis_3, None, self.img_axis_3_slice),
-            ]
-            for axis_name, displayed_val, slice_val in axis_mappings:
-                value = displayed_val if displayed_val is not None else slice_val
-                if axis_name == "x":
-                    x = value
-                elif axis_name == "y":
-                    y = value
-                elif axis_name == "z":
-                    z = value
-
-            selected_points.append((z, y, x))
-        return selected_points
+            self.selected_points = mapper.mask_to_data_indices(self.img_mask)
+
+    @pn.depends("img_axis_1", "img_axis_2", "img_axis_3", watch=True)
+    def _clear_slice_masks(self, *_):
+        """
+        Forget the lassos stored for all the slices; the lasso currently drawn on the displayed
+        slice, if any, is then stored again from `img_mask`.
+        Also needed when the displayed axes change, as the stored lassos don't mean anything anymore.
+        """
+        self._slice_masks = {}
+        if self.roi_depth == "Per-slice lassos":
+            self.update_selected_points()
+
+    @pn.depends("img_slices", watch=True)
+    def _update_slice_range(self):
+        last_slice = max(len(self.img_slices) - 1, 0)
+        self.param.slice_range.bounds = (0, last_slice)
+        self.slice_range = (0, last_slice)
+        # A slider can't have start == end
+        self.slice_range_widget.end = max(last_slice, 1)
+        self.slice_range_widget.disabled = last_slice == 0
+
+    @pn.depends("roi_depth", watch=True)
+    def _update_roi_depth_widgets(self):
+        self.slice_range_widget.visible = self.roi_depth == "Slice range"
+        self.clear_roi_button.visible = self.roi_depth == "Per-slice lassos"
+
+    def coordinate_mapper(self) -> CoordinateMapper:
+        """Mapper from the displayed mask to the data indices"""
+        return CoordinateMapper(
+            horizontal_axis=self.img_axis_1,
+            vertical_axis=self.img_axis_2,
+            slice_axis=self.img_axis_3,
+            slice_index=self.img_axis_3_slice,
+        )
 
     @pn.depends("selected_points")
     def selected_points_widget(self):
@@ -151,7 +427,7 @@ class BlsStatistics(WidgetBase, PyComponent):
         Display the list of selected points in a DataFrame.
         Should only be used for debugging due to potential performance issues.
         """
-        if not self.selected_points:
+        if len(self.selected_points) == 0:
             return pn.pane.Markdown("No points selected.")
         else:
             df = pd.DataFrame(self.selected_points, columns=["z", "y", "x"])
@@ -159,40 +435,23 @@ class BlsStatistics(WidgetBase, PyComponent):
 
     # === Average spectrum computation and visualization ===
 
-    def fetch_data_from_points(self, selected_points: ZYXPoints):
-        """
-        Fetch data from the selected points.
-        """
-        if not selected_points or self.bls_data is None:
-            logger.debug(
-                "No points selected or no BLS data loaded for average spectrum"
-            )
-            return (
-                None,
-                None,
-            )
-        else:
-            all_spectra = []
-            all_quantities = []
-            for z, y, x in self.tqdm(
-                selected_points, desc="Fetching data from points", leave=False
-            ):
-                spectrum, quantities = (
-                    self.bls_data.data.get_spectrum_and_all_quantities_in_image(
-                        ar=self.bls_data.analysis, coor=(z, y, x)
-                    )
-                )
-                all_spectra.append(spectrum)
-                all_quantities.append(quantities)
-            return all_spectra, all_quantities
+    def displayed_map(self) -> dict:
+        """The map already loaded by the data visualizer (see `preloaded_map`)"""
+        return preloaded_map(
+            self.displayed_dataset, self.displayed_quantity, self.displayed_peak
+        )
 
-    @pn.depends("selected_points", watch=True)
+    @pn.depends("selected_points", "aggregation", "spectrum_view", watch=True)
     @catch_and_notify(prefix="<b>Processing ROI: </b>")
-    def update_widget(self):
+    async def update_widget(self):
+        # Any new ROI supersedes the computations still running for the previous ones
+        self._roi_generation += 1
+        generation = self._roi_generation
+
         if (
             self.bls_data is None
             or not self.bls_data.is_loaded()
-            or not self.selected_points
+            or len(self.selected_points) == 0
         ):
             logger.debug(
                 "No data or no points selected, skipping statistics widget update"
@@ -200,106 +459,554 @@ class BlsStatistics(WidgetBase, PyComponent):
             self.spectrum_plot_widget.object = None
             self.statistic_tabulator_widget.value = self.placeholder_dataframe()
             self.statistic_tabulator_widget.visible = False
+            self.save_roi_button.disabled = True
+            self.tqdm.visible = False
+            self.loading = False
             return
 
         self.loading = True
         self.tqdm.visible = True
-        spectra, quantities = self.fetch_data_from_points(self.selected_points)
-
-        # spectra: (PSD, frequency, PSD_units, frequency_units)
-        (common_freq, mean_spectrum, std_spectrum, PSD_units, frequency_units) = (
-            self.compute_average_spectrum(spectra)
+        # Everything the computation needs from the widgets is gathered here, on the event loop;
+        # its progress is shown by polling `progress`, the thread never touches the widgets
+        roi = RoiInputs(
+            points=self.selected_points,
+            data=self.bls_data.data,
+            analysis=self.bls_data.analysis,
+            streaming=self.use_streaming(len(self.selected_points)),
+            view=self.spectrum_view,
+            displayed_map=self.displayed_map(),
+            progress=ProgressChannel(total=0),
         )
-        curve = self.plot_average_spectrum(
-            common_freq, mean_spectrum, std_spectrum, PSD_units, frequency_units
+        follow = asyncio.ensure_future(
+            follow_tqdm(self.tqdm, roi.progress, desc="Processing ROI")
         )
-        self.spectrum_plot_widget.object = curve
+        try:
+            if running_from_pyodide:
+                # No threads in pyodide: the computation runs inline
+                result = self.compute_roi(
+                    self._roi_spectrum, self._roi_quantity_stats, roi, generation
+                )
+            else:
+                result = await asyncio.to_thread(
+                    self.compute_roi,
+                    self._roi_spectrum,
+                    self._roi_quantity_stats,
+                    roi,
+                    generation,
+                )
+        except RoiComputationSuperseded:
+            logger.debug(f"ROI computation #{generation} dropped (superseded)")
+            return
+        finally:
+            roi.progress.close()
+            follow.cancel()
+            if generation == self._roi_generation:
+                self.tqdm.visible = False
+                self.loading = False
 
-        # quantities: result[quantity.name][peak.name] = bls.Metadata.Item(value, units)
-        df_quantities = self.compute_average_quantities(quantities)
+        if generation != self._roi_generation:
+            # Finished, but the ROI changed in the meantime: the results are stale
+            return
+
+        self._roi_spectrum, self._roi_quantity_stats, df_quantities, density = result
+        self._roi_points = self.selected_points
+        self._roi_quantities = df_quantities
+        self.save_roi_button.disabled = False
+        if density is not None:
+            plot = self.plot_spectral_density(density, self._roi_spectrum)
+        else:
+            plot = self.plot_average_spectrum(
+                self._roi_spectrum.frequency,
+                self._roi_spectrum.stats.mean_or_nan(),
+                self._roi_spectrum.stats.std(),
+                self._roi_spectrum.PSD_units,
+                self._roi_spectrum.frequency_units,
+            )
+        self.spectrum_plot_widget.object = plot
 
         self.statistic_tabulator_widget.visible = True
         self.statistic_tabulator_widget.value = df_quantities
 
-        self.tqdm.visible = False
-        self.loading = False
+    def compute_roi(
+        self,
+        previous: "SpectrumAggregate",
+        previous_quantities: "QuantityAggregate",
+        roi: RoiInputs,
+        generation: int,
+    ) -> tuple["SpectrumAggregate", "QuantityAggregate", pd.DataFrame, SpectralDensity]:
+        """
+        Computes the spectrum and quantity statistics of a ROI, the quantity table and,
+        for the "Density" view, the spectral density (None otherwise).
+        The statistics of the previous ROI are updated when possible (see `_is_small_edit`).
 
-    def compute_average_spectrum(
-        self, spectra
-    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, str, str]:
-        if spectra is None or len(spectra) == 0:
+        Meant to run in a worker thread: only `roi` is read, the widgets and their
+        parameters are never touched from here (the progress is written to `roi.progress`,
+        which the event loop polls), and the previous statistics are not modified.
+        Raises `RoiComputationSuperseded` at the next chunk boundary if the ROI
+        changes in the meantime.
+        """
+
+        def check_superseded():
+            if generation != self._roi_generation:
+                raise RoiComputationSuperseded()
+
+        aggregate = self.update_spectrum_aggregate(previous, roi, check_superseded)
+        if aggregate.stats.n_spectra == 0:
             raise ValueError("No spectra provided for averaging")
-        retrieved_PSD = []
-        retrieved_frequency = []
-        for PSD, frequency, PSD_units, frequency_units in spectra:
-            retrieved_PSD.append(PSD)
-            retrieved_frequency.append(frequency)
-
-        # Generate average PSD
-        # Figuring out which frequency axis to use
-        n_data_points = len(
-            retrieved_PSD[0]
-        )  # Assuming they all have the same number of points
-        freq_min = np.nanmin(retrieved_frequency)
-        freq_max = np.nanmax(retrieved_frequency)
-        common_freq = np.linspace(freq_min, freq_max, n_data_points)  # shape (71,)
-
-        # Interpolating all the PSDs to the common frequency axis
-        interpolated_psd = np.empty((len(self.selected_points), len(common_freq)))
-        for i in self.tqdm(
-            range(len(self.selected_points)), desc="Interpolating spectra", leave=False
-        ):
-            interp_func = scipy.interpolate.interp1d(
-                retrieved_frequency[i],
-                retrieved_PSD[i],
-                kind="linear",
-                bounds_error=False,
-                fill_value="extrapolate",
+        check_superseded()
+
+        density = None
+        if roi.view == "Density":
+            density = self.compute_spectral_density(
+                roi.data, roi.points, aggregate, check_superseded, roi.progress
             )
-            interpolated_psd[i, :] = interp_func(common_freq)
 
-        mean_spectrum = np.mean(interpolated_psd, axis=0)  # shape (71,)
-        std_spectrum = np.nanstd(interpolated_psd, axis=0)
-        return (common_freq, mean_spectrum, std_spectrum, PSD_units, frequency_units)
+        quantities = self.update_quantity_aggregate(
+            previous_quantities, roi, check_superseded
+        )
+        return aggregate, quantities, self.quantity_table(quantities), density
+
+    def compute_spectral_density(
+        self,
+        data: bls.Data,
+        points: ZYXPoints,
+        aggregate: SpectrumAggregate,
+        check_cancelled: Callable[[], None] = None,
+        progress: ProgressChannel = None,
+    ) -> SpectralDensity:
+        """
+        2D histogram of all the spectra at `points`, resampled on the frequency axis
+        of `aggregate`. The spectra are streamed chunk by chunk, whatever the ROI size.
+
+        The PSD range is taken from the aggregate (mean ± 3 std over all the frequencies),
+        as it has to be known before reading the spectra.
+        """
+        mean, std = aggregate.stats.mean_or_nan(), aggregate.stats.std()
+        low, high = np.nanmin(mean - 3 * std), np.nanmax(mean + 3 * std)
+        if not high > low:
+            high = low + 1
+        density = SpectralDensity(
+            aggregate.frequency, np.linspace(low, high, DENSITY_PSD_BINS + 1)
+        )
+
+        z, y, x = points.T
+        reader = SpectraReader(data, z, y, x)
+        if progress is not None:
+            progress.extend(len(reader))
+        for _, PSD, frequency in reader:
+            density.update(resample_spectra(frequency, PSD, aggregate.frequency))
+            _batch_done(check_cancelled, progress)
+        return density
+
+    def update_quantity_aggregate(
+        self,
+        previous: "QuantityAggregate",
+        roi: RoiInputs,
+        check_cancelled: Callable[[], None] = None,
+    ) -> "QuantityAggregate":
+        """
+        Statistics of all the quantities and peaks at `roi.points`. Only the chunks of the
+        quantity maps that contain the points are read, and if `previous` holds the statistics
+        of a similar ROI, only the added pixels (see `QuantityAggregate`).
+        """
+        maps = quantity_maps(roi.analysis)
+        index = _flat_index(roi.points)
+        if previous is not None and previous.can_be_updated(maps, roi.streaming):
+            added = np.setdiff1d(index, previous.index)
+            removed = np.setdiff1d(previous.index, index)
+            if _is_small_edit(previous.index, added, removed) and (
+                not roi.streaming or len(removed) == 0
+            ):
+                logger.debug(
+                    f"Incremental ROI quantities update: +{len(added)} / -{len(removed)} pixels"
+                )
+                update = self.aggregate_quantities(roi, maps, added, check_cancelled)
+                if roi.streaming:
+                    update.moments.merge(previous.moments)
+                    for sketch, previous_sketch in zip(update.sketches, previous.sketches):
+                        sketch.merge(previous_sketch)
+                    update.index = index
+                    return update
+                kept = ~np.isin(previous.index, removed)
+                merged = np.concatenate([previous.index[kept], added])
+                values = np.concatenate([previous.values[:, kept], update.values], axis=1)
+                return QuantityAggregate(
+                    maps, index, values=values[:, np.argsort(merged)]
+                )
+        return self.aggregate_quantities(roi, maps, index, check_cancelled)
+
+    def aggregate_quantities(
+        self,
+        roi: RoiInputs,
+        maps: QuantityMaps,
+        index: np.ndarray,
+        check_cancelled: Callable[[], None] = None,
+    ) -> "QuantityAggregate":
+        """Statistics of the quantities at the pixels `index` (all or part of the ROI)"""
+        z, y, x = _unflat_index(index).T
+        if roi.streaming:
+            return self.stream_average_quantities(
+                maps, z, y, x, roi.displayed_map, check_cancelled, roi.progress
+            )
+        values = maps.values_at(z, y, x, roi.displayed_map)
+        return QuantityAggregate(maps, index, values=values)
+
+    def quantity_table(self, quantities: "QuantityAggregate") -> pd.DataFrame:
+        """Statistics table of all the quantities and peaks of a ROI"""
+        if quantities.streaming:
+            return self.stream_quantity_table(quantities)
+        return self.compute_average_quantities(
+            (quantities.maps.labels, quantities.values)
+        )
+
+    def use_streaming(self, n_points: int) -> bool:
+        """Whether a ROI of `n_points` pixels is aggregated by streaming, per `aggregation`"""
+        if self.aggregation == "Auto":
+            return n_points > STREAMING_THRESHOLD
+        return self.aggregation == "Streaming"
+
+    @staticmethod
+    def _stats_row(peak_name, quantity_name, mean, median, std, p5, p95, units):
+        return {
+            "Peak": peak_name,
+            "Quantity": quantity_name,
+            "Mean": mean,
+            "Median": median,
+            "Std": std,
+            "P5": p5,
+            "P95": p95,
+            "Units": units,
+        }
+
+    def update_spectrum_aggregate(
+        self,
+        previous: "SpectrumAggregate",
+        roi: RoiInputs,
+        check_cancelled: Callable[[], None] = None,
+    ) -> "SpectrumAggregate":
+        """
+        Statistics of the spectra at `roi.points`.
+
+        If `previous` holds the statistics of a similar ROI of the same data, only the
+        added and removed pixels are read and merged into / subtracted from a copy of it.
+        `check_cancelled` is called after each batch of chunks and may raise to abort;
+        the batches are counted in `roi.progress`.
+        """
+        index = _flat_index(roi.points)
+        edited = None
+        if previous is not None and previous.can_be_updated(roi.data):
+            added = np.setdiff1d(index, previous.index)
+            removed = np.setdiff1d(previous.index, index)
+            if _is_small_edit(previous.index, added, removed):
+                logger.debug(
+                    f"Incremental ROI update: +{len(added)} / -{len(removed)} pixels"
+                )
+                stats = previous.stats.copy()
+                if len(added) > 0:
+                    stats.merge(
+                        self.aggregate_spectra(
+                            roi, _unflat_index(added), previous.frequency, check_cancelled
+                        ).stats
+                    )
+                if len(removed) > 0:
+                    stats.subtract(
+                        self.aggregate_spectra(
+                            roi, _unflat_index(removed), previous.frequency, check_cancelled
+                        ).stats
+                    )
+                edited = replace(
+                    previous, stats=stats, index=index, n_edits=previous.n_edits + 1
+                )
+                if edited.n_edits < _MAX_INCREMENTAL_EDITS:
+                    return edited
+
+        aggregate = self.aggregate_spectra(
+            roi, roi.points, check_cancelled=check_cancelled
+        )
+        aggregate.index = index
+        if edited is not None and np.array_equal(edited.frequency, aggregate.frequency):
+            # Recomputed after many edits: check how far the incremental statistics drifted
+            drift = edited.stats.relative_difference(aggregate.stats)
+            message = (
+                f"Drift of the ROI statistics after {edited.n_edits} incremental edits: {drift:.2e}"
+            )
+            if drift > _DRIFT_TOLERANCE:
+                logger.warning(message)
+            else:
+                logger.debug(message)
+        return aggregate
+
+    def aggregate_spectra(
+        self,
+        roi: RoiInputs,
+        points: ZYXPoints,
+        common_freq: np.ndarray = None,
+        check_cancelled: Callable[[], None] = None,
+    ) -> "SpectrumAggregate":
+        """
+        Running statistics of the spectra of `roi.data` at `points` (all or part of the ROI),
+        resampled onto `common_freq`. If `common_freq` is None, it is determined from
+        the spectra themselves (see `common_frequency_axis`).
+        """
+        if roi.streaming:
+            return self.stream_average_spectrum(
+                roi.data, points, common_freq, check_cancelled, roi.progress
+            )
+        return self.compute_average_spectrum(
+            roi.data, points, common_freq, check_cancelled, roi.progress
+        )
+
+    def compute_average_spectrum(
+        self,
+        data: bls.Data,
+        points: ZYXPoints,
+        common_freq: np.ndarray = None,
+        check_cancelled: Callable[[], None] = None,
+        progress: ProgressChannel = None,
+    ) -> "SpectrumAggregate":
+        """
+        All the spectra are read in bulk (one read per storage chunk) and resampled at once.
+        """
+        z, y, x = points.T
+        reader = SpectraReader(data, z, y, x)
+        if progress is not None:
+            progress.extend(len(reader))
+        (retrieved_PSD, retrieved_frequency, PSD_units, frequency_units) = (
+            reader.read_all(on_batch=lambda: _batch_done(check_cancelled, progress))
+        )
+
+        # Figuring out which frequency axis to use: if all the spectra share
+        # the same axis we use it directly, without any interpolation
+        if common_freq is None:
+            n_data_points = retrieved_PSD.shape[-1]
+            common_freq = common_frequency_axis(retrieved_frequency, n_data_points)
+
+        # Resampling all the PSDs to the common frequency axis at once
+        interpolated_psd = resample_spectra(
+            retrieved_frequency, retrieved_PSD, common_freq
+        )
+        stats = RunningSpectrumStats(len(common_freq))
+        stats.update(interpolated_psd)
+        return SpectrumAggregate(
+            data=data,
+            frequency=common_freq,
+            stats=stats,
+            PSD_units=PSD_units,
+            frequency_units=frequency_units,
+            shared_frequency=has_shared_frequency_axis(retrieved_frequency),
+        )
 
     def compute_average_quantities(self, quantities) -> pd.DataFrame:
         """
-        Assuming quantities: result[quantity.name][peak.name] = bls.Metadata.Item(value, units)
+        Assuming quantities: (labels, values) with labels a list of (quantity_name, peak_name, units)
+        and values a (n_maps, N) array (see `QuantityMaps.values_at`).
+        The statistics of all the quantities and peaks are computed in one vectorised pass.
         """
-        if quantities is None or len(quantities) == 0:
+        if quantities is None or len(quantities[0]) == 0:
             raise ValueError("No quantities provided for averaging")
+        labels, values = quantities
+
+        with warnings.catch_warnings():
+            # All-NaN quantities (e.g. nothing fitted in the ROI) just give NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            mean_values = np.nanmean(values, axis=1)
+            std_values = np.nanstd(values, axis=1)
+            p5, median_values, p95 = np.nanpercentile(values, [5, 50, 95], axis=1)
 
         df_rows = []
-        for quantity_name in self.tqdm(
-            quantities[0].keys(), desc="Averaging quantities", leave=False
-        ):
-            for peak_name in self.tqdm(
-                quantities[0][quantity_name].keys(),
-                desc=f"Averaging peaks for {quantity_name}",
-                leave=False,
-            ):
-                values = [
-                    quantities[i][quantity_name][peak_name].value
-                    for i in range(len(quantities))
-                ]
-                mean_value = np.mean(values)
-                median_value = np.median(values)
-                std_value = np.std(values)
-                logger.debug(
-                    f"Average {quantity_name} ({peak_name}): {mean_value:.3f} ± {std_value:.3f}"
+        for i, (quantity_name, peak_name, units) in enumerate(labels):
+            logger.debug(
+                f"Average {quantity_name} ({peak_name}): {mean_values[i]:.3f} ± {std_values[i]:.3f}"
+            )
+            df_rows.append(
+                self._stats_row(
+                    peak_name,
+                    quantity_name,
+                    mean_values[i],
+                    median_values[i],
+                    std_values[i],
+                    p5[i],
+                    p95[i],
+                    units,
                 )
-                new_row = {
-                    "Peak": peak_name,
-                    "Quantity": quantity_name,
-                    "Mean": mean_value,
-                    "Median": median_value,
-                    "Std": std_value,
-                    "Units": quantities[0][quantity_name][peak_name].units,
-                }
-                df_rows.append(new_row)
+            )
         df = pd.DataFrame(df_rows)
         return df
 
+    # === Streaming aggregation (bounded memory) ===
+
+    def stream_average_spectrum(
+        self,
+        data: bls.Data,
+        points: ZYXPoints,
+        common_freq: np.ndarray = None,
+        check_cancelled: Callable[[], None] = None,
+        progress: ProgressChannel = None,
+    ) -> "SpectrumAggregate":
+        """
+        Same as `compute_average_spectrum`, but the spectra are read a batch of
+        storage chunks at a time and only the running mean/variance is kept in memory.
+        """
+        z, y, x = points.T
+        reader = SpectraReader(data, z, y, x)
+        if common_freq is None:
+            if reader.shared_frequency is not None:
+                common_freq = np.sort(reader.shared_frequency)
+            else:
+                # The frequency range must be known before seeing all the spectra
+                common_freq = np.linspace(*reader.frequency_range(), reader.n_freq)
+
+        stats = RunningSpectrumStats(len(common_freq))
+        if progress is not None:
+            progress.extend(len(reader))
+        for _, PSD, frequency in reader:
+            stats.update(resample_spectra(frequency, PSD, common_freq))
+            _batch_done(check_cancelled, progress)
+
+        return SpectrumAggregate(
+            data=data,
+            frequency=common_freq,
+            stats=stats,
+            PSD_units=reader.PSD_units,
+            frequency_units=reader.frequency_units,
+            shared_frequency=reader.shared_frequency is not None,
+        )
+
+    def stream_average_quantities(
+        self,
+        maps: QuantityMaps,
+        z,
+        y,
+        x,
+        preloaded: dict = None,
+        check_cancelled: Callable[[], None] = None,
+        progress: ProgressChannel = None,
+    ) -> "QuantityAggregate":
+        """
+        Statistics of the quantities at the given pixels, without ever having all their values
+        in memory: they are read a batch of pixels at a time, feeding running mean/variance and
+        a quantile sketch per map (median and percentiles are approximate).
+        """
+        if len(maps) == 0:
+            raise ValueError("No quantities provided for averaging")
+        moments = RunningSpectrumStats(len(maps))
+        sketches = [QuantileSketch() for _ in maps.labels]
+        if progress is not None:
+            progress.extend(-(-len(z) // _QUANTITY_BATCH_SIZE))
+        for _, values in maps.iter_values_at(z, y, x, _QUANTITY_BATCH_SIZE, preloaded):
+            moments.update(values.T)
+            for sketch, map_values in zip(sketches, values):
+                sketch.update(map_values)
+            _batch_done(check_cancelled, progress)
+        index = np.ravel_multi_index((z, y, x), _FLAT_SHAPE)
+        return QuantityAggregate(maps, index, moments=moments, sketches=sketches)
+
+    def stream_quantity_table(self, quantities: "QuantityAggregate") -> pd.DataFrame:
+        """Same as `compute_average_quantities`, from the moments and sketches of streaming"""
+        moments = quantities.moments
+        mean_values, std_values = moments.mean_or_nan(), moments.std()
+        df_rows = []
+        for i, (quantity_name, peak_name, units) in enumerate(quantities.maps.labels):
+            p5, median_value, p95 = quantities.sketches[i].quantile([0.05, 0.5, 0.95])
+            df_rows.append(
+                self._stats_row(
+                    peak_name,
+                    quantity_name,
+                    mean_values[i],
+                    median_value,
+                    std_values[i],
+                    p5,
+                    p95,
+                    units,
+                )
+            )
+        return pd.DataFrame(df_rows)
+
+    # === Multi-ROI comparison ===
+    # Everything here only uses the cached aggregates of the saved ROIs:
+    # adding or removing a ROI never reads any data.
+
+    def save_current_roi(self, event=None):
+        """Save the last computed ROI under `roi_name` (replacing any ROI with the same name)."""
+        if self._roi_spectrum is None or len(self._roi_points) == 0:
+            return
+        name = self.roi_name.strip() or f"ROI {len(self._saved_rois) + 1}"
+        self._saved_rois[name] = SavedRoi(
+            name=name,
+            points=self._roi_points,
+            spectrum=self._roi_spectrum,
+            quantities=self._roi_quantities,
+        )
+        logger.info(f"Saved {name} ({len(self._roi_points)} pixels)")
+
+        # Suggest a new name for the next ROI
+        index = len(self._saved_rois) + 1
+        while f"ROI {index}" in self._saved_rois:
+            index += 1
+        self.roi_name = f"ROI {index}"
+        self.update_comparison()
+
+    def remove_roi(self, name: str):
+        self._saved_rois.pop(name, None)
+        self.update_comparison()
+
+    def _on_roi_list_click(self, event):
+        if event.column == "Remove":
+            self.remove_roi(self.roi_list_widget.value["ROI"].iloc[event.row])
+
+    @pn.depends("bls_data.analysis", watch=True)
+    def _clear_saved_rois(self):
+        """The saved statistics belong to the previous data/analysis"""
+        if len(self._saved_rois) > 0:
+            logger.info("Data changed: removing the saved ROIs")
+            self._saved_rois = {}
+            self.update_comparison()
+
+    def update_comparison(self):
+        self.roi_list_widget.value = self._roi_list_dataframe()
+        if len(self._saved_rois) == 0:
+            self.comparison_plot_widget.object = None
+            self.comparison_tabulator_widget.value = self.placeholder_comparison_dataframe()
+            self.comparison_tabulator_widget.visible = False
+            return
+        self.comparison_plot_widget.object = self.plot_roi_spectra()
+        self.comparison_tabulator_widget.value = self.comparison_dataframe()
+        self.comparison_tabulator_widget.visible = True
+
+    def _roi_list_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "ROI": [roi.name for roi in self._saved_rois.values()],
+                "Pixels": [roi.n_pixels for roi in self._saved_rois.values()],
+            }
+        )
+
+    def comparison_dataframe(self) -> pd.DataFrame:
+        """Quantity statistics of all the saved ROIs, side by side"""
+        df = pd.concat(
+            [roi.quantities.assign(ROI=roi.name) for roi in self._saved_rois.values()],
+            ignore_index=True,
+        )
+        # Rows of the same quantity next to each other, ROIs in saving order
+        df = df.sort_values(["Quantity"], kind="stable")
+        columns = ["Peak", "Quantity", "ROI"]
+        return df[columns + [c for c in df.columns if c not in columns]]
+
+    def plot_roi_spectra(self) -> hv.Overlay:
+        curves = [
+            hv.Curve(
+                (roi.spectrum.frequency, roi.spectrum.stats.mean_or_nan()),
+                hv.Dimension("Frequency", unit=roi.spectrum.frequency_units),
+                hv.Dimension("PSD", unit=roi.spectrum.PSD_units),
+                label=roi.name,
+            )
+            for roi in self._saved_rois.values()
+        ]
+        return hv.Overlay(curves).opts(
+            hv.opts.Curve(tools=["hover"]),
+            hv.opts.Overlay(title="Average Spectra of Saved ROIs", legend_position="right"),
+        )
+
     # === Panel display method / GUI logic===
 
     @pn.depends("loading", watch=True)
@@ -361,6 +1068,8 @@ class BlsStatistics(WidgetBase, PyComponent):
                 "Mean": [0.0],
                 "Median": [0.0],
                 "Std": [1.0],
+                "P5": [0.0],
+                "P95": [0.0],
                 "Units": ["Units placeholder"],
             }
         )
@@ -379,12 +1088,25 @@ class BlsStatistics(WidgetBase, PyComponent):
                 "Mean": ScientificFormatter(precision=3),
                 "Median": ScientificFormatter(precision=3),
                 "Std": ScientificFormatter(precision=3),
+                "P5": ScientificFormatter(precision=3),
+                "P95": ScientificFormatter(precision=3),
             },
             layout="fit_columns",
             sizing_mode="stretch_width",
         )
         return tab
 
+    def comparison_tabulator(self) -> pn.widgets.Tabulator:
+        tab = self.statistic_tabulator()
+        tab.value = self.placeholder_comparison_dataframe()
+        tab.visible = False
+        return tab
+
+    def placeholder_comparison_dataframe(self) -> pd.DataFrame:
+        df = self.placeholder_dataframe()
+        df.insert(2, "ROI", ["ROI placeholder"])
+        return df
+
     def plot_average_spectrum(
         self, common_freq, mean_spectrum, std_spectrum, PSD_units, frequency_units
     ) -> hv.Curve:
@@ -401,13 +1123,66 @@ class BlsStatistics(WidgetBase, PyComponent):
         plot = curve * spread
         return plot
 
+    def plot_spectral_density(
+        self, density: SpectralDensity, aggregate: SpectrumAggregate
+    ) -> hv.Overlay:
+        """The spectral density as a single image, with the mean spectrum on top"""
+        # The frequency axis is not necessarily evenly spaced, hence the QuadMesh
+        counts = density.counts.astype(float)
+        counts[counts == 0] = np.nan  # Transparent empty bins
+        mesh = hv.QuadMesh(
+            (density.frequency, density.PSD_centers, counts),
+            kdims=[
+                hv.Dimension("Frequency", unit=aggregate.frequency_units),
+                hv.Dimension("PSD", unit=aggregate.PSD_units),
+            ],
+            vdims=[hv.Dimension("Spectra")],
+        ).opts(
+            cmap="viridis",
+            cnorm="log",
+            colorbar=True,
+            tools=["hover"],
+            title="Spectral Density of Selected Region",
+        )
+        curve = hv.Curve(
+            (aggregate.frequency, aggregate.stats.mean_or_nan()),
+            mesh.kdims[0],
+            mesh.kdims[1],
+            label="Average Spectra",
+        ).opts(color="red")
+        return mesh * curve
+
     def __panel__(self):
         """Create Panel layout for the statistics widget."""
         card = pn.Card(
             self.mask_status,
+            pn.Row(
+                pn.widgets.RadioButtonGroup.from_param(
+                    self.param.roi_depth, button_type="light"
+                ),
+                self.clear_roi_button,
+            ),
+            self.slice_range_widget,
+            self.param.aggregation,
+            pn.widgets.RadioButtonGroup.from_param(
+                self.param.spectrum_view, button_type="light"
+            ),
             self.tqdm,
             self.spectrum_plot_widget,
             self.statistic_tabulator_widget,
+            pn.Card(
+                pn.Row(
+                    pn.widgets.TextInput.from_param(self.param.roi_name, width=150),
+                    self.save_roi_button,
+                    align="end",
+                ),
+                self.roi_list_widget,
+                self.comparison_plot_widget,
+                self.comparison_tabulator_widget,
+                title="ROI comparison",
+                collapsed=True,
+                sizing_mode="stretch_width",
+            ),
             title="BLS Statistics",
             sizing_mode="stretch_height",
         )
@@ -0,0 +1,185 @@
+"""
+The brimfile internals BrimView relies on, in one place.
+
+The public API of brimfile reads whole datasets (e.g. `AnalysisResults.get_image`) or single
+pixels, and only writes analysis results as whole arrays (`Data.create_analysis_results_group`).
+The chunk-aware bulk reads of `psd_access` need lazy access to the datasets, and the incremental
+writes of `result_writer` need to create an empty analysis results group, write its datasets
+region by region and delete it if the treatment doesn't complete; brimfile only offers all that
+through private functions and methods, or private attributes (the file and the path of a group,
+the spatial map of sparse data). They are wrapped here: the modules that access the datasets
+themselves (`psd_access`, `result_writer`, the treatment and its checkpoints) only use the names
+below. The only other private uses are in `bls_zarr_info`, which shows the zarr store and groups
+of the file as they are and predates this module. Once brimfile has public APIs for writing
+analysis results by regions and for deleting them, the writing part of this module can go.
+
+Because these are private, brimfile is pinned to the minor version they were checked against
+(`BRIMFILE_VERSION`, see the dependencies in pyproject.toml): when upgrading brimfile, this is
+the module to check.
+"""
+
+import numpy as np
+import zarr
+import brimfile as bls
+from brimfile.file_abstraction import FileAbstraction, sync, _async_getitem, _gather_sync
+from brimfile.constants import brim_obj_names
+from brimfile.utils import concatenate_paths, set_object_name
+from brimfile import units as bls_units
+
+from .logging import logger
+
+# Minor version of brimfile whose internals are used here
+BRIMFILE_VERSION = "1.7"
+
+if not bls.__version__.startswith(BRIMFILE_VERSION + "."):
+    logger.warning(
+        f"brimfile {bls.__version__} is installed, but BrimView was checked against "
+        f"brimfile {BRIMFILE_VERSION}: reading or writing large files may fail"
+    )
+
+__all__ = [
+    "sync",
+    "gather_sync",
+    "async_getitem",
+    "group_file",
+    "group_path",
+    "file_name",
+    "spatial_map",
+    "open_data_dataset",
+    "dataset_units",
+    "open_quantity_dataset",
+    "water_references",
+    "create_analysis_results",
+    "create_quantity_array",
+    "delete_group",
+    "rename_group",
+]
+
+
+def gather_sync(*aws):
+    """Run several brimfile coroutines concurrently and return their results (`asyncio.gather`)"""
+    return _gather_sync(*aws)
+
+
+def async_getitem(ds, selection: tuple):
+    """Coroutine reading `ds[selection]` from a lazy dataset, without loading the rest of it"""
+    return _async_getitem(ds, selection)
+
+
+def group_file(group) -> FileAbstraction:
+    """The file of a data group or analysis results group, for the functions below"""
+    return group._file
+
+
+def group_path(group) -> str:
+    """Path of a data group or analysis results group in its file"""
+    return group._path
+
+
+def file_name(group) -> str:
+    """Path (or URL, for remote files) of the file of a data group or analysis results group"""
+    return str(group._file.filename)
+
+
+def spatial_map(group) -> np.ndarray:
+    """
+    For sparse data, the (z, y, x) map of the index of the spectrum of each pixel (-1 where
+    there is none) of a data group or analysis results group; None for non-sparse data.
+    """
+    if not group._sparse:
+        return None
+    return np.asarray(group._spatial_map, dtype=np.intp)
+
+
+def open_data_dataset(data: bls.Data, name: str):
+    """Coroutine opening (without reading) a dataset of a data group (`name` is "PSD" or "frequency")"""
+    return data._file.open_dataset(
+        concatenate_paths(data._path, getattr(brim_obj_names.data, name))
+    )
+
+
+def dataset_units(data: bls.Data, ds):
+    """Coroutine reading the units of a dataset opened from `data`"""
+    return bls_units.of_object(data._file, ds)
+
+
+def open_quantity_dataset(
+    analysis: bls.Data.AnalysisResults,
+    quantity: "bls.Data.AnalysisResults.Quantity",
+    peak: "bls.Data.AnalysisResults.PeakType",
+):
+    """Coroutine opening (without reading) the dataset of a fitted quantity"""
+    return analysis._get_quantity(quantity, peak, 0)
+
+
+def water_references(analysis: bls.Data.AnalysisResults) -> dict:
+    """
+    The reference values of water brimfile divides by to compute the contrasts, as
+    {Quantity.Elastic_contrast: shift, Quantity.Viscous_contrast: width}, positive; a contrast
+    is missing if brimfile can't compute it (e.g. the wavelength is not in the metadata).
+
+    brimfile only computes the contrasts of whole arrays, from the metadata (wavelength,
+    temperature, scattering angle, with its own defaults): the references are recovered from
+    the contrast of a unit value, `1 / reference - 1`.
+    """
+    Quantity = bls.Data.AnalysisResults.Quantity
+    computations = {
+        Quantity.Elastic_contrast: analysis._compute_elastic_contrast_async,
+        Quantity.Viscous_contrast: analysis._compute_viscous_contrast_async,
+    }
+    references = {}
+    for quantity, compute in computations.items():
+        try:
+            references[quantity] = 1 / (float(sync(compute(np.ones(1)))[0]) + 1)
+        except (ValueError, ZeroDivisionError) as e:
+            logger.debug(f"No {quantity.name}: {e}")
+    return references
+
+
+# === Writing ===
+
+
+def create_analysis_results(
+    data: bls.Data, index: int, fit_model: "bls.Data.AnalysisResults.FitModel"
+) -> bls.Data.AnalysisResults:
+    """Create an empty analysis results group (without any quantity) at `index` in `data`"""
+    analysis = bls.Data.AnalysisResults._create_new(data, index=index, sparse=data._sparse)
+    sync(data._file.create_attr(analysis._path, "Fit_model", fit_model.value))
+    return analysis
+
+
+def create_quantity_array(
+    analysis: bls.Data.AnalysisResults,
+    quantity: "bls.Data.AnalysisResults.Quantity",
+    peak: "bls.Data.AnalysisResults.PeakType",
+    units: str,
+    shape: tuple,
+    chunks: tuple,
+) -> zarr.Array:
+    """
+    Create the dataset of a fitted quantity in `analysis`, filled with NaN and compressed as
+    brimfile does, and return it as a zarr array that can be written region by region.
+    """
+    group = sync(analysis._file.open_group(analysis._path))
+    array = sync(
+        group.create_array(
+            name=bls.Data.AnalysisResults._get_quantity_name(quantity, peak, 0),
+            shape=shape,
+            dtype="float64",
+            chunks=chunks,
+            fill_value=np.nan,
+            compressors=FileAbstraction.Compression().to_zarr_compressor(),
+        )
+    )
+    analysis._set_units(units, quantity, peak, 0)
+    return zarr.Array(array)
+
+
+def delete_group(group):
+    """Remove a group (e.g. analysis results), and everything in it, from its file"""
+    sync(group._file._root.delitem(group._path))
+
+
+def rename_group(group, name: str):
+    """Set the name under which a group (e.g. analysis results) is listed"""
+    set_object_name(group._file, group._path, name)
@@ -0,0 +1,281 @@
+"""
+Command-line entry point to run treatments without the GUI (`brimview-treat`).
+Like the widgets, it needs the processing dependencies:
+`pip install brimview-widgets[processing]`.
+
+The peaks and the fit model are read from a configuration file (TOML or JSON), e.g.:
+
+    model_fit = "Lorentzian"
+    # Optional, the command-line options take precedence
+    engine = "Process pool"
+    n_workers = 8
+    warm_start = false
+
+    [[peaks]]
+    type_pnt = "Anti-Stokes"
+    position = 5.0
+    fitting_window = 3.0
+    bound_shift = [3.0, 7.0]
+    bound_linewidth = [0.1, 2.0]
+
+    [[peaks]]
+    type_pnt = "Stokes"
+    position = -5.0
+    fitting_window = 3.0
+    bound_shift = [-7.0, -3.0]
+    bound_linewidth = [0.1, 2.0]
+
+Each target is a brim file, optionally followed by `::` and a data group (its index, its group
+name, e.g. `Data_0`, or its display name); without a data group, all the data groups of the file
+are treated. The results are saved as a new analysis results group of each data group,
+named after `--name` if given (see `results_name`).
+
+    brimview-treat peaks.toml sample1.brim.zarr sample2.brim.zarr::Data_1 --name "fit_{data}"
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import sys
+import time
+import tomllib
+
+import brimfile as bls
+
+from .brimfile_compat import group_path
+from .logging import logger
+from .progress_channel import ProgressChannel
+from .result_writer import AnalysisResultsWriter
+from .treatment_checkpoint import DEFAULT_CHECKPOINT_DIR, discard_checkpoint
+from .treatment_engine import (
+    ENGINES,
+    PeakConfig,
+    TreatmentConfig,
+    default_n_workers,
+    treat_data,
+)
+
+# Same defaults as in the GUI (`BrillouinPeakEstimate`)
+_PEAK_DEFAULTS = {
+    "normalizing_window": 2.0,
+    "fitting_window": 3.0,
+    "bound_shift": (-10, 10),
+    "bound_linewidth": (0, 2),
+}
+# Keys of the configuration file that are not part of `TreatmentConfig`
+_RUN_OPTIONS = ["engine", "n_workers"]
+
+
+def load_config(path: str) -> tuple[TreatmentConfig, dict]:
+    """
+    Read a configuration file.
+
+    Returns
+    -------
+    (config, options)
+        The treatment configuration, and the run options (`engine`, `n_workers`) it contains.
+    """
+    with open(path, "rb") as f:
+        content = json.load(f) if path.endswith(".json") else tomllib.load(f)
+
+    options = {key: content.pop(key) for key in _RUN_OPTIONS if key in content}
+    peaks = content.pop("peaks", [])
+    if not peaks:
+        raise ValueError(f"No peaks defined in {path}")
+    config_fields = {f.name for f in dataclasses.fields(TreatmentConfig)}
+    unknown = set(content) - config_fields
+    if unknown:
+        raise ValueError(f"Unknown keys in {path}: {sorted(unknown)}")
+
+    peak_configs = []
+    for peak in peaks:
+        peak = {**_PEAK_DEFAULTS, **peak}
+        peak["bound_shift"] = tuple(peak["bound_shift"])
+        peak["bound_linewidth"] = tuple(peak["bound_linewidth"])
+        peak_configs.append(PeakConfig(**peak))
+    return TreatmentConfig(peaks=peak_configs, **content), options
+
+
+def parse_target(target: str) -> tuple[str, str]:
+    """Split `file::data_group` into its parts (the data group is None if not given)"""
+    path, sep, data_group = target.rpartition("::")
+    return (path, data_group) if sep else (target, None)
+
+
+def data_groups(file: bls.File, data_group: str = None) -> list[bls.Data]:
+    """The data group(s) of `file` designated on the command line"""
+    groups = file.list_data_groups()
+    if data_group is None:
+        return [file.get_data(g["index"]) for g in groups]
+    if data_group.isdigit():
+        return [file.get_data(int(data_group))]
+    for g in groups:
+        if g["name"] == data_group:
+            return [file.get_data(g["index"])]
+    for g in groups:
+        data = file.get_data(g["index"])
+        if data.get_name() == data_group:
+            return [data]
+    raise ValueError(f"No data group '{data_group}' in {file.filename}")
+
+
+def results_name(template: str, data_name: str) -> str:
+    """
+    Name of the analysis results of the data group `data_name` (e.g. `Data_0`) from `--name`:
+    either a template where `{data}` stands for the data group (e.g. `fit_{data}`), or a prefix
+    the data group is appended to, so that the results of each data group have their own name.
+    None (no `--name`) gives None, for the default name of `AnalysisResultsWriter`.
+    """
+    if template is None:
+        return None
+    if "{data}" in template:
+        return template.replace("{data}", data_name)
+    return f"{template}_{data_name}"
+
+
+async def _report_progress(channel: ProgressChannel, label: str, interval: float):
+    """Log the progress of a treatment every `interval` seconds, until it is done"""
+    while True:
+        await asyncio.sleep(interval)
+        snapshot = channel.snapshot()
+        if snapshot.finished:
+            return
+        if snapshot.done == 0:
+            # Still setting up
+            continue
+        eta = f"{snapshot.eta:.0f} s" if snapshot.eta == snapshot.eta else "--"
+        logger.info(
+            f"{label}: {snapshot.done}/{snapshot.total} spectra, "
+            f"{snapshot.rate:.1f} spectra/s, ETA {eta}"
+        )
+
+
+async def treat_target(
+    data: bls.Data, config: TreatmentConfig, args: argparse.Namespace, label: str, name: str = None
+) -> str:
+    """Treat one data group and save the results as `name` (or a generated name), returns that name"""
+    checkpoint_dir = None if args.no_checkpoint else args.checkpoint_dir
+    progress = ProgressChannel(total=0)
+    reporter = asyncio.ensure_future(_report_progress(progress, label, args.progress_interval))
+    # The results are written chunk by chunk while the treatment runs
+    writer = None if args.dry_run else AnalysisResultsWriter(data, config.model_fit, name=name)
+    t0 = time.time()
+    try:
+        state, result = await treat_data(
+            data,
+            config,
+            engine=args.engine,
+            n_workers=args.workers,
+            max_spectra=args.max_spectra,
+            checkpoint_dir=checkpoint_dir,
+            progress=progress,
+            writer=writer,
+        )
+    except BaseException:
+        if writer is not None:
+            writer.discard()
+        raise
+    finally:
+        progress.close()
+        reporter.cancel()
+    elapsed = time.time() - t0
+    logger.info(
+        f"{label}: {progress.done}/{result.n_spectra} spectra fitted in {elapsed:.1f} s "
+        f"({result.n_fit_errors} fit errors)"
+    )
+    if args.dry_run:
+        return None
+    name = writer.finish()
+    if checkpoint_dir is not None:
+        discard_checkpoint(checkpoint_dir, data, state)
+    return name
+
+
+async def run(args: argparse.Namespace) -> int:
+    config, options = load_config(args.config)
+    args.engine = args.engine or options.get("engine", "Process pool")
+    args.workers = args.workers or options.get("n_workers") or default_n_workers()
+    if args.engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{args.engine}', expected one of {ENGINES}")
+
+    n_failed = 0
+    for target in args.targets:
+        path, data_group = parse_target(target)
+        if "://" not in path and not os.path.exists(path):
+            logger.error(f"{path} does not exist")
+            n_failed += 1
+            continue
+        try:
+            file = bls.File(path, mode="r" if args.dry_run else "a")
+        except Exception as e:
+            logger.error(f"Could not open {path}: {e}")
+            n_failed += 1
+            continue
+        try:
+            for data in data_groups(file, data_group):
+                data_name = group_path(data).rsplit("/", 1)[-1]
+                label = f"{path}::{data_name}"
+                try:
+                    name = await treat_target(
+                        data, config, args, label, results_name(args.name, data_name)
+                    )
+                    if name is not None:
+                        logger.info(f"{label}: results saved as {name}")
+                except Exception as e:
+                    logger.error(f"{label}: treatment failed: {e}")
+                    n_failed += 1
+        except Exception as e:
+            logger.error(f"{path}: {e}")
+            n_failed += 1
+        finally:
+            file.close()
+    return 1 if n_failed else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="brimview-treat",
+        description="Fit the Brillouin peaks of brim files and save the results as analysis groups.",
+    )
+    parser.add_argument("config", help="peak and model configuration (TOML or JSON)")
+    parser.add_argument(
+        "targets", nargs="+", metavar="FILE[::DATA]", help="brim file, optionally with a data group"
+    )
+    parser.add_argument("--engine", choices=ENGINES, help="fitting engine (default: Process pool)")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: all CPUs)")
+    parser.add_argument("--max-spectra", type=int, help="only fit the first spectra (for testing)")
+    parser.add_argument(
+        "--name",
+        help="name of the analysis results groups, '{data}' standing for the data group "
+        "(e.g. 'fit_{data}'); without '{data}', the data group is appended (default: generated)",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=DEFAULT_CHECKPOINT_DIR,
+        help="where to checkpoint the running treatments, to resume them if interrupted",
+    )
+    parser.add_argument("--no-checkpoint", action="store_true", help="don't checkpoint the treatments")
+    parser.add_argument("--dry-run", action="store_true", help="fit, but don't write the results")
+    parser.add_argument(
+        "--progress-interval", type=float, default=30.0, help="seconds between progress messages"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="show debug messages")
+    return parser
+
+
+def main(argv: list[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
+    if not args.verbose:
+        logger.setLevel(logging.INFO)
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
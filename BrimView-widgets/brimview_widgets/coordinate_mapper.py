@@ -0,0 +1,152 @@
+"""
+Conversion between the displayed 2D frame and the (z, y, x) indices of the data.
+
+The data visualizer shows one slice of a (z, y, x) volume: any of the three axes can be
+mapped to the horizontal, vertical and slice direction. All the conversions here work on
+whole NumPy arrays of coordinates, so a mask or a batch of clicks is converted at once.
+"""
+
+import numpy as np
+
+ZYX_AXES = ("z", "y", "x")
+
+
+class CoordinateMapper:
+    """
+    Maps the displayed frame (horizontal, vertical, slice) to data indices (z, y, x).
+
+    Parameters
+    ----------
+    horizontal_axis, vertical_axis, slice_axis : str
+        Which data axis ("x", "y" or "z") is displayed in each direction.
+    slice_index : int
+        Index of the displayed slice along `slice_axis`.
+    pixel_size : tuple of 3 floats
+        (z, y, x) size of a pixel, in the units of the displayed coordinates.
+        Only needed to convert physical coordinates (e.g. clicks) into indices.
+    """
+
+    def __init__(
+        self,
+        horizontal_axis: str = "x",
+        vertical_axis: str = "y",
+        slice_axis: str = "z",
+        slice_index: int = 0,
+        pixel_size: tuple[float, float, float] = (1.0, 1.0, 1.0),
+    ):
+        if sorted((horizontal_axis, vertical_axis, slice_axis)) != sorted(ZYX_AXES):
+            raise ValueError(
+                f"Invalid axis mapping ({horizontal_axis}, {vertical_axis}, {slice_axis}): "
+                "each of x, y and z must be used exactly once"
+            )
+        self.horizontal_axis = horizontal_axis
+        self.vertical_axis = vertical_axis
+        self.slice_axis = slice_axis
+        self.slice_index = int(slice_index)
+        self.pixel_size = tuple(float(p) for p in pixel_size)
+
+        self._horizontal = ZYX_AXES.index(horizontal_axis)
+        self._vertical = ZYX_AXES.index(vertical_axis)
+        self._slice = ZYX_AXES.index(slice_axis)
+
+    def to_data_indices(self, horizontal, vertical, slice_index=None) -> np.ndarray:
+        """
+        Convert displayed pixel indices into data indices.
+
+        `slice_index` defaults to the displayed slice, and can also be an array
+        (broadcast against `horizontal` and `vertical`).
+
+        Returns
+        -------
+        points : (..., 3) int array
+            (z, y, x) indices.
+        """
+        if slice_index is None:
+            slice_index = self.slice_index
+        horizontal, vertical, slice_index = np.broadcast_arrays(
+            np.asarray(horizontal, dtype=np.intp),
+            np.asarray(vertical, dtype=np.intp),
+            np.asarray(slice_index, dtype=np.intp),
+        )
+        points = np.empty(horizontal.shape + (3,), dtype=np.intp)
+        points[..., self._horizontal] = horizontal
+        points[..., self._vertical] = vertical
+        points[..., self._slice] = slice_index
+        return points
+
+    def physical_to_data_indices(self, horizontal, vertical) -> np.ndarray:
+        """
+        Same as `to_data_indices`, for coordinates in physical units
+        (i.e. the coordinates reported by a click on the plot).
+        """
+        horizontal = np.rint(
+            np.asarray(horizontal, dtype=float) / self.pixel_size[self._horizontal]
+        )
+        vertical = np.rint(
+            np.asarray(vertical, dtype=float) / self.pixel_size[self._vertical]
+        )
+        return self.to_data_indices(horizontal, vertical)
+
+    def to_physical(self, points) -> np.ndarray:
+        """Convert (..., 3) data indices into (z, y, x) physical coordinates."""
+        return np.asarray(points) * np.asarray(self.pixel_size)
+
+    def mask_to_data_indices(self, mask, slices=None) -> np.ndarray:
+        """
+        Convert a displayed 2D mask into the data indices of its selected pixels.
+
+        Parameters
+        ----------
+        mask : (vertical, horizontal) bool array or xr.DataArray
+        slices : sequence of int, optional
+            Extrude the mask through these slices (along the slice axis).
+            Defaults to the displayed slice only.
+
+        Returns
+        -------
+        points : (N, 3) int array
+            (z, y, x) indices of the selected pixels, slice by slice.
+        """
+        vertical, horizontal = np.nonzero(np.asarray(mask))
+        if slices is None:
+            return self.to_data_indices(horizontal, vertical)
+        slices = np.asarray(slices, dtype=np.intp)
+        return self.to_data_indices(
+            np.tile(horizontal, len(slices)),
+            np.tile(vertical, len(slices)),
+            np.repeat(slices, len(horizontal)),
+        )
+
+    def masks_to_data_indices(self, masks: dict) -> np.ndarray:
+        """
+        Convert one 2D mask per slice, masks[slice_index] = mask, into the
+        (N, 3) data indices of all their selected pixels.
+        """
+        points = [
+            self.mask_to_data_indices(mask, [slice_index])
+            for slice_index, mask in sorted(masks.items())
+        ]
+        if len(points) == 0:
+            return np.empty((0, 3), dtype=np.intp)
+        return np.concatenate(points)
+
+    def to_display_indices(self, points) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Convert (N, 3) data indices into displayed (horizontal, vertical, slice) indices.
+        """
+        points = np.asarray(points, dtype=np.intp).reshape(-1, 3)
+        return (
+            points[:, self._horizontal],
+            points[:, self._vertical],
+            points[:, self._slice],
+        )
+
+
+def as_zyx_points(points) -> np.ndarray:
+    """
+    Normalise a single (z, y, x) point or a collection of points into an (N, 3) int array.
+    """
+    points = np.asarray(points)
+    if points.size == 0:
+        return np.empty((0, 3), dtype=np.intp)
+    return np.rint(points).astype(np.intp).reshape(-1, 3)
@@ -0,0 +1,330 @@
+"""
+Process-wide queue of treatment jobs.
+
+All the sessions of a `panel serve` deployment live in the same server process. If each of them
+started its treatment as soon as asked, concurrent treatments would oversubscribe the CPU and
+starve every session. `TreatmentScheduler` runs at most `max_jobs` treatments at a time, in the
+order they were submitted; the others wait in a FIFO queue, where they can see their position,
+and any job can be cancelled, whether it is still queued or already running.
+
+The fits of all the jobs run in a pool of worker processes owned by the scheduler, so the server
+process only reads the files and serves the sessions; each running job gets an equal share of
+the workers (see `TreatmentScheduler.worker_share`). When a job is cancelled, its blocks that are
+still waiting for a worker are dropped, and its slot is only given to the next job once its
+blocks already being fitted are done, so the workers are never oversubscribed.
+
+The limits are read from the environment when the scheduler is first used:
+`BRIMVIEW_MAX_TREATMENT_JOBS` (concurrent jobs, 1 by default) and `BRIMVIEW_TREATMENT_WORKERS`
+(worker processes, all the CPUs by default).
+"""
+
+import asyncio
+import contextlib
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from .logging import logger
+
+MAX_JOBS = int(os.environ.get("BRIMVIEW_MAX_TREATMENT_JOBS", 1))
+# 0 means one worker per CPU
+JOB_WORKERS = int(os.environ.get("BRIMVIEW_TREATMENT_WORKERS", 0))
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    """The job was cancelled (see `TreatmentJob.cancel`)"""
+
+
+@dataclass(eq=False)
+class TreatmentJob:
+    """A treatment submitted to the `TreatmentScheduler`"""
+
+    label: str
+    id: int
+    submitted: float = field(default_factory=time.time)
+    state: str = QUEUED
+    started: float = None
+    _scheduler: "TreatmentScheduler" = field(default=None, repr=False)
+    _loop: asyncio.AbstractEventLoop = field(default=None, repr=False)
+    # Resolved when the job may start (True), or is cancelled while queued (False)
+    _granted: asyncio.Future = field(default=None, repr=False)
+    _task: asyncio.Task = field(default=None, repr=False)
+    _executor: "_JobExecutor" = field(default=None, repr=False)
+    _cancel_requested: bool = field(default=False, repr=False)
+    # Set to ask a running job to stop cooperatively, see `stop`
+    stop_event: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def position(self) -> int:
+        """1-based position in the queue, 0 if the job is not queued"""
+        return self._scheduler.position(self)
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_requested
+
+    @property
+    def executor(self) -> Executor:
+        """The worker pool of the scheduler, to fit the blocks of this job in while it runs"""
+        return self._executor
+
+    def cancel(self):
+        """
+        Cancel the job. A queued job leaves the queue; a running job is interrupted
+        and its `TreatmentScheduler.run` block raises `JobCancelled`.
+        Can be called from any thread.
+        """
+        self._scheduler.cancel(self)
+
+    def stop(self):
+        """
+        Ask the job to stop at its next checkpoint (e.g. between chunks, see the `stop`
+        argument of `treat_data`), so that what it has already done can be kept.
+        A job that is still queued is cancelled. Can be called from any thread.
+        """
+        if not self.stop_event.is_set():
+            self.stop_event.set()
+            logger.info(f"Treatment job {self.id} ({self.label}) asked to stop")
+        self._scheduler.cancel(self, queued_only=True)
+
+
+class TreatmentScheduler:
+    """
+    FIFO queue of treatment jobs, with at most `max_jobs` of them running at a time.
+
+    Usage, from a coroutine:
+
+        job = scheduler.submit("my file")  # queued, `job.position` is its place in the queue
+        async with scheduler.run(job):     # waits for its turn
+            await treat_data(..., executor=job.executor, n_workers=scheduler.worker_share(n))
+
+    The bookkeeping is protected by a lock and the jobs are woken up on their own event loop,
+    so jobs can be submitted from any thread.
+    """
+
+    def __init__(self, max_jobs: int = MAX_JOBS, n_workers: int = JOB_WORKERS or None):
+        if max_jobs < 1:
+            raise ValueError("At least one job must be allowed to run")
+        self.max_jobs = max_jobs
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._queue: list[TreatmentJob] = []
+        self._running: list[TreatmentJob] = []
+        self._ids = itertools.count(1)
+        self._executor: ProcessPoolExecutor = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """Worker processes shared by all the jobs, created on first use"""
+        with self._lock:
+            if self._executor is None:
+                # "spawn" rather than "fork": forking the multi-threaded Bokeh server is not safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.n_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def worker_share(self, n_workers: int = None) -> int:
+        """Number of workers a job may keep busy: `n_workers`, within its share of the pool"""
+        share = max(1, self.n_workers // self.max_jobs)
+        return share if n_workers is None else max(1, min(n_workers, share))
+
+    def submit(self, label: str) -> TreatmentJob:
+        """Add a job at the end of the queue; must be called from the event loop that will run it"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            job = TreatmentJob(label=label, id=next(self._ids), _scheduler=self, _loop=loop)
+            job._granted = loop.create_future()
+            self._queue.append(job)
+            self._dispatch()
+        logger.info(f"Treatment job {job.id} ({label}) submitted, position {job.position}")
+        return job
+
+    @property
+    def queued(self) -> list[TreatmentJob]:
+        with self._lock:
+            return list(self._queue)
+
+    @property
+    def running(self) -> list[TreatmentJob]:
+        with self._lock:
+            return list(self._running)
+
+    def position(self, job: TreatmentJob) -> int:
+        with self._lock:
+            return self._queue.index(job) + 1 if job in self._queue else 0
+
+    def cancel(self, job: TreatmentJob, queued_only: bool = False):
+        with self._lock:
+            if job.state not in (QUEUED, RUNNING) or job._cancel_requested:
+                return
+            if queued_only and job not in self._queue:
+                return
+            job._cancel_requested = True
+            if job in self._queue:
+                self._queue.remove(job)
+                job.state = CANCELLED
+                job._loop.call_soon_threadsafe(_resolve, job._granted, False)
+            elif job._task is not None:
+                job._loop.call_soon_threadsafe(job._task.cancel)
+            executor = job._executor
+        if executor is not None:
+            executor.cancel_pending()
+        logger.info(f"Treatment job {job.id} ({job.label}) cancelled")
+
+    @contextlib.asynccontextmanager
+    async def run(self, job: TreatmentJob):
+        """
+        Wait for the turn of `job`, and hold its slot for the duration of the block.
+
+        Raises
+        ------
+        JobCancelled
+            If the job is cancelled while queued, or while the block runs.
+        """
+        try:
+            if not await job._granted:
+                raise JobCancelled(f"Job {job.id} was cancelled while queued")
+        except asyncio.CancelledError:
+            # The waiting task itself was cancelled (e.g. the session was closed)
+            self._finish(job, CANCELLED)
+            raise
+
+        task = asyncio.current_task()
+        executor = _JobExecutor(self.executor)
+        with self._lock:
+            job._task = task
+            job._executor = executor
+            cancelled = job._cancel_requested
+        logger.info(f"Treatment job {job.id} ({job.label}) started")
+        try:
+            if cancelled:
+                raise JobCancelled(f"Job {job.id} was cancelled")
+            yield job
+        except asyncio.CancelledError:
+            if not job.cancel_requested:
+                await self._release(job, CANCELLED)
+                raise
+            # The cancellation came from `cancel`, not from outside the job
+            task.uncancel()
+            await self._release(job, CANCELLED)
+            raise JobCancelled(f"Job {job.id} was cancelled") from None
+        except JobCancelled:
+            await self._release(job, CANCELLED)
+            raise
+        except BaseException:
+            await self._release(job, FAILED)
+            raise
+        else:
+            await self._release(job, FINISHED)
+
+    async def _release(self, job: TreatmentJob, state: str):
+        """
+        Free the slot of a job that started. Its blocks still waiting for a worker are cancelled,
+        and the slot is only freed once the blocks already being fitted are done.
+        """
+        in_flight = job._executor.cancel_pending()
+        try:
+            if in_flight:
+                logger.info(
+                    f"Treatment job {job.id} ({job.label}): waiting for {len(in_flight)} "
+                    "blocks being fitted"
+                )
+                await asyncio.wait([asyncio.wrap_future(future) for future in in_flight])
+        finally:
+            self._finish(job, state)
+
+    def _finish(self, job: TreatmentJob, state: str):
+        with self._lock:
+            if job in self._queue:
+                self._queue.remove(job)
+            if job in self._running:
+                self._running.remove(job)
+            job.state = state
+            job._task = None
+            job._executor = None
+            self._dispatch()
+        if job.started is not None:
+            logger.info(
+                f"Treatment job {job.id} ({job.label}) {state} after {time.time() - job.started:.1f} s"
+            )
+
+    def _dispatch(self):
+        """Start the next queued jobs, if there are free slots; the lock must be held"""
+        while self._queue and len(self._running) < self.max_jobs:
+            job = self._queue.pop(0)
+            job.state = RUNNING
+            job.started = time.time()
+            self._running.append(job)
+            job._loop.call_soon_threadsafe(_resolve, job._granted, True)
+
+    def shutdown(self):
+        """Cancel all the jobs and stop the worker processes"""
+        for job in self.queued + self.running:
+            job.cancel()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+class _JobExecutor(Executor):
+    """
+    The worker pool of the scheduler as seen by one job: it keeps track of the blocks
+    the job submitted, so that they can be cancelled or waited for with the job
+    """
+
+    def __init__(self, pool: Executor):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._futures: set[Future] = set()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = self._pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def cancel_pending(self) -> list[Future]:
+        """Cancel the blocks still waiting for a worker, and return those being fitted"""
+        with self._lock:
+            futures = list(self._futures)
+        return [future for future in futures if not future.cancel() and not future.done()]
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        # The pool is shared with the other jobs, only the blocks of this job are concerned
+        if cancel_futures:
+            self.cancel_pending()
+
+
+def _resolve(future: asyncio.Future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+_scheduler: TreatmentScheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> TreatmentScheduler:
+    """The scheduler shared by all the sessions of this process"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TreatmentScheduler()
+        return _scheduler
@@ -0,0 +1,128 @@
+"""
+Thread-safe progress reporting for long jobs.
+
+The workers only increment counters (`ProgressChannel.advance`), which is cheap and safe
+from any thread. The GUI never gets called from the workers: it polls `snapshot()` from
+the event loop at its own pace (see `ProgressWidget.follow`).
+"""
+
+import collections
+import threading
+import time
+from dataclasses import dataclass, field
+
+# Time window (s) over which the current rate is computed
+RATE_WINDOW = 10.0
+
+
+@dataclass
+class WorkerStats:
+    """Spectra fitted by one worker (process or thread), and the time it spent fitting them"""
+
+    name: str
+    n_spectra: int = 0
+    n_blocks: int = 0
+    busy: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Spectra per second while busy"""
+        return self.n_spectra / self.busy if self.busy > 0 else float("nan")
+
+
+@dataclass
+class ProgressSnapshot:
+    done: int
+    total: int
+    start_time: float
+    elapsed: float
+    # Spectra per second over the last `RATE_WINDOW` seconds
+    rate: float
+    # Remaining time (s), NaN while the rate is unknown
+    eta: float
+    workers: list[WorkerStats] = field(default_factory=list)
+    finished: bool = False
+
+
+class ProgressChannel:
+    """
+    Counter of processed items, written by the workers and read by the GUI.
+
+    Items that didn't need processing (e.g. restored from a checkpoint) are counted
+    with `skip`, so that they don't inflate the rate.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._skipped = 0
+        self._workers: dict[str, WorkerStats] = {}
+        self._finished = False
+        # (time, processed) at each snapshot within the rate window
+        self._history = collections.deque([(time.monotonic(), 0)])
+
+    def advance(self, n: int = 1):
+        """`n` more items processed; can be called from any thread"""
+        with self._lock:
+            self._processed += n
+
+    def extend(self, n: int):
+        """`n` more items to process, for jobs that only discover their work as they go"""
+        with self._lock:
+            self.total += n
+
+    def skip(self, n: int):
+        """`n` more items done without being processed"""
+        with self._lock:
+            self._skipped += n
+
+    def record_block(self, worker: str, n_spectra: int, busy: float):
+        """Statistics of a block of `n_spectra` processed by `worker` in `busy` seconds"""
+        with self._lock:
+            stats = self._workers.setdefault(worker, WorkerStats(worker))
+            stats.n_spectra += n_spectra
+            stats.n_blocks += 1
+            stats.busy += busy
+
+    def close(self):
+        with self._lock:
+            self._finished = True
+
+    @property
+    def done(self) -> int:
+        with self._lock:
+            return self._processed + self._skipped
+
+    def snapshot(self) -> ProgressSnapshot:
+        """Current progress; meant to be polled by a single reader (e.g. the GUI)"""
+        now = time.monotonic()
+        with self._lock:
+            processed, skipped, total = self._processed, self._skipped, self.total
+            workers = [WorkerStats(**vars(w)) for w in self._workers.values()]
+            finished = self._finished
+
+        history = self._history
+        if processed == 0:
+            # The rate is measured from the first processed item, not from the set-up
+            history.clear()
+        history.append((now, processed))
+        while len(history) > 2 and now - history[1][0] >= RATE_WINDOW:
+            history.popleft()
+        t0, processed0 = history[0]
+        rate = (processed - processed0) / (now - t0) if now > t0 else float("nan")
+
+        done = processed + skipped
+        remaining = max(total - done, 0)
+        eta = remaining / rate if rate > 0 else (0.0 if remaining == 0 else float("nan"))
+        return ProgressSnapshot(
+            done=done,
+            total=total,
+            start_time=self.start_time,
+            elapsed=time.time() - self.start_time,
+            rate=rate,
+            eta=eta,
+            workers=sorted(workers, key=lambda w: w.name),
+            finished=finished,
+        )
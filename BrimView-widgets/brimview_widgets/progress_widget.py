@@ -1,7 +1,11 @@
 import panel as pn
+import asyncio
+import math
 import time
 import datetime
 
+from .progress_channel import ProgressChannel, ProgressSnapshot
+
 pn.extension()
 
 class ProgressWidget(pn.Column):
@@ -13,6 +17,7 @@ class ProgressWidget(pn.Column):
         )
         self.status_text = pn.pane.Str("0 / 0")
         self.time_info = pn.pane.Str("Start: -- | Elapsed: -- | ETA: --")
+        self.worker_info = pn.pane.Str("", visible=False)
 
         self._start_time = None
         self._last_update_time = 0
@@ -24,6 +29,7 @@ class ProgressWidget(pn.Column):
             self.label,
             pn.Row(self.progress, self.status_text),
             self.time_info,
+            self.worker_info,
             **kwargs
         )
 
@@ -40,6 +46,7 @@ class ProgressWidget(pn.Column):
         self.progress.value = 0
         self.label.object = f"### {task}"
         self.status_text.object = f"0 / {total}"
+        self.worker_info.visible = False
         self._update_time_info(current=0)
 
     def update(self, current: int, total: int = None):
@@ -79,8 +86,72 @@ class ProgressWidget(pn.Column):
                 f"ETA: {self._format_duration(eta)}"
             )
 
-    def finish(self, message="Done"):
-        self.progress.value = self.progress.max
-        self.status_text.object = f"{self.progress.max} / {self.progress.max}"
-        self._update_time_info(current=self.progress.max)
+    async def follow(self, channel: ProgressChannel, interval: float = 0.5):
+        """
+        Show the progress written to `channel` by the workers, until it is closed.
+        The channel is polled from the event loop, so the workers never touch the widgets.
+        """
+        while True:
+            snapshot = channel.snapshot()
+            self.show(snapshot)
+            if snapshot.finished:
+                return
+            await asyncio.sleep(interval)
+
+    async def follow_queue(self, job, interval: float = 0.5):
+        """Show the position of `job` (see `job_queue.TreatmentJob`) while it waits in the queue"""
+        while (position := job.position) > 0:
+            self.label.object = f"### Queued: position {position} in the queue"
+            await asyncio.sleep(interval)
+
+    def show(self, snapshot: ProgressSnapshot):
+        self.progress.max = max(snapshot.total, 1)
+        self.progress.value = min(snapshot.done, self.progress.max)
+        self.status_text.object = f"{snapshot.done} / {snapshot.total}"
+        rate = f"{snapshot.rate:.1f} spectra/s" if math.isfinite(snapshot.rate) else "-- spectra/s"
+        eta = self._format_duration(snapshot.eta) if math.isfinite(snapshot.eta) else "--"
+        self.time_info.object = (
+            f"Start: {time.strftime('%H:%M:%S', time.localtime(snapshot.start_time))} | "
+            f"Elapsed: {self._format_duration(snapshot.elapsed)} | "
+            f"ETA: {eta} | {rate}"
+        )
+        # Per-worker statistics are only informative when fitting in parallel
+        if len(snapshot.workers) > 1:
+            self.worker_info.object = "\n".join(
+                f"{w.name}: {w.n_spectra} spectra in {w.n_blocks} blocks, "
+                f"{w.rate:.1f} spectra/s, busy {100 * w.busy / max(snapshot.elapsed, 1e-9):.0f}%"
+                for w in snapshot.workers
+            )
+            self.worker_info.visible = True
+
+    def finish(self, message="Done", completed: int = None):
+        """
+        Mark the task as over. By default it is shown as complete; if it ended early
+        (stopped, cancelled...), `completed` is the number of steps actually done.
+        """
+        if completed is None:
+            self.progress.value = self.progress.max
+            self.status_text.object = f"{self.progress.max} / {self.progress.max}"
+            self._update_time_info(current=self.progress.max)
+        else:
+            self.progress.value = min(completed, self.progress.max)
+            self.status_text.object = f"{completed} / {self.progress.max}"
         self.label.object += f" -- {message}"
+
+
+async def follow_tqdm(
+    tqdm: pn.widgets.Tqdm, channel: ProgressChannel, desc: str = "", interval: float = 0.2
+):
+    """
+    Show the progress written to `channel` in a Tqdm widget, until the channel is closed.
+    As in `ProgressWidget.follow`, the channel is polled from the event loop,
+    so the workers never touch the widget.
+    """
+    while True:
+        snapshot = channel.snapshot()
+        total = max(snapshot.total, 1)
+        tqdm.param.update(max=total, value=min(snapshot.done, total))
+        tqdm.text = f"{desc}: {snapshot.done}/{snapshot.total} [{snapshot.elapsed:.1f} s]"
+        if snapshot.finished:
+            return
+        await asyncio.sleep(interval)
@@ -0,0 +1,710 @@
+"""
+Bulk, chunk-aware access to the spectra stored in a brimfile data group.
+
+brimfile only exposes the whole PSD cube (`Data.get_PSD_as_spatial_map`) or one
+spectrum at a time (`Data.get_spectrum_in_image`). Reading a region of interest
+pixel by pixel pays the full per-call overhead for every spectrum, while loading
+the whole cube does not scale to large volumes.
+
+The functions here open the underlying datasets lazily and only read the
+storage chunks that contain the requested pixels, each chunk exactly once.
+"""
+
+import itertools
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+import brimfile as bls
+
+from .brimfile_compat import (
+    sync,
+    async_getitem,
+    gather_sync,
+    spatial_map,
+    open_data_dataset,
+    dataset_units,
+    open_quantity_dataset,
+    water_references,
+)
+from .logging import logger
+
+# Number of chunk reads issued concurrently (this matters mostly for remote stores)
+_CONCURRENT_READS = 16
+
+# Quantities that brimfile computes from the stored ones instead of reading them:
+# computed quantity -> the stored quantity it is computed from
+_COMPUTED_QUANTITIES = {
+    bls.Data.AnalysisResults.Quantity.Elastic_contrast: bls.Data.AnalysisResults.Quantity.Shift,
+    bls.Data.AnalysisResults.Quantity.Viscous_contrast: bls.Data.AnalysisResults.Quantity.Width,
+}
+
+
+def open_psd_datasets(data: bls.Data) -> tuple:
+    """
+    Open (without reading) the PSD and frequency datasets of a data group.
+
+    Returns
+    -------
+    (PSD, frequency, PSD_units, frequency_units)
+        PSD and frequency are the lazy dataset objects of the file,
+        which support `.shape` and slicing.
+    """
+    PSD, frequency = gather_sync(
+        open_data_dataset(data, "PSD"), open_data_dataset(data, "frequency")
+    )
+    PSD_units, frequency_units = gather_sync(
+        dataset_units(data, PSD), dataset_units(data, frequency)
+    )
+    return PSD, frequency, PSD_units, frequency_units
+
+
+@dataclass(frozen=True)
+class PSDDescriptor:
+    """
+    Layout of the PSD of a data group, read from the array metadata only.
+
+    Attributes
+    ----------
+    shape, dtype, chunks :
+        Of the PSD dataset, whose last dimension is the frequency.
+    spatial_shape : tuple
+        `shape` without the frequency dimension: (z, y, x) for regular data,
+        (n_spectra,) for sparse data.
+    image_shape : tuple
+        (z, y, x) shape of the image the spectra are displayed in.
+    frequency_shape : tuple
+        Shape of the frequency dataset: (n_freq,) when the axis is shared by all the spectra.
+    """
+
+    shape: tuple
+    dtype: np.dtype
+    chunks: tuple
+    spatial_shape: tuple
+    image_shape: tuple
+    frequency_shape: tuple
+    sparse: bool
+    PSD_units: str
+    frequency_units: str
+
+    @property
+    def n_spectra(self) -> int:
+        return int(np.prod(self.spatial_shape))
+
+    @property
+    def n_freq(self) -> int:
+        return self.shape[-1]
+
+    @property
+    def shared_frequency(self) -> bool:
+        return len(self.frequency_shape) == 1
+
+    @property
+    def chunk_nbytes(self) -> int:
+        return int(np.prod(self.chunks)) * np.dtype(self.dtype).itemsize
+
+
+_descriptors = weakref.WeakKeyDictionary()
+
+
+def describe_psd(data: bls.Data) -> PSDDescriptor:
+    """
+    The `PSDDescriptor` of a data group. No spectra are read, and the result is cached
+    for as long as the data group object is alive.
+    """
+    descriptor = _descriptors.get(data)
+    if descriptor is None:
+        PSD, frequency, PSD_units, frequency_units = open_psd_datasets(data)
+        spatial_shape = tuple(PSD.shape[:-1])
+        sparse_map = spatial_map(data)
+        image_shape = sparse_map.shape if sparse_map is not None else spatial_shape[:3]
+        descriptor = PSDDescriptor(
+            shape=tuple(PSD.shape),
+            dtype=np.dtype(PSD.dtype),
+            chunks=dataset_chunks(PSD),
+            spatial_shape=spatial_shape,
+            image_shape=image_shape,
+            frequency_shape=tuple(frequency.shape),
+            sparse=sparse_map is not None,
+            PSD_units=PSD_units,
+            frequency_units=frequency_units,
+        )
+        logger.debug(f"PSD layout: {descriptor}")
+        _descriptors[data] = descriptor
+    return descriptor
+
+
+def dataset_chunks(ds) -> tuple:
+    """
+    Chunk shape of a lazy dataset.
+    Falls back to the full shape if the backend doesn't report any chunking.
+    """
+    chunks = getattr(ds, "chunks", None)
+    if chunks is None or len(chunks) != len(ds.shape):
+        return tuple(ds.shape)
+    return tuple(chunks)
+
+
+def chunk_slabs(shape: tuple, chunks: tuple) -> list[tuple[slice, ...]]:
+    """The regions of each storage chunk of an array, in C order."""
+    starts = itertools.product(*[range(0, s, c) for s, c in zip(shape, chunks)])
+    return [
+        tuple(slice(i, min(i + c, s)) for i, c, s in zip(start, chunks, shape))
+        for start in starts
+    ]
+
+
+def zyx_to_dataset_index(data: bls.Data, z, y, x) -> tuple[np.ndarray, ...]:
+    """
+    Convert (z, y, x) image coordinates into indices of the PSD dataset.
+
+    For non-sparse data this is simply (z, y, x). For sparse data, the spatial map
+    is used to get the spectrum index; pixels without a spectrum get -1.
+    """
+    z = np.asarray(z, dtype=np.intp)
+    y = np.asarray(y, dtype=np.intp)
+    x = np.asarray(x, dtype=np.intp)
+    sparse_map = spatial_map(data)
+    if sparse_map is not None:
+        return (sparse_map[z, y, x],)
+    return (z, y, x)
+
+
+class ChunkedPointReader:
+    """
+    Reads the values of a dataset at many points, one storage chunk at a time.
+
+    The points are grouped by the chunk they belong to and, within a chunk,
+    the bounding box of the selected points is read once. Iterating over the reader
+    yields `(positions, values)` for a batch of chunks, where `positions` are the
+    indices of the returned points in the original index arrays.
+    Memory use is bounded by the batch size, not by the number of points.
+
+    Parameters
+    ----------
+    ds : lazy dataset
+        Dataset to read from.
+    index : tuple of (N,) int arrays
+        Indices along the leading dimensions of `ds`. Negative indices mark
+        invalid points, which are never read.
+    batch_size : int
+        Number of chunks read concurrently in each batch.
+    """
+
+    def __init__(self, ds, index: tuple[np.ndarray, ...], batch_size: int = _CONCURRENT_READS):
+        self.ds = ds
+        self.n_points = len(index[0])
+        self.trailing_shape = tuple(ds.shape[len(index) :])
+        self.batch_size = batch_size
+
+        valid = np.all([i >= 0 for i in index], axis=0)
+        self._valid_points = np.flatnonzero(valid)
+        self._index = tuple(i[valid] for i in index)
+        self._groups, self._slabs = self._plan_reads()
+
+    def _plan_reads(self):
+        if len(self._valid_points) == 0:
+            return [], []
+        chunks = dataset_chunks(self.ds)[: len(self._index)]
+        chunk_id = np.stack([i // c for i, c in zip(self._index, chunks)], axis=-1)
+        _, chunk_of_point = np.unique(chunk_id, axis=0, return_inverse=True)
+        chunk_of_point = chunk_of_point.ravel()
+        order = np.argsort(chunk_of_point, kind="stable")
+        boundaries = np.flatnonzero(np.diff(chunk_of_point[order])) + 1
+        groups = np.split(order, boundaries)
+
+        # Within a chunk we read the bounding box of the selected points
+        slabs = []
+        for group in groups:
+            lower = [int(i[group].min()) for i in self._index]
+            upper = [int(i[group].max()) + 1 for i in self._index]
+            slabs.append(tuple(slice(lo, up) for lo, up in zip(lower, upper)))
+        return groups, slabs
+
+    def __len__(self):
+        """Number of read batches"""
+        return -(-len(self._groups) // self.batch_size)
+
+    def __iter__(self):
+        for start in range(0, len(self._groups), self.batch_size):
+            batch = range(start, min(start + self.batch_size, len(self._groups)))
+            blocks = gather_sync(
+                *[async_getitem(self.ds, self._slabs[b]) for b in batch]
+            )
+            positions = []
+            values = []
+            for b, block in zip(batch, blocks):
+                group = self._groups[b]
+                local = tuple(i[group] - s.start for i, s in zip(self._index, self._slabs[b]))
+                positions.append(self._valid_points[group])
+                values.append(np.asarray(block, dtype=np.float64)[local])
+            yield np.concatenate(positions), np.concatenate(values)
+
+    def read_all(self, on_batch: Callable[[], None] = None) -> np.ndarray:
+        """
+        Read all the points at once.
+
+        `on_batch`, if given, is called after each batch of chunks has been read.
+        It can raise to abort the reading (e.g. when the result is not needed anymore).
+
+        Returns
+        -------
+        values : (N, *trailing_shape) array
+            Invalid points are returned as NaN.
+        """
+        out = np.full((self.n_points,) + self.trailing_shape, np.nan, dtype=np.float64)
+        for positions, values in self:
+            out[positions] = values
+            if on_batch is not None:
+                on_batch()
+        return out
+
+
+def read_points(ds, index: tuple[np.ndarray, ...]) -> np.ndarray:
+    """
+    Read the values of a dataset at many points, one read per storage chunk.
+    See `ChunkedPointReader` for the description of the arguments.
+    """
+    return ChunkedPointReader(ds, index).read_all()
+
+
+class SpectraReader:
+    """
+    Iterates over the spectra of many pixels, a batch of storage chunks at a time.
+
+    Each iteration yields `(positions, PSD, frequency)`, with `positions` the indices
+    of the returned spectra in the (z, y, x) arrays, PSD of shape (n, n_freq) and
+    frequency of shape (n_freq,) if shared by all the spectra, (n, n_freq) otherwise.
+    Pixels without a spectrum (sparse data) are skipped.
+    """
+
+    def __init__(self, data: bls.Data, z, y, x):
+        PSD_ds, self._freq_ds, self.PSD_units, self.frequency_units = (
+            open_psd_datasets(data)
+        )
+        index = zyx_to_dataset_index(data, z, y, x)
+        logger.debug(
+            f"Reading {len(index[0])} spectra from PSD {PSD_ds.shape} (chunks {dataset_chunks(PSD_ds)})"
+        )
+        self._reader = ChunkedPointReader(PSD_ds, index)
+        self.n_points = self._reader.n_points
+        self.n_freq = PSD_ds.shape[-1]
+
+        if self._freq_ds.ndim == 1:
+            self.shared_frequency = np.asarray(
+                sync(async_getitem(self._freq_ds, (...,))), dtype=np.float64
+            )
+            self._freq_index = None
+        else:
+            # Frequency has (some of) the spatial dimensions of the PSD;
+            # broadcast the index on the ones it doesn't have
+            self.shared_frequency = None
+            n_spatial = self._freq_ds.ndim - 1
+            self._freq_index = tuple(
+                np.where(i >= 0, i if s > 1 else 0, -1)
+                for i, s in zip(index[-n_spatial:], self._freq_ds.shape[:n_spatial])
+            )
+
+    def __len__(self):
+        return len(self._reader)
+
+    def __iter__(self):
+        for positions, PSD in self._reader:
+            yield positions, PSD, self._frequency_at(positions)
+
+    def _frequency_at(self, positions: np.ndarray) -> np.ndarray:
+        if self.shared_frequency is not None:
+            return self.shared_frequency
+        return read_points(self._freq_ds, tuple(i[positions] for i in self._freq_index))
+
+    def frequency_range(self) -> tuple[float, float]:
+        """
+        Range of the frequency axis over all the spectra.
+        Only reads the frequency dataset (not the PSD) if it is not shared.
+        """
+        if self.shared_frequency is not None:
+            return np.nanmin(self.shared_frequency), np.nanmax(self.shared_frequency)
+        f_min, f_max = np.inf, -np.inf
+        for _, frequency in ChunkedPointReader(self._freq_ds, self._freq_index):
+            f_min = min(f_min, np.nanmin(frequency))
+            f_max = max(f_max, np.nanmax(frequency))
+        return f_min, f_max
+
+    def read_all(self, on_batch: Callable[[], None] = None) -> tuple:
+        """
+        Read all the spectra at once.
+        See `ChunkedPointReader.read_all` for `on_batch`.
+
+        Returns
+        -------
+        (PSD, frequency, PSD_units, frequency_units)
+            PSD has shape (N, n_freq); pixels without a spectrum are filled with NaN.
+            frequency has shape (n_freq,) if it is shared by all the spectra, (N, n_freq) otherwise.
+        """
+        PSD = self._reader.read_all(on_batch)
+        if self.shared_frequency is not None:
+            frequency = self.shared_frequency
+        else:
+            frequency = ChunkedPointReader(self._freq_ds, self._freq_index).read_all(
+                on_batch
+            )
+        return PSD, frequency, self.PSD_units, self.frequency_units
+
+
+class PSDBlockReader:
+    """
+    Iterates over all the spectra of a data group, one storage chunk at a time.
+
+    Each iteration yields `(flat_index, PSD)`: the (n,) indices of the spectra in the
+    flattened spatial dimensions of the PSD dataset (i.e. in the layout expected when
+    writing analysis results), and the (n, n_freq) spectra themselves.
+    Memory use is bounded by the chunk size, not by the dataset size.
+
+    Attributes
+    ----------
+    spatial_shape : tuple
+        Shape of the PSD dataset without the frequency dimension:
+        (z, y, x) for regular data, (n_spectra,) for sparse data.
+    frequency : (n_freq,) array
+        The frequency axis if it is shared by all the spectra,
+        otherwise the one of the first spectrum (see `frequency_of`).
+    """
+
+    def __init__(self, data: bls.Data):
+        self._PSD_ds, self._freq_ds, self.PSD_units, self.frequency_units = (
+            open_psd_datasets(data)
+        )
+        psd = describe_psd(data)
+        self.spatial_shape = psd.spatial_shape
+        self.n_spectra = psd.n_spectra
+        self.n_freq = psd.n_freq
+        self.slabs = chunk_slabs(self.spatial_shape, psd.chunks[:-1])
+
+        self.shared_frequency = psd.shared_frequency
+        freq_selection = (0,) * (self._freq_ds.ndim - 1) + (slice(None),)
+        self.frequency = np.asarray(
+            sync(async_getitem(self._freq_ds, freq_selection)), dtype=np.float64
+        )
+
+    def __len__(self):
+        """Number of chunks"""
+        return len(self.slabs)
+
+    def __iter__(self):
+        for slab in self.slabs:
+            yield self.read_slab(slab)
+
+    def read_slab(self, slab: tuple[slice, ...]) -> tuple[np.ndarray, np.ndarray]:
+        """Read the spectra of one region of the PSD dataset, as `(flat_index, PSD)`"""
+        return self.read_slabs([slab])[0]
+
+    def read_slabs(self, slabs: list) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Same as `read_slab` for several regions, which are read concurrently"""
+        blocks = gather_sync(*[async_getitem(self._PSD_ds, slab) for slab in slabs])
+        return [
+            (
+                self.flat_index_of(slab),
+                np.asarray(PSD, dtype=np.float64).reshape(-1, self.n_freq),
+            )
+            for slab, PSD in zip(slabs, blocks)
+        ]
+
+    def read_spectra(self, flat_index: np.ndarray) -> np.ndarray:
+        """
+        Read the (n, n_freq) spectra at scattered flat indices, one read per chunk
+        (see `ChunkedPointReader`).
+        """
+        index = np.unravel_index(flat_index, self.spatial_shape)
+        return ChunkedPointReader(self._PSD_ds, index).read_all()
+
+    def flat_index_of(self, slab: tuple[slice, ...]) -> np.ndarray:
+        grid = np.meshgrid(*[np.arange(s.start, s.stop) for s in slab], indexing="ij")
+        return np.ravel_multi_index([g.ravel() for g in grid], self.spatial_shape)
+
+    def frequency_of(self, slab: tuple[slice, ...]) -> np.ndarray:
+        """
+        Frequency axis of the spectra of a region: (n_freq,) if it is shared by
+        all the spectra, (n, n_freq) otherwise.
+        """
+        if self.shared_frequency:
+            return self.frequency
+        # The frequency dataset can be broadcast along some spatial dimensions
+        selection = tuple(
+            slice(0, 1) if size == 1 else s
+            for s, size in zip(slab, self._freq_ds.shape[:-1])
+        )
+        frequency = np.asarray(
+            sync(async_getitem(self._freq_ds, selection)), dtype=np.float64
+        )
+        slab_shape = tuple(s.stop - s.start for s in slab)
+        return np.broadcast_to(frequency, slab_shape + (self.n_freq,)).reshape(
+            -1, self.n_freq
+        )
+
+    def sample(
+        self, n_samples: int, max_chunks: int = 8, rng: np.random.Generator = None
+    ):
+        """
+        Randomly sample `n_samples` spectra (or all of them, if there are fewer),
+        from as few random chunks as possible.
+
+        Reading whole chunks costs the same as reading a single spectrum from them,
+        so the samples are drawn from a few chunks instead of from everywhere in the
+        dataset, where almost every sample would fall in a different chunk.
+        The chunks are read `max_chunks` at a time, until they hold enough spectra.
+
+        Yields
+        ------
+        (PSD, frequency)
+            For each sampled chunk, PSD has shape (n, n_freq) and frequency is
+            as returned by `frequency_of`.
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        chunks = rng.permutation(len(self.slabs))
+        n_left = n_samples
+        for start in range(0, len(chunks), max_chunks):
+            if n_left <= 0:
+                break
+            slabs = [self.slabs[i] for i in chunks[start : start + max_chunks]]
+            blocks = self.read_slabs(slabs)
+            for i, (slab, (_, PSD)) in enumerate(zip(slabs, blocks)):
+                if n_left <= 0:
+                    break
+                # Spread what is left evenly over the chunks read together
+                per_chunk = -(-n_left // (len(slabs) - i))
+                picked = rng.choice(len(PSD), size=min(per_chunk, len(PSD)), replace=False)
+                n_left -= len(picked)
+                frequency = self.frequency_of(slab)
+                if frequency.ndim > 1:
+                    frequency = frequency[picked]
+                yield PSD[picked], frequency
+        if n_left > 0:
+            logger.debug(
+                f"Only {n_samples - n_left} spectra to sample, {n_samples} were requested"
+            )
+
+
+def read_spectra(
+    data: bls.Data, z, y, x, on_batch: Callable[[], None] = None
+) -> tuple:
+    """
+    Read the spectra of many pixels at once.
+
+    Parameters
+    ----------
+    data : bls.Data
+        The data group to read from.
+    z, y, x : (N,) int arrays
+        Pixel coordinates in the image.
+    on_batch : callable, optional
+        See `ChunkedPointReader.read_all`.
+
+    Returns
+    -------
+    (PSD, frequency, PSD_units, frequency_units)
+        See `SpectraReader.read_all`.
+    """
+    return SpectraReader(data, z, y, x).read_all(on_batch)
+
+
+class QuantityMaps:
+    """
+    Lazy access to all the quantity maps of an analysis group, to gather the values of every
+    quantity and peak at many pixels.
+
+    Only the metadata of the quantity datasets is read when the object is created. The values
+    are then read at the requested pixels only, one read per storage chunk they touch
+    (see `ChunkedPointReader`): memory use is bounded by the number of requested pixels,
+    not by the size of the volume.
+
+    Attributes
+    ----------
+    labels : list of (quantity_name, peak_name, units)
+        One entry per map, in the order of the values returned by `values_at`.
+        For each quantity, the fitted peaks come first, then their average. The contrasts
+        computed by brimfile (see `_COMPUTED_QUANTITIES`) come last.
+    shape : tuple
+        (z, y, x) shape of the maps.
+    """
+
+    def __init__(self, analysis: bls.Data.AnalysisResults):
+        self.labels = []
+        # Stored dataset of each fitted map: _datasets[(quantity_name, peak_name)] = dataset
+        self._datasets = {}
+        # For each label, the keys of the datasets it is computed from
+        self._sources: list[tuple] = []
+        # Computed quantities: _contrasts[label index] = (index of the stored label, reference)
+        self._contrasts: dict[int, tuple[int, float]] = {}
+        self._spatial_map = spatial_map(analysis)
+        sparse = self._spatial_map is not None
+        self.shape = self._spatial_map.shape if sparse else None
+
+        peak_types = list(analysis.list_existing_peak_types())
+        n_index = 1 if sparse else 3
+        for quantity in analysis.list_existing_quantities() if peak_types else ():
+            if quantity in _COMPUTED_QUANTITIES:
+                continue
+            sources = []
+            for peak in peak_types:
+                try:
+                    ds = sync(open_quantity_dataset(analysis, quantity, peak))
+                    units = analysis.get_units(quantity, peak)
+                except Exception as e:
+                    logger.debug(f"Skipping {quantity.name} ({peak.name}): {e}")
+                    continue
+                if ds.ndim != n_index:
+                    # e.g. one value per parameter: not a map
+                    logger.debug(f"Skipping {quantity.name} ({peak.name}): shape {ds.shape}")
+                    continue
+                if self.shape is None:
+                    self.shape = tuple(ds.shape)
+                key = (quantity.name, peak.name)
+                self._datasets[key] = ds
+                self.labels.append((quantity.name, peak.name, units))
+                self._sources.append((key,))
+                sources.append(key)
+            if sources:
+                # Same as `AnalysisResults.get_image` with `PeakType.average`,
+                # with the units of the first peak
+                units = self.labels[-len(sources)][2]
+                self.labels.append(
+                    (quantity.name, bls.Data.AnalysisResults.PeakType.average.name, units)
+                )
+                self._sources.append(tuple(sources))
+        self._add_contrasts(analysis)
+        logger.debug(f"{len(self.labels)} quantity maps of shape {self.shape}")
+
+    def _add_contrasts(self, analysis: bls.Data.AnalysisResults):
+        """
+        Add the contrasts of every stored map they are computed from. brimfile computes them
+        pixel by pixel as `value / reference - 1`, the reference (water, see `water_references`)
+        having the sign of the value: that is `|value| / reference - 1`.
+        """
+        stored = list(enumerate(self.labels))
+        references = water_references(analysis)
+        for contrast, quantity in _COMPUTED_QUANTITIES.items():
+            reference = references.get(contrast)
+            if reference is None:
+                continue
+            for j, (quantity_name, peak_name, _) in stored:
+                if quantity_name == quantity.name:
+                    self._contrasts[len(self.labels)] = (j, reference)
+                    # Contrasts have no units
+                    self.labels.append((contrast.name, peak_name, None))
+                    self._sources.append(())
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _dataset_index(self, z, y, x) -> tuple[np.ndarray, ...]:
+        """Same as `zyx_to_dataset_index`, with the spatial map read once"""
+        if self._spatial_map is not None:
+            return (self._spatial_map[z, y, x],)
+        return (z, y, x)
+
+    def values_at(self, z, y, x, preloaded: dict = None) -> np.ndarray:
+        """
+        Values of all the maps at the given pixels.
+
+        Parameters
+        ----------
+        z, y, x : (N,) int arrays
+            Pixel coordinates in the image.
+        preloaded : dict, optional
+            preloaded[(quantity_name, peak_name)] = (z, y, x) image, for maps that are already
+            in memory (e.g. the one currently displayed). These are indexed instead of being read.
+
+        Returns
+        -------
+        values : (n_maps, N) array
+            Pixels without a value (e.g. no spectrum in sparse data) are NaN.
+        """
+        preloaded = preloaded or {}
+        z, y, x = (np.asarray(i, dtype=np.intp) for i in (z, y, x))
+        index = self._dataset_index(z, y, x)
+        out = np.empty((len(self.labels), len(z)))
+        read = {}
+
+        def stored(key):
+            if key not in read:
+                read[key] = ChunkedPointReader(self._datasets[key], index).read_all()
+            return read[key]
+
+        for i, ((quantity_name, peak_name, _), sources) in enumerate(
+            zip(self.labels, self._sources)
+        ):
+            image = preloaded.get((quantity_name, peak_name))
+            if image is not None:
+                out[i] = image[z, y, x]
+            elif i in self._contrasts:
+                # Computed below, once the stored map is known
+                continue
+            elif len(sources) == 1:
+                out[i] = stored(sources[0])
+            else:
+                out[i] = np.mean([np.abs(stored(key)) for key in sources], axis=0)
+        for i, (j, reference) in self._contrasts.items():
+            if (self.labels[i][0], self.labels[i][1]) not in preloaded:
+                out[i] = np.abs(out[j]) / reference - 1
+        return out
+
+    def iter_values_at(self, z, y, x, batch_size: int, preloaded: dict = None):
+        """
+        Same as `values_at`, for at most `batch_size` pixels at a time.
+        The pixels are taken in storage order, so that each batch only touches a few chunks.
+
+        Yields
+        ------
+        (positions, values)
+            `positions` are the indices of the pixels of the batch in the (z, y, x) arrays,
+            `values` is a (n_maps, len(positions)) array.
+        """
+        z, y, x = (np.asarray(i, dtype=np.intp) for i in (z, y, x))
+        order = np.arange(len(z))
+        if self._datasets:
+            ds = next(iter(self._datasets.values()))
+            chunks = dataset_chunks(ds)
+            grid = [-(-s // c) for s, c in zip(ds.shape, chunks)]
+            # Pixels without a value (negative index) are never read, their place doesn't matter
+            chunk_id = np.ravel_multi_index(
+                [np.maximum(i, 0) // c for i, c in zip(self._dataset_index(z, y, x), chunks)],
+                grid,
+            )
+            order = np.argsort(chunk_id, kind="stable")
+        for start in range(0, len(order), batch_size):
+            positions = order[start : start + batch_size]
+            yield positions, self.values_at(
+                z[positions], y[positions], x[positions], preloaded
+            )
+
+
+_quantity_maps = weakref.WeakKeyDictionary()
+_quantity_maps_lock = threading.Lock()
+
+
+def quantity_maps(analysis: bls.Data.AnalysisResults) -> QuantityMaps:
+    """
+    The `QuantityMaps` of an analysis group, shared by all the widgets and cached for as long
+    as the analysis group object is alive. Can be called from any thread.
+    """
+    with _quantity_maps_lock:
+        maps = _quantity_maps.get(analysis)
+        if maps is None:
+            maps = QuantityMaps(analysis)
+            _quantity_maps[analysis] = maps
+        return maps
+
+
+def preloaded_map(dataset, quantity, peak) -> dict:
+    """
+    The quantity map already loaded by the data visualizer (its `img_dataset`, `result_quantity`
+    and `result_peak`), which doesn't need to be read again, in the `preloaded` form of
+    `QuantityMaps.values_at`: {(quantity_name, peak_name): (z, y, x) image}, empty if none.
+    """
+    if dataset is None or quantity is None:
+        return {}
+    # The dataset is backed by a single-variable xarray Dataset
+    (displayed,) = dataset.data.data_vars.values()
+    return {(quantity.name, peak.name): displayed.transpose("z", "y", "x").values}
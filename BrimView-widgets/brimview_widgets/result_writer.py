@@ -0,0 +1,147 @@
+"""
+Incremental writing of the results of a treatment to the brim file.
+
+brimfile only writes analysis results as whole arrays (`Data.create_analysis_results_group`),
+so the results of a treatment could only be saved at the end, as full-size arrays.
+Here the analysis results group is created when the treatment starts, with datasets
+that have the spatial shape of the PSD, the same chunking as the PSD, and NaN as fill value.
+Each storage chunk is then written once, as soon as all its spectra are fitted, while
+the workers keep fitting the next ones. The chunks that are never written (spectra that
+were not fitted) are never materialised in the file, and read as NaN.
+"""
+
+import time
+
+import numpy as np
+import zarr
+import brimfile as bls
+
+from .brimfile_compat import (
+    group_path,
+    create_analysis_results,
+    create_quantity_array,
+    delete_group,
+    rename_group,
+)
+from .logging import logger
+from .psd_access import PSDBlockReader
+
+AnalysisResults = bls.Data.AnalysisResults
+
+# Result array -> (quantity, units) stored in the file, as in `create_analysis_results_group`
+_QUANTITIES = {
+    "shift": (AnalysisResults.Quantity.Shift, "GHz"),
+    "linewidth": (AnalysisResults.Quantity.Width, "Hz"),
+    "amplitude": (AnalysisResults.Quantity.Amplitude, "a.u."),
+    "offset": (AnalysisResults.Quantity.Offset, "u.a"),
+}
+
+
+def analysis_fit_model(model_fit: str) -> "bls.Data.AnalysisResults.FitModel":
+    """The brimfile fit model corresponding to a `HDF5_BLS_treat` model"""
+    FitModel = AnalysisResults.FitModel
+    match model_fit:
+        case "Lorentzian":
+            return FitModel.Lorentzian
+        case "DHO":
+            return FitModel.DHO
+        case "Gaussian":
+            return FitModel.Gaussian
+        case _:
+            # Including the "elastic" variants
+            return FitModel.Undefined
+
+
+def peak_types(n_peaks: int) -> list["bls.Data.AnalysisResults.PeakType"]:
+    """
+    Peak type under which each fitted peak is saved: with 2 peaks, the first one is saved
+    as the anti-Stokes peak and the second one as the Stokes peak.
+    """
+    match n_peaks:
+        case 1:
+            return [AnalysisResults.PeakType.AntiStokes]
+        case 2:
+            return [AnalysisResults.PeakType.AntiStokes, AnalysisResults.PeakType.Stokes]
+        case _:
+            raise ValueError(f"{n_peaks} peaks fitted, unsure how to save that")
+
+
+class AnalysisResultsWriter:
+    """
+    Analysis results group of a data group, written chunk by chunk while the treatment runs.
+
+    The group is created by `open` (called by `treat_data` once the number of peaks is known)
+    under a provisional name, and gets its final name in `finish`; `discard` removes it,
+    e.g. if the treatment fails or is cancelled.
+    """
+
+    def __init__(self, data: bls.Data, model_fit: str, name: str = None):
+        self.data = data
+        self.fit_model = analysis_fit_model(model_fit)
+        self.name = name or f"BrimView_{self.fit_model}_{time.strftime('%Y%m%d-%H%M%S')}"
+        self.path: str = None
+        self._analysis: bls.Data.AnalysisResults = None
+        self._reader: PSDBlockReader = None
+        self._arrays: dict[tuple[str, int], zarr.Array] = {}
+        self.shared_offset = False
+        self.n_chunks_written = 0
+
+    def open(self, reader: PSDBlockReader, n_peaks: int, shared_offset: bool = False):
+        """
+        Create the analysis results group, with the datasets of `n_peaks` peaks.
+
+        With `shared_offset`, only the offset of the first peak is fitted (see
+        `TreatState.shared_offset`), and it is saved as the offset of all the peaks.
+        """
+        types = peak_types(n_peaks)
+        self.shared_offset = shared_offset and n_peaks > 1
+        ar_groups = self.data.list_AnalysisResults()
+        index = max((ar["index"] for ar in ar_groups), default=-1) + 1
+        self._analysis = create_analysis_results(self.data, index, self.fit_model)
+        self.path = group_path(self._analysis)
+        self._reader = reader
+        rename_group(self._analysis, f"{self.name} (in progress)")
+
+        chunks = tuple(s.stop - s.start for s in reader.slabs[0])
+        for peak, pt in enumerate(types):
+            for name, (qt, units) in _QUANTITIES.items():
+                self._arrays[name, peak] = create_quantity_array(
+                    self._analysis, qt, pt, units, shape=reader.spatial_shape, chunks=chunks
+                )
+        logger.debug(f"Writing the treatment results to {self.path}")
+
+    def write_chunk(self, chunk: int, values: dict):
+        """
+        Write the results of a storage chunk of the PSD, given as {name: (n, n_peaks) array}
+        in the order of `PSDBlockReader.flat_index_of`.
+        """
+        slab = self._reader.slabs[chunk]
+        slab_shape = tuple(s.stop - s.start for s in slab)
+        offsets = values["offset"]
+        if self.shared_offset:
+            offsets = offsets[:, np.zeros(offsets.shape[1], dtype=int)]
+        for (name, peak), array in self._arrays.items():
+            value = offsets if name == "offset" else values[name]
+            array[slab] = value[:, peak].reshape(slab_shape)
+        self.n_chunks_written += 1
+
+    def finish(self, stopped: bool = False) -> str:
+        """Give the group its final name (suffixed if the treatment was stopped), and return it"""
+        if stopped:
+            self.name += "_partial"
+        rename_group(self._analysis, self.name)
+        logger.info(f"Treatment results saved as {self.name} ({self.n_chunks_written} chunks)")
+        return self.name
+
+    def discard(self):
+        """Remove the analysis results group, if it was created"""
+        if self.path is None:
+            return
+        try:
+            delete_group(self._analysis)
+        except Exception as e:
+            logger.warning(f"Could not remove the incomplete analysis results {self.path}: {e}")
+        else:
+            logger.debug(f"Removed the incomplete analysis results {self.path}")
+        self.path = None
+        self._analysis = None
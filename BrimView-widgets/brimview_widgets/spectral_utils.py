@@ -0,0 +1,331 @@
+"""
+Vectorised helpers to bring many spectra onto a common frequency axis,
+and mergeable statistics to aggregate them (or any stream of values) in bounded memory.
+"""
+
+import warnings
+
+import numpy as np
+
+
+def has_shared_frequency_axis(frequency: np.ndarray) -> bool:
+    """
+    Whether all the spectra are sampled on the same frequency axis.
+
+    `frequency` is either a 1D array (shared by definition) or a (N, n_freq) array.
+    """
+    frequency = np.asarray(frequency)
+    if frequency.ndim == 1 or len(frequency) <= 1:
+        return True
+    valid = ~np.any(np.isnan(frequency), axis=-1)
+    if not np.any(valid):
+        return True
+    frequency = frequency[valid]
+    return bool(np.all(frequency == frequency[0]))
+
+
+def common_frequency_axis(frequency: np.ndarray, n_points: int) -> np.ndarray:
+    """
+    Frequency axis onto which all the spectra are resampled.
+
+    If all the spectra share the same axis, that axis (sorted) is returned;
+    otherwise a linear axis covering the whole frequency range.
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    if has_shared_frequency_axis(frequency):
+        axis = frequency if frequency.ndim == 1 else _first_valid_row(frequency)
+        return np.sort(axis)
+    return np.linspace(np.nanmin(frequency), np.nanmax(frequency), n_points)
+
+
+def resample_spectra(
+    frequency: np.ndarray, PSD: np.ndarray, common_freq: np.ndarray
+) -> np.ndarray:
+    """
+    Resample all the spectra onto `common_freq` in one batched operation.
+
+    Linear interpolation, with linear extrapolation outside of each spectrum's own range
+    (same behaviour as `scipy.interpolate.interp1d(..., fill_value="extrapolate")`).
+    When all the spectra share an axis, no interpolation is done, the columns are only reordered.
+
+    Parameters
+    ----------
+    frequency : (n_freq,) or (N, n_freq) array
+        Frequency axis of each spectrum, in any order.
+    PSD : (N, n_freq) array
+        The spectra.
+    common_freq : (M,) array
+        Sorted target frequency axis.
+
+    Returns
+    -------
+    resampled : (N, M) array
+        Spectra with a NaN frequency axis give NaN rows.
+    """
+    PSD = np.asarray(PSD, dtype=float)
+    frequency = np.asarray(frequency, dtype=float)
+    common_freq = np.asarray(common_freq, dtype=float)
+    n_spectra, n_freq = PSD.shape
+
+    if has_shared_frequency_axis(frequency):
+        axis = frequency if frequency.ndim == 1 else _first_valid_row(frequency)
+        if axis.shape == common_freq.shape:
+            order = np.argsort(axis)
+            if np.array_equal(axis[order], common_freq):
+                return PSD[:, order]
+    frequency = np.broadcast_to(frequency, PSD.shape)
+
+    out = np.full((n_spectra, len(common_freq)), np.nan)
+    valid = ~np.any(np.isnan(frequency), axis=-1)
+    if not np.any(valid) or n_freq < 2:
+        return out
+    frequency = frequency[valid]
+    PSD = PSD[valid]
+    n_valid = len(PSD)
+
+    order = np.argsort(frequency, axis=-1)
+    frequency = np.take_along_axis(frequency, order, axis=-1)
+    PSD = np.take_along_axis(PSD, order, axis=-1)
+
+    # Offsetting each row by a multiple of the full span makes the flattened
+    # array globally sorted, so a single searchsorted handles all the rows
+    low = min(frequency[:, 0].min(), common_freq.min())
+    span = max(frequency[:, -1].max(), common_freq.max()) - low + 1.0
+    offsets = np.arange(n_valid)[:, None] * span
+    flat_freq = (frequency - low + offsets).ravel()
+    queries = common_freq[None, :] - low + offsets
+    position = np.searchsorted(flat_freq, queries, side="right")
+    position -= np.arange(n_valid)[:, None] * n_freq
+
+    # Index of the left point of the segment used for (inter/extra)polation
+    left = np.clip(position - 1, 0, n_freq - 2)
+    x0 = np.take_along_axis(frequency, left, axis=-1)
+    x1 = np.take_along_axis(frequency, left + 1, axis=-1)
+    y0 = np.take_along_axis(PSD, left, axis=-1)
+    y1 = np.take_along_axis(PSD, left + 1, axis=-1)
+    dx = x1 - x0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(dx != 0, (common_freq[None, :] - x0) / dx, 0.0)
+    out[valid] = y0 + t * (y1 - y0)
+    return out
+
+
+def _first_valid_row(frequency: np.ndarray) -> np.ndarray:
+    valid = np.flatnonzero(~np.any(np.isnan(frequency), axis=-1))
+    return frequency[valid[0]] if len(valid) else frequency[0]
+
+
+class RunningSpectrumStats:
+    """
+    Streaming mean and variance of spectra (Welford's algorithm, chunk-wise).
+
+    Statistics are computed independently for each frequency bin, ignoring NaN.
+    Two instances can be merged (Chan et al. parallel formula), so partial results
+    computed on different chunks can be combined, and a subset of spectra can be removed again.
+    """
+
+    def __init__(self, n_bins: int):
+        self.count = np.zeros(n_bins)
+        self.mean = np.zeros(n_bins)
+        self.m2 = np.zeros(n_bins)
+
+    @classmethod
+    def from_moments(cls, count, mean, m2) -> "RunningSpectrumStats":
+        """Statistics computed elsewhere: count, mean and sum of squared deviations of each bin"""
+        stats = cls(len(count))
+        stats.count, stats.mean, stats.m2 = (
+            np.asarray(count, dtype=float),
+            np.asarray(mean, dtype=float),
+            np.asarray(m2, dtype=float),
+        )
+        return stats
+
+    def copy(self) -> "RunningSpectrumStats":
+        other = RunningSpectrumStats(len(self.count))
+        other.count, other.mean, other.m2 = (
+            self.count.copy(),
+            self.mean.copy(),
+            self.m2.copy(),
+        )
+        return other
+
+    @property
+    def n_spectra(self) -> int:
+        return int(self.count.max()) if len(self.count) else 0
+
+    def update(self, spectra: np.ndarray):
+        """Add a (n, n_bins) block of spectra."""
+        spectra = np.asarray(spectra, dtype=float)
+        valid = ~np.isnan(spectra)
+        count = valid.sum(axis=0)
+        total = np.where(valid, spectra, 0.0).sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, total / count, 0.0)
+        m2 = np.where(valid, (spectra - mean) ** 2, 0.0).sum(axis=0)
+        self._combine(count, mean, m2)
+
+    def merge(self, other: "RunningSpectrumStats"):
+        """Add the spectra accumulated in `other`."""
+        self._combine(other.count, other.mean, other.m2)
+
+    def subtract(self, other: "RunningSpectrumStats"):
+        """
+        Remove spectra that were previously added (inverse of `merge`).
+        `other` must only contain spectra that are part of this instance.
+
+        The variance is obtained as a difference of sums of squares, which loses precision
+        when `other` holds most of the spectra, and the errors add up over successive calls:
+        recompute the statistics from scratch from time to time (see `relative_difference`).
+        """
+        count = self.count - other.count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(
+                count > 0, (self.count * self.mean - other.count * other.mean) / count, 0.0
+            )
+            delta = other.mean - mean
+            m2 = np.where(
+                count > 0,
+                self.m2 - other.m2 - delta**2 * count * other.count / self.count,
+                0.0,
+            )
+        # Rounding errors can make the remaining variance slightly negative
+        self.count, self.mean, self.m2 = count, mean, np.maximum(m2, 0.0)
+
+    def _combine(self, count_b, mean_b, m2_b):
+        count = self.count + count_b
+        delta = mean_b - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight_b = np.where(count > 0, count_b / count, 0.0)
+            self.mean = self.mean + delta * weight_b
+            self.m2 = self.m2 + m2_b + delta**2 * self.count * weight_b
+        self.count = count
+
+    def std(self) -> np.ndarray:
+        """Population standard deviation (same as np.nanstd)"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+
+    def mean_or_nan(self) -> np.ndarray:
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def relative_difference(self, reference: "RunningSpectrumStats") -> float:
+        """
+        Largest difference of the mean and standard deviation with `reference`,
+        relative to the largest mean of `reference` (e.g. to check the drift of statistics
+        updated incrementally against a fresh computation).
+        """
+        if not np.array_equal(self.count, reference.count):
+            # Not computed on the same spectra
+            return float("inf")
+        mean, reference_mean = self.mean_or_nan(), reference.mean_or_nan()
+        with warnings.catch_warnings():
+            # All-NaN statistics just give NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            difference = max(
+                np.nanmax(np.abs(mean - reference_mean)),
+                np.nanmax(np.abs(self.std() - reference.std())),
+            )
+            scale = np.nanmax(np.abs(reference_mean))
+        return float(difference / scale) if scale > 0 else float(difference)
+
+
+class SpectralDensity:
+    """
+    2D histogram of (frequency, PSD) over many spectra, accumulated chunk by chunk.
+
+    All the spectra must be resampled on the same `frequency` axis. Values outside
+    of the PSD bin edges are not counted. Histograms are additive, so partial
+    densities can be merged.
+    """
+
+    def __init__(self, frequency: np.ndarray, PSD_edges: np.ndarray):
+        self.frequency = np.asarray(frequency, dtype=float)
+        self.PSD_edges = np.asarray(PSD_edges, dtype=float)
+        self.counts = np.zeros(
+            (len(self.PSD_edges) - 1, len(self.frequency)), dtype=np.int64
+        )
+
+    @property
+    def PSD_centers(self) -> np.ndarray:
+        return (self.PSD_edges[:-1] + self.PSD_edges[1:]) / 2
+
+    def update(self, spectra: np.ndarray):
+        """Add a (n, n_freq) block of spectra."""
+        n_bins, n_freq = self.counts.shape
+        PSD_bin = np.searchsorted(self.PSD_edges, spectra, side="right") - 1
+        # The last edge is included in the last bin
+        PSD_bin[spectra == self.PSD_edges[-1]] = n_bins - 1
+        valid = (PSD_bin >= 0) & (PSD_bin < n_bins) & ~np.isnan(spectra)
+        # One bin per (PSD bin, frequency) pair
+        index = PSD_bin * n_freq + np.arange(n_freq)
+        self.counts += np.bincount(index[valid], minlength=n_bins * n_freq).reshape(
+            n_bins, n_freq
+        )
+
+    def merge(self, other: "SpectralDensity"):
+        self.counts += other.counts
+
+
+class QuantileSketch:
+    """
+    Mergeable, bounded-memory sketch to estimate quantiles of a stream of values.
+
+    Simplified KLL sketch: values are stored in levels, where an item at level `i`
+    stands for 2**i original values. When a level grows above `capacity`, it is
+    sorted and every other item is promoted to the next level.
+    Memory is O(capacity * log(n)) and the rank error is roughly 1/capacity.
+    """
+
+    def __init__(self, capacity: int = 512, seed: int = 0):
+        self.capacity = capacity
+        self.levels: list[np.ndarray] = [np.empty(0)]
+        self.n = 0
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other: "QuantileSketch"):
+        self.n += other.n
+        for i, level in enumerate(other.levels):
+            if i >= len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[i] = np.concatenate([self.levels[i], level])
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                # Keep an even number of items to promote, the odd one out stays here
+                n_promoted = len(items) - len(items) % 2
+                offset = self._rng.integers(2)
+                promoted = items[offset:n_promoted:2]
+                self.levels[level] = items[n_promoted:]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], promoted]
+                )
+            level += 1
+
+    def quantile(self, q) -> float | np.ndarray:
+        """Estimate the q-th quantile(s), q in [0, 1]."""
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(level), 2.0**i) for i, level in enumerate(self.levels)]
+        )
+        order = np.argsort(items)
+        items = items[order]
+        cumulative = np.cumsum(weights[order])
+        # Midpoint ranks, to be consistent with linear interpolation on the exact values
+        ranks = (cumulative - weights[order] / 2) / cumulative[-1]
+        return np.interp(q, ranks, items)
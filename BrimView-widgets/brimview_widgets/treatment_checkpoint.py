@@ -0,0 +1,157 @@
+"""
+Checkpoints of long treatment runs.
+
+While a treatment is running, the fitted parameters of every completed storage chunk
+are written to a scratch zarr group, together with a mask of the completed chunks.
+If the run is interrupted (server restart, closed session...), a later run with the
+same data and the same treatment set-up resumes from there instead of starting over.
+
+The checkpoint of a run is identified by a hash of everything the fitted values depend on:
+the file and data group, the layout of the PSD and the recorded treatment algorithm.
+It is removed once the results are saved; the checkpoints of runs that are never
+resumed (stopped or failed) are removed after `CHECKPOINT_MAX_AGE_DAYS` without changes.
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import brimfile as bls
+import zarr
+
+from .brimfile_compat import file_name, group_path
+from .logging import logger
+from .psd_access import PSDBlockReader, describe_psd
+
+DEFAULT_CHECKPOINT_DIR = os.environ.get(
+    "BRIMVIEW_CHECKPOINT_DIR",
+    os.path.join(tempfile.gettempdir(), "brimview_checkpoints"),
+)
+# Checkpoints not written to for this long are removed when a treatment starts
+CHECKPOINT_MAX_AGE_DAYS = float(os.environ.get("BRIMVIEW_CHECKPOINT_MAX_AGE_DAYS", 7))
+
+
+def checkpoint_key(data: bls.Data, state) -> str:
+    """Hash identifying the treatment of a data group with a given `TreatState`"""
+    psd = describe_psd(data)
+    filename = file_name(data)
+    description = {
+        # Remote files are identified by their URL
+        "file": os.path.abspath(filename) if os.path.exists(filename) else filename,
+        "data": group_path(data),
+        "shape": psd.shape,
+        "chunks": psd.chunks,
+        "state": dataclasses.asdict(state),
+    }
+    encoded = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()[:16]
+
+
+class TreatmentCheckpoint:
+    """
+    Scratch zarr group holding the results of the completed chunks of a treatment.
+
+    The result arrays have the spatial shape of the PSD dataset (plus the peaks),
+    with the same chunking, so each completed chunk is written exactly once.
+    The `done` mask is only updated after the chunk has been written, so an
+    interrupted write is never considered as completed.
+    """
+
+    def __init__(self, path: str, key: str, reader: PSDBlockReader, n_peaks: int, result_arrays: list[str]):
+        self.path = path
+        self.key = key
+        self._reader = reader
+
+        group = zarr.open_group(path, mode="a")
+        if group.attrs.get("key") != key:
+            # Unknown or stale content: start from scratch
+            group = zarr.open_group(path, mode="w")
+            group.attrs.update({"key": key, "created": time.strftime("%Y-%m-%d %H:%M:%S")})
+        self._group = group
+
+        chunks = tuple(s.stop - s.start for s in reader.slabs[0])
+        self._arrays = {
+            name: group.require_array(
+                name,
+                shape=reader.spatial_shape + (n_peaks,),
+                chunks=chunks + (n_peaks,),
+                dtype="float64",
+                fill_value=np.nan,
+            )
+            for name in result_arrays
+        }
+        n_chunks = len(reader.slabs)
+        self._done = group.require_array(
+            "done", shape=(n_chunks,), chunks=(min(n_chunks, 4096),), dtype="bool", fill_value=False
+        )
+        self.done = np.asarray(self._done[:], dtype=bool)
+        if self.done.any():
+            logger.info(f"Resuming treatment from {path}: {self.done.sum()}/{n_chunks} chunks done")
+
+    @classmethod
+    def open(cls, directory: str, data: bls.Data, state, reader: PSDBlockReader, result_arrays: list[str]):
+        """Open (or create) the checkpoint of the treatment of `data` with `state` in `directory`"""
+        key = checkpoint_key(data, state)
+        os.makedirs(directory, exist_ok=True)
+        prune_checkpoints(directory, keep=key)
+        return cls(os.path.join(directory, f"{key}.zarr"), key, reader, state.n_peaks, result_arrays)
+
+    def read_chunk(self, chunk: int) -> tuple[np.ndarray, dict]:
+        """The results of a completed chunk, as `(flat_index, {name: (n, n_peaks) array})`"""
+        slab = self._reader.slabs[chunk]
+        values = {
+            name: np.asarray(array[slab]).reshape(-1, array.shape[-1])
+            for name, array in self._arrays.items()
+        }
+        return self._reader.flat_index_of(slab), values
+
+    def save_chunk(self, chunk: int, values: dict):
+        """Write the results of a completed chunk, given as {name: (n, n_peaks) array}"""
+        slab = self._reader.slabs[chunk]
+        slab_shape = tuple(s.stop - s.start for s in slab)
+        for name, array in self._arrays.items():
+            array[slab] = values[name].reshape(slab_shape + (array.shape[-1],))
+        self.done[chunk] = True
+        self._done[chunk] = True
+
+
+def discard_checkpoint(directory: str, data: bls.Data, state):
+    """Delete the checkpoint of a treatment, e.g. once its results have been saved"""
+    path = os.path.join(directory, f"{checkpoint_key(data, state)}.zarr")
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+        logger.debug(f"Removed treatment checkpoint {path}")
+
+
+def _last_modified(path: str) -> float:
+    """Time of the last write to a checkpoint (its files are only ever created or replaced)"""
+    last = os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            last = max(last, os.path.getmtime(os.path.join(root, name)))
+    return last
+
+
+def prune_checkpoints(directory: str, keep: str = None, max_age_days: float = None):
+    """
+    Delete the checkpoints in `directory` that were not written to for `max_age_days`
+    (`CHECKPOINT_MAX_AGE_DAYS` by default), except the one of key `keep`
+    """
+    if max_age_days is None:
+        max_age_days = CHECKPOINT_MAX_AGE_DAYS
+    oldest = time.time() - max_age_days * 86400
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".zarr") or entry.name == f"{keep}.zarr":
+            continue
+        try:
+            if _last_modified(entry.path) < oldest:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                logger.info(f"Removed the stale treatment checkpoint {entry.path}")
+        except OSError as e:
+            # E.g. removed by another treatment in the meantime
+            logger.debug(f"Could not check the treatment checkpoint {entry.path}: {e}")
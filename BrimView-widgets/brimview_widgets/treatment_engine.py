@@ -0,0 +1,791 @@
+"""
+Fitting engines for the Brillouin treatment.
+
+The treatment is set up once with `HDF5_BLS_treat` on the average spectrum (`prepare_treat`):
+this records the algorithm (points, model, width estimation and fit) in the `Treat` object.
+The recorded algorithm is then replayed on blocks of spectra (`fit_block`), either in a
+background thread or in worker processes, optionally seeding each fit with the parameters
+of its already-fitted neighbours (see `warm_start`). The "Batched" engine instead fits whole
+blocks at once with a vectorised solver (see `batched_fit`). `treat_data` streams the spectra from the file
+one storage chunk at a time, so memory use doesn't depend on the size of the dataset.
+
+Nothing in this module depends on Panel, so it can also be used without a GUI.
+"""
+
+import asyncio
+import copy
+import datetime
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+import multiprocessing
+
+import numpy as np
+import brimfile as bls
+from HDF5_BLS_treat import treat as bls_treat
+
+from .logging import logger
+from .progress_channel import ProgressChannel
+from .psd_access import PSDBlockReader
+from .spectral_utils import RunningSpectrumStats
+from .result_writer import AnalysisResultsWriter
+from .treatment_checkpoint import TreatmentCheckpoint
+from .warm_start import MultiPeakProblem, WarmStartStats, fit_spectra_warm_start
+from .batched_fit import BATCHED_MODELS, BatchedMultiPeakFit
+
+ENGINES = ["Serial", "Process pool", "Batched"]
+
+# Number of chunks averaged to get the spectrum on which the treatment is set up
+SETUP_CHUNKS = 8
+# Approximate number of spectra fitted for the coarse preview
+PREVIEW_SPECTRA = 1024
+# Minimum time (s) between two updates of the preview during the full treatment
+PREVIEW_INTERVAL = 1.0
+# Maximum number of spectra fitted at once by the "Batched" engine
+BATCHED_BLOCK_SIZE = 4096
+# Number of spectra fitted to estimate the duration of a treatment (see `estimate_treatment`),
+# taken from at most `ESTIMATE_CHUNKS` random chunks
+ESTIMATE_SPECTRA = 200
+ESTIMATE_CHUNKS = 4
+
+
+@dataclass
+class PeakConfig:
+    """Initial guess and constraints of one peak, see `BrillouinPeakEstimate`"""
+
+    position: float
+    normalizing_window: float
+    fitting_window: float
+    type_pnt: str
+    bound_shift: tuple[float, float]
+    bound_linewidth: tuple[float, float]
+
+
+@dataclass
+class TreatmentConfig:
+    """Everything needed to set up a treatment, independently of the GUI"""
+
+    peaks: list[PeakConfig]
+    model_fit: str = "Lorentzian"
+    max_width_guess: float = 2.0
+    # Seed each fit with the fitted parameters of its neighbours
+    warm_start: bool = False
+
+
+def prepare_treat(
+    frequency: np.ndarray, PSD: np.ndarray, config: TreatmentConfig
+) -> bls_treat.Treat:
+    """
+    Create a `Treat` object and record the treatment algorithm described by `config`.
+
+    Parameters
+    ----------
+    frequency : (n_freq,) array
+        Frequency axis, sorted from low to high (as expected by `HDF5_BLS_treat`).
+    PSD : (n_spectra, n_freq) array
+        The spectra to treat. Their average is used to refine the peaks and estimate the widths.
+    """
+    treat = bls_treat.Treat(frequency=frequency, PSD=PSD)
+
+    # Points used for the normalization
+    for peak in config.peaks:
+        treat.add_point(
+            position_center_window=peak.position,
+            type_pnt="Other",
+            window_width=peak.normalizing_window,
+        )
+
+    # Points used for the fitting
+    for peak in config.peaks:
+        treat.add_point(
+            position_center_window=peak.position,
+            type_pnt=peak.type_pnt,
+            window_width=peak.fitting_window,
+        )
+
+    treat.define_model(model=config.model_fit, elastic_correction=False)
+    treat.estimate_width_inelastic_peaks(max_width_guess=config.max_width_guess)
+    treat.multi_fit_all_inelastic(
+        guess_offset=True,
+        update_point_position=True,
+        bound_shift=[list(peak.bound_shift) for peak in config.peaks],
+        bound_linewidth=[list(peak.bound_linewidth) for peak in config.peaks],
+    )
+    return treat
+
+
+@dataclass
+class TreatState:
+    """
+    Picklable snapshot of a prepared `Treat` object: the recorded algorithm
+    and the state it starts from when replayed on each spectrum.
+    """
+
+    algorithm: dict
+    points: list
+    windows: list
+    width_estimator: list
+    fit_model: str
+    n_peaks: int
+    warm_start: bool = False
+    batched: bool = False
+
+    @classmethod
+    def from_treat(
+        cls, treat: bls_treat.Treat, warm_start: bool = False, batched: bool = False
+    ) -> "TreatState":
+        return cls(
+            algorithm=copy.deepcopy(treat._algorithm),
+            points=copy.deepcopy(treat.points),
+            windows=copy.deepcopy(treat.windows),
+            width_estimator=list(treat.width_estimator),
+            fit_model=treat.fit_model,
+            # Number of peaks fitted by the last step of the algorithm
+            n_peaks=len(treat.shift_sample),
+            warm_start=warm_start,
+            batched=batched,
+        )
+
+    @property
+    def shared_offset(self) -> bool:
+        """
+        Whether a single offset is fitted for all the peaks: `multi_fit_all_inelastic` only
+        lets the offset of the first peak free, the ones of the other peaks stay at 0
+        """
+        return self.n_peaks > 1 and any(
+            f["function"] == "multi_fit_all_inelastic" for f in self.algorithm["functions"]
+        )
+
+    def restore(self, frequency: np.ndarray, PSD: np.ndarray) -> bls_treat.Treat:
+        """A new `Treat` object on (frequency, PSD), ready for `apply_algorithm_on_all`"""
+        treat = bls_treat.Treat(frequency=frequency, PSD=PSD)
+        treat._algorithm = copy.deepcopy(self.algorithm)
+        treat.points = copy.deepcopy(self.points)
+        treat.windows = copy.deepcopy(self.windows)
+        treat.width_estimator = list(self.width_estimator)
+        treat.fit_model = self.fit_model
+        # apply_algorithm_on_all sizes its outputs from the last sample fit
+        treat.shift_sample = [np.nan] * self.n_peaks
+        return treat
+
+
+@dataclass
+class TreatmentResult:
+    """
+    Fitted parameters of a treatment, each of shape (n_spectra, n_peaks).
+
+    The spectra are in the order of the flattened spatial dimensions of the PSD dataset
+    (`spatial_shape`). Spectra that were not (yet) fitted are NaN.
+    """
+
+    shift: np.ndarray
+    linewidth: np.ndarray
+    amplitude: np.ndarray
+    offset: np.ndarray
+    shift_var: np.ndarray
+    linewidth_var: np.ndarray
+    amplitude_var: np.ndarray
+    n_fit_errors: int = field(default=0)
+    spatial_shape: tuple = field(default=None)
+    # Only for warm-started treatments
+    warm_start: WarmStartStats = field(default=None)
+    # The treatment was stopped before all the spectra were fitted
+    stopped: bool = field(default=False)
+
+    def __post_init__(self):
+        if self.spatial_shape is None:
+            self.spatial_shape = (self.shift.shape[0],)
+
+    @classmethod
+    def empty(cls, spatial_shape: tuple, n_peaks: int) -> "TreatmentResult":
+        n_spectra = int(np.prod(spatial_shape))
+        return cls(
+            *(np.full((n_spectra, n_peaks), np.nan) for _ in cls.arrays()),
+            spatial_shape=tuple(spatial_shape),
+        )
+
+    @classmethod
+    def arrays(cls) -> list[str]:
+        """Names of the per-spectrum arrays"""
+        return [
+            f.name for f in fields(cls) if f.name not in ("n_fit_errors", "spatial_shape", "warm_start", "stopped")
+        ]
+
+    @classmethod
+    def from_treat(cls, treat: bls_treat.Treat) -> "TreatmentResult":
+        """The results of `Treat.apply_algorithm_on_all`, with the spectra dimensions flattened"""
+        n_peaks = treat.shift.shape[-1]
+        return cls(
+            *(
+                np.asarray(getattr(treat, name), dtype=float).reshape(-1, n_peaks)
+                for name in cls.arrays()
+            ),
+            n_fit_errors=len(treat.point_error),
+            spatial_shape=treat.shift.shape[:-1],
+        )
+
+    @classmethod
+    def from_parameters(cls, popt: np.ndarray, std: np.ndarray, **kwargs) -> "TreatmentResult":
+        """
+        The results of the fits of `MultiPeakProblem`, from (n, n_peaks, 4) arrays of
+        (offset, amplitude, shift, linewidth) and their standard deviations.
+        """
+        return cls(
+            shift=popt[..., 2],
+            linewidth=popt[..., 3],
+            amplitude=popt[..., 1],
+            offset=popt[..., 0],
+            shift_var=std[..., 2],
+            linewidth_var=std[..., 3],
+            amplitude_var=std[..., 1],
+            n_fit_errors=int(np.all(np.isnan(popt[..., 2]), axis=-1).sum()),
+            **kwargs,
+        )
+
+    @property
+    def n_spectra(self) -> int:
+        return self.shift.shape[0]
+
+    @property
+    def n_peaks(self) -> int:
+        return self.shift.shape[1]
+
+    def insert(self, index, block: "TreatmentResult"):
+        """Copy the results of a block of spectra at the flat indices `index`"""
+        for name in self.arrays():
+            getattr(self, name)[index] = getattr(block, name)
+        self.n_fit_errors += block.n_fit_errors
+        if block.warm_start is not None:
+            if self.warm_start is None:
+                self.warm_start = WarmStartStats()
+            self.warm_start.merge(block.warm_start)
+
+    def peak_map(self, name: str, peak: int) -> np.ndarray:
+        """One array (e.g. "shift") of one peak, reshaped to `spatial_shape`"""
+        return getattr(self, name)[:, peak].reshape(self.spatial_shape)
+
+
+def fit_block(
+    state: TreatState,
+    frequency: np.ndarray,
+    PSD: np.ndarray,
+    row_length: int = 1,
+    progress=None,
+) -> TreatmentResult:
+    """
+    Fit a (n, n_freq) block of spectra by replaying the recorded algorithm.
+    Top-level function, so it can be sent to worker processes.
+
+    With `state.warm_start`, the block is fitted by `fit_spectra_warm_start`, walking
+    its rows of `row_length` spectra (in storage order) as a serpentine.
+    With `state.batched`, all the spectra of the block are fitted at once by `BatchedMultiPeakFit`.
+    `progress(n)`, if given, is called as the spectra get fitted (from the calling thread).
+    """
+    if state.batched:
+        problem = MultiPeakProblem.from_state(state, frequency)
+        popt, std, _ = BatchedMultiPeakFit(problem, frequency).fit(PSD)
+        result = TreatmentResult.from_parameters(popt, std)
+    elif state.warm_start:
+        problem = MultiPeakProblem.from_state(state, frequency)
+        popt, std, stats = fit_spectra_warm_start(problem, frequency, PSD, row_length)
+        result = TreatmentResult.from_parameters(popt, std, warm_start=stats)
+    else:
+        treat = state.restore(frequency, PSD)
+        if progress is not None:
+            # Called once per spectrum
+            treat._progress_callback = lambda count, total: progress(1)
+        treat.apply_algorithm_on_all()
+        return TreatmentResult.from_treat(treat)
+    if progress is not None:
+        progress(len(PSD))
+    return result
+
+
+def _timed_fit_block(*args, **kwargs) -> tuple[TreatmentResult, str, float]:
+    """`fit_block`, with the name of the worker that ran it and the time it took"""
+    t0 = time.perf_counter()
+    result = fit_block(*args, **kwargs)
+    worker = f"process {os.getpid()}" if multiprocessing.parent_process() else threading.current_thread().name
+    return result, worker, time.perf_counter() - t0
+
+
+def default_n_workers() -> int:
+    return os.cpu_count() or 1
+
+
+_executor: ProcessPoolExecutor | None = None
+_executor_workers = 0
+
+# HDF5_BLS_treat is not thread-safe: the "Serial" and "Batched" engines fit one block
+# at a time, in a background thread so that the event loop is not blocked
+_serial_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bls_treat")
+
+
+def get_executor(n_workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool shared by all the treatments of this process.
+    The workers are kept alive between treatments, and the pool is only
+    re-created when the number of workers changes.
+    """
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != n_workers:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        # "spawn" rather than "fork": forking the multi-threaded Bokeh server is not safe
+        _executor = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        _executor_workers = n_workers
+    return _executor
+
+
+def block_size(n_spectra: int, n_workers: int, max_block_size: int = 256) -> int:
+    """
+    Number of spectra sent to a worker at once.
+
+    Several blocks per worker keep all the workers busy until the end (load balancing),
+    while blocks of a few hundred spectra make the transfer overhead negligible
+    compared to the fitting time.
+    """
+    return max(1, min(max_block_size, -(-n_spectra // (4 * n_workers))))
+
+
+def engine_block_size(engine: str, n_spectra: int, n_workers: int) -> int:
+    """Maximum number of spectra per block sent to the workers by `treat_data`"""
+    # The batched solver is most efficient on large blocks, it fits each chunk at once
+    return BATCHED_BLOCK_SIZE if engine == "Batched" else block_size(n_spectra, n_workers)
+
+
+def preview_grid(spatial_shape: tuple, n_target: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Regular subsample of the spectra, used for the coarse preview of a treatment.
+
+    Returns
+    -------
+    (samples, nearest)
+        `samples` are the flat indices of about `n_target` spectra on a regular grid,
+        and `nearest[i]` is the flat index of the sample closest to spectrum `i` (below it
+        along each dimension), to fill the full-resolution map from the samples.
+    """
+    n_spectra = int(np.prod(spatial_shape))
+    n_dims = max(1, sum(n > 1 for n in spatial_shape))
+    stride = max(1, int(np.ceil((n_spectra / n_target) ** (1 / n_dims))))
+    strides = [stride if n > 1 else 1 for n in spatial_shape]
+
+    def flat(per_dim_indices):
+        grid = np.broadcast_arrays(*np.ix_(*per_dim_indices))
+        return np.ravel_multi_index(grid, spatial_shape).ravel()
+
+    samples = flat([np.arange(0, n, s) for n, s in zip(spatial_shape, strides)])
+    nearest = flat([(np.arange(n) // s) * s for n, s in zip(spatial_shape, strides)])
+    return samples, nearest
+
+
+def setup_spectrum(reader: PSDBlockReader, n_chunks: int = SETUP_CHUNKS) -> np.ndarray:
+    """
+    Average spectrum of a few chunks spread over the whole dataset,
+    on which the treatment is set up (peak refinement and width estimation).
+    """
+    slabs = reader.slabs
+    picked = np.unique(np.linspace(0, len(slabs) - 1, min(n_chunks, len(slabs))).astype(int))
+    stats = RunningSpectrumStats(reader.n_freq)
+    for i in picked:
+        _, PSD = reader.read_slab(slabs[i])
+        stats.update(PSD)
+    return stats.mean_or_nan()
+
+
+async def setup_treatment(
+    data: bls.Data, config: TreatmentConfig, engine: str
+) -> tuple[PSDBlockReader, np.ndarray, TreatState]:
+    """
+    Set up the treatment of a data group on its average spectrum (see `setup_spectrum`).
+
+    Returns
+    -------
+    (reader, order, state)
+        The reader of the PSD, the order of the frequency axis in which the spectra
+        must be given to `fit_block`, and the treatment set-up.
+    """
+    batched = engine == "Batched"
+    if batched and config.model_fit not in BATCHED_MODELS:
+        raise ValueError(
+            f"The batched engine supports the models {BATCHED_MODELS}, not '{config.model_fit}'"
+        )
+    reader = PSDBlockReader(data)
+    if not reader.shared_frequency:
+        logger.warning(
+            "The frequency axis is not shared by all the spectra: using the one of the first spectrum"
+        )
+    order = np.argsort(reader.frequency)
+    # bls_treat expects the frequency to be ordered from low to high
+    frequency = reader.frequency[order]
+    logger.debug(f"Frequency axis for BLS treatment: {frequency}")
+
+    mean_spectrum = await asyncio.to_thread(setup_spectrum, reader)
+    treat = prepare_treat(frequency, mean_spectrum[None, order], config)
+    state = TreatState.from_treat(
+        treat, warm_start=config.warm_start and not batched, batched=batched
+    )
+    return reader, order, state
+
+
+async def treat_data(
+    data: bls.Data,
+    config: TreatmentConfig,
+    *,
+    engine: str = "Process pool",
+    n_workers: int = None,
+    max_spectra: int = None,
+    checkpoint_dir: str = None,
+    progress: ProgressChannel = None,
+    preview_callback=None,
+    executor: Executor = None,
+    stop: threading.Event = None,
+    writer: AnalysisResultsWriter = None,
+) -> tuple[TreatState, TreatmentResult]:
+    """
+    Run the treatment on all the spectra of a data group.
+
+    The PSD is streamed one storage chunk at a time. Each chunk is split into blocks,
+    which are fitted in a background thread ("Serial"), in worker processes
+    ("Process pool") or all at once by the vectorised solver ("Batched"), with a bounded
+    number of blocks in flight so that memory use is bounded by the chunk and block sizes,
+    not by the dataset size.
+    With `config.warm_start`, the blocks are whole rows of the chunks, so that each
+    spectrum can be seeded by its neighbours (see `warm_start`); this doesn't apply
+    to the "Batched" engine, whose spectra are all fitted at the same time.
+
+    Parameters
+    ----------
+    max_spectra : int, optional
+        Only fit the first `max_spectra` spectra (in storage order); the others are left NaN.
+    checkpoint_dir : str, optional
+        If given, the results of each completed chunk are checkpointed in this directory,
+        and the chunks completed by a previous run with the same set-up are not fitted again
+        (see `treatment_checkpoint`).
+    progress : ProgressChannel, optional
+        Advanced as the spectra get fitted (by the worker thread itself, spectrum by spectrum,
+        for the "Serial" engine; when each block is done for the others), together with the
+        statistics of each worker. Its `total` is set to the number of spectra to fit.
+    preview_callback : callable, optional
+        If given, a coarse preview is computed first, by fitting a regular subsample of
+        about `PREVIEW_SPECTRA` spectra. `preview_callback(shift)` is then called with a
+        (n_spectra, n_peaks) shift array filled from the nearest fitted sample, and again
+        (at most every `PREVIEW_INTERVAL` s) as the full-resolution results replace it.
+    executor : Executor, optional
+        Pool of worker processes to fit the blocks in, whatever the engine (e.g. the one of
+        `job_queue.TreatmentScheduler`, to keep the fits out of the server process).
+        By default, the "Process pool" engine uses the pool of `get_executor`, and the
+        other engines a background thread.
+    stop : threading.Event, optional
+        Checked before sending each block to the workers: once set, no more blocks are sent,
+        the blocks already sent are completed, and the partial result is returned with
+        `stopped` set (the spectra that were not fitted are NaN).
+    writer : AnalysisResultsWriter, optional
+        If given, its analysis results group is created once the treatment is set up, and
+        the results of each chunk are written to it as soon as the chunk is fitted (in the
+        background, while the next blocks are being fitted). The chunks that are only partly
+        fitted (see `max_spectra` and `stop`) are written at the end, with NaN for the spectra
+        that were not fitted. The caller is responsible for `finish`ing or `discard`ing it.
+
+    Returns
+    -------
+    (state, result)
+        The treatment set-up (which also identifies its checkpoint), and the fitted parameters.
+    """
+    reader, order, state = await setup_treatment(data, config, engine)
+    frequency = reader.frequency[order]
+
+    n_total = reader.n_spectra if max_spectra is None else min(max_spectra, reader.n_spectra)
+    if progress is not None:
+        progress.total = n_total
+    n_workers = (n_workers or default_n_workers()) if engine == "Process pool" else 1
+    size = engine_block_size(engine, n_total, n_workers)
+    result = TreatmentResult.empty(reader.spatial_shape, state.n_peaks)
+
+    if writer is not None:
+        await asyncio.to_thread(writer.open, reader, state.n_peaks, state.shared_offset)
+
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = await asyncio.to_thread(
+            TreatmentCheckpoint.open, checkpoint_dir, data, state, reader, TreatmentResult.arrays()
+        )
+
+    if executor is None:
+        executor = _serial_executor if engine != "Process pool" else get_executor(n_workers)
+    in_thread = isinstance(executor, ThreadPoolExecutor)
+    # Blocks in flight: enough to keep the workers busy; the single-worker engines only
+    # submit the next block while the current one is being fitted
+    max_pending = 2 * n_workers if engine == "Process pool" else 1
+    loop = asyncio.get_running_loop()
+
+    async def fit(chunk, index, PSD, row_length=1, report=False):
+        # The callback can't be sent to other processes, their blocks are counted once done
+        advance = progress.advance if progress is not None and report and in_thread else None
+        block_result, worker, busy = await loop.run_in_executor(
+            executor, _timed_fit_block, state, frequency, PSD, row_length, advance
+        )
+        if progress is not None and report:
+            if not in_thread:
+                progress.advance(len(index))
+            progress.record_block(worker, len(index), busy)
+        return chunk, index, block_result
+
+    preview = None
+    if preview_callback is not None:
+        samples, nearest = preview_grid(reader.spatial_shape, PREVIEW_SPECTRA)
+        PSD = (await asyncio.to_thread(reader.read_spectra, samples))[:, order]
+        preview_size = engine_block_size(engine, len(samples), n_workers)
+        coarse = np.full((reader.n_spectra, state.n_peaks), np.nan)
+        for _, index, block_result in await asyncio.gather(
+            *(
+                fit(None, samples[start : start + preview_size], PSD[start : start + preview_size])
+                for start in range(0, len(samples), preview_size)
+            )
+        ):
+            coarse[index] = block_result.shift
+        preview = coarse[nearest]
+        del coarse, nearest, PSD
+        preview_callback(preview)
+    last_preview = time.monotonic()
+
+    pending = set()
+    # Results of the chunks being written to `writer`
+    writes = set()
+    # chunk -> (flat indices, number of blocks still being fitted, whether all the spectra
+    # of the chunk are fitted), for the chunks to checkpoint or write
+    unfinished = {}
+
+    async def chunk_done(chunk: int, flat_index: np.ndarray, complete: bool):
+        values = {name: getattr(result, name)[flat_index] for name in result.arrays()}
+        if writer is not None:
+            writes.add(asyncio.ensure_future(asyncio.to_thread(writer.write_chunk, chunk, values)))
+        if checkpoint is not None and complete:
+            await asyncio.to_thread(checkpoint.save_chunk, chunk, values)
+
+    async def merge_finished(limit: int):
+        nonlocal pending, last_preview
+        while len(pending) > limit:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chunk, index, block_result = task.result()
+                result.insert(index, block_result)
+                if preview is not None:
+                    preview[index] = block_result.shift
+                    if time.monotonic() - last_preview > PREVIEW_INTERVAL:
+                        preview_callback(preview)
+                        last_preview = time.monotonic()
+                if chunk in unfinished:
+                    flat_index, n_blocks, complete = unfinished[chunk]
+                    unfinished[chunk] = (flat_index, n_blocks - 1, complete)
+                    if n_blocks == 1:
+                        del unfinished[chunk]
+                        await chunk_done(chunk, flat_index, complete)
+
+    n_read = 0
+    try:
+        for chunk, slab in enumerate(reader.slabs):
+            if n_read >= n_total:
+                break
+            if result.stopped:
+                break
+            if stop is not None and stop.is_set():
+                # Checked before reading the next chunk, which would not be fitted anyway
+                result.stopped = True
+                logger.info(f"Treatment stopped after {n_read} of {n_total} spectra")
+                break
+            if checkpoint is not None and checkpoint.done[chunk]:
+                chunk_index, values = await asyncio.to_thread(checkpoint.read_chunk, chunk)
+                # As for the chunks that are read, only the spectra within `max_spectra` are kept
+                n_keep = min(len(chunk_index), n_total - n_read)
+                n_read += n_keep
+                flat_index = chunk_index[:n_keep]
+                for name, value in values.items():
+                    getattr(result, name)[flat_index] = value[:n_keep]
+                result.n_fit_errors += int(
+                    np.all(np.isnan(values["shift"][:n_keep]), axis=-1).sum()
+                )
+                if preview is not None:
+                    preview[flat_index] = values["shift"][:n_keep]
+                # Written to the file, without checkpointing it again
+                await chunk_done(chunk, chunk_index, complete=False)
+                if progress is not None:
+                    progress.skip(n_keep)
+                continue
+
+            flat_index, PSD = await asyncio.to_thread(reader.read_slab, slab)
+            n_keep = min(len(flat_index), n_total - n_read)
+            n_read += n_keep
+            # Rows of the chunk along the last spatial dimension
+            row_length = slab[-1].stop - slab[-1].start if len(slab) > 1 else 1
+            chunk_size = -(-size // row_length) * row_length if state.warm_start else size
+            chunk_index = flat_index
+            flat_index, PSD = flat_index[:n_keep], PSD[:n_keep, order]
+            for start in range(0, n_keep, chunk_size):
+                if stop is not None and stop.is_set():
+                    # The blocks of this chunk that were not sent are left NaN (and the
+                    # chunk is not checkpointed)
+                    result.stopped = True
+                    logger.info(f"Treatment stopped after {n_read - n_keep + start} of {n_total} spectra")
+                    break
+                block = slice(start, start + chunk_size)
+                pending.add(
+                    asyncio.ensure_future(
+                        fit(chunk, flat_index[block], PSD[block], row_length, report=True)
+                    )
+                )
+                if start == 0 and (checkpoint is not None or writer is not None):
+                    # Only the chunks with fitted spectra are checkpointed or written
+                    unfinished[chunk] = (
+                        chunk_index,
+                        -(-n_keep // chunk_size),
+                        n_keep == len(chunk_index),
+                    )
+                # Don't read further ahead than the workers can fit
+                await merge_finished(max_pending)
+        await merge_finished(0)
+        # Chunks left unfinished by `stop`
+        for chunk, (flat_index, _, _) in list(unfinished.items()):
+            await chunk_done(chunk, flat_index, complete=False)
+        await asyncio.gather(*writes)
+        if preview is not None:
+            preview_callback(preview)
+    finally:
+        # On error or cancellation, don't leave the remaining blocks in the queue
+        for task in pending:
+            task.cancel()
+        # ... but let the writes in progress complete, so nothing writes to the file afterwards
+        if writes:
+            await asyncio.wait(writes)
+        if progress is not None:
+            progress.close()
+    if result.warm_start is not None:
+        logger.info(result.warm_start.summary())
+    return state, result
+
+
+@dataclass
+class TreatmentEstimate:
+    """Expected cost of a treatment, extrapolated from a small random sample (see `estimate_treatment`)"""
+
+    engine: str
+    n_workers: int
+    # Spectra the treatment would fit, and spectra fitted for the estimate
+    n_spectra: int
+    n_sampled: int
+    # Time (s) to set up the treatment on the average spectrum
+    setup_time: float
+    # Time (s) per spectrum to read the PSD, and to fit it on a single worker
+    read_time: float
+    fit_time: float
+    # Fraction of the sampled spectra whose fit failed
+    failure_rate: float
+    # CPUs available to this process: the workers don't fit faster in parallel than that
+    n_cpus: int = field(
+        default_factory=lambda: len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else default_n_workers()
+    )
+
+    @property
+    def total_time(self) -> float:
+        """
+        Expected duration (s) of the treatment: the chunks are read while the workers fit
+        the previous ones, so the slowest of the two sets the pace.
+        """
+        n_blocks = -(-self.n_spectra // engine_block_size(self.engine, self.n_spectra, self.n_workers))
+        parallel = max(1, min(self.n_workers, n_blocks, self.n_cpus))
+        fitting = self.n_spectra * self.fit_time / parallel
+        return self.setup_time + max(fitting, self.n_spectra * self.read_time)
+
+    def summary(self) -> str:
+        workers = f", {self.n_workers} workers" if self.engine == "Process pool" else ""
+        return (
+            f"{self.engine}{workers}: about {datetime.timedelta(seconds=round(self.total_time))} "
+            f"for {self.n_spectra} spectra ({1e3 * self.fit_time:.2f} ms of fitting and "
+            f"{1e3 * self.read_time:.3f} ms of reading per spectrum, "
+            f"{100 * self.failure_rate:.0f}% of the {self.n_sampled} sampled fits failed)"
+        )
+
+
+async def estimate_treatment(
+    data: bls.Data,
+    config: TreatmentConfig,
+    *,
+    engine: str = "Process pool",
+    n_workers: int = None,
+    max_spectra: int = None,
+    n_samples: int = ESTIMATE_SPECTRA,
+    executor: Executor = None,
+    rng: np.random.Generator = None,
+) -> TreatmentEstimate:
+    """
+    Estimate the duration of `treat_data` with the same arguments, by fitting a small
+    random sample of spectra with the same set-up.
+
+    The sample is made of runs of consecutive spectra at random places of a few random
+    chunks, which are read one at a time as in `treat_data`, to measure the reading time
+    as well. The runs are fitted one after the other on a single worker (in `executor` if
+    given), and the time per spectrum is scaled by the number of workers. The runs are never
+    longer than the blocks of `treat_data` (see `engine_block_size`); for the "Batched" engine,
+    whose cost per spectrum depends on the size of the blocks, the sample is a single run
+    of the size of its blocks. The warm start is not used for the sample, whose spectra are
+    not neighbours: the estimate is an upper bound for warm-started treatments.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    t0 = time.perf_counter()
+    reader, order, state = await setup_treatment(data, config, engine)
+    setup_time = time.perf_counter() - t0
+    frequency = reader.frequency[order]
+    state = replace(state, warm_start=False)
+
+    def read_sample():
+        chunks = rng.permutation(len(reader.slabs))[:ESTIMATE_CHUNKS]
+        t0 = time.perf_counter()
+        blocks = [reader.read_slab(reader.slabs[i])[1] for i in chunks]
+        return blocks, (time.perf_counter() - t0) / sum(len(PSD) for PSD in blocks)
+
+    blocks, read_time = await asyncio.to_thread(read_sample)
+    n_total = reader.n_spectra if max_spectra is None else min(max_spectra, reader.n_spectra)
+    n_workers = (n_workers or default_n_workers()) if engine == "Process pool" else 1
+    size = engine_block_size(engine, n_total, n_workers)
+    if state.batched:
+        # A whole block, as `treat_data` would fit it (the blocks don't span several chunks)
+        blocks = blocks[:1]
+        run_length = size
+    else:
+        run_length = min(-(-n_samples // len(blocks)), size)
+    # A run of consecutive spectra from each chunk, as in the blocks of `treat_data`:
+    # the replayed algorithm starts each fit from the previous one, which doesn't
+    # work on scattered spectra
+    runs = []
+    for PSD in blocks:
+        start = rng.integers(0, max(len(PSD) - run_length, 0) + 1)
+        runs.append(PSD[start : start + run_length, order])
+
+    if executor is None:
+        executor = _serial_executor
+    loop = asyncio.get_running_loop()
+    fitted = [
+        await loop.run_in_executor(executor, _timed_fit_block, state, frequency, PSD)
+        for PSD in runs
+    ]
+    n_fit = sum(len(PSD) for PSD in runs)
+    busy = sum(t for _, _, t in fitted)
+    n_fit_errors = sum(result.n_fit_errors for result, _, _ in fitted)
+    estimate = TreatmentEstimate(
+        engine=engine,
+        n_workers=n_workers,
+        n_spectra=n_total,
+        n_sampled=n_fit,
+        setup_time=setup_time,
+        read_time=read_time,
+        fit_time=busy / max(n_fit, 1),
+        failure_rate=n_fit_errors / max(n_fit, 1),
+    )
+    logger.info(f"Treatment estimate: {estimate.summary()}")
+    return estimate
@@ -0,0 +1,256 @@
+"""
+Neighbour warm-start of the multi-peak fit.
+
+Brillouin maps are spatially smooth, so the converged parameters of a spectrum are a much
+better initial guess for its neighbours than the generic guess of `HDF5_BLS_treat`
+(peak position, amplitude at that position, estimated width). Here the fit recorded by
+`multi_fit_all_inelastic` (same model, windows and bounds) is run directly with `curve_fit`,
+walking each block of spectra row by row in a serpentine order, and seeding each fit
+with the parameters of its already-fitted neighbours.
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+from scipy import optimize
+from HDF5_BLS_treat.models import Models
+
+# One warm-started fit out of BASELINE_EVERY is also run from the default guess,
+# to measure the reduction of the number of function evaluations on the same spectra
+BASELINE_EVERY = 32
+
+
+@dataclass
+class WarmStartStats:
+    """Number of fits and of function evaluations, for warm-started and default ("cold") guesses"""
+
+    n_warm: int = 0
+    nfev_warm: int = 0
+    n_cold: int = 0
+    nfev_cold: int = 0
+    # Warm-started fits that failed and were run again from the default guess
+    n_fallback: int = 0
+    # Spectra fitted from both guesses
+    n_paired: int = 0
+    nfev_paired_warm: int = 0
+    nfev_paired_cold: int = 0
+
+    def merge(self, other: "WarmStartStats"):
+        for name in self.__dataclass_fields__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def evaluation_reduction(self) -> float:
+        """Relative reduction of the number of function evaluations, on the paired spectra"""
+        if self.nfev_paired_cold == 0:
+            return np.nan
+        return 1 - self.nfev_paired_warm / self.nfev_paired_cold
+
+    def summary(self) -> str:
+        n_fits = self.n_warm + self.n_cold
+        if n_fits == 0:
+            return "Warm start: no spectra fitted"
+        text = (
+            f"Warm start: {self.n_warm}/{n_fits} fits seeded by a neighbour "
+            f"({self.n_fallback} fell back to the default guess), "
+            f"{(self.nfev_warm + self.nfev_cold) / n_fits:.1f} function evaluations per fit"
+        )
+        if self.n_paired:
+            text += (
+                f"; on {self.n_paired} spectra fitted both ways: "
+                f"{self.nfev_paired_warm / self.n_paired:.1f} evaluations from the neighbours "
+                f"vs {self.nfev_paired_cold / self.n_paired:.1f} from the default guess "
+                f"({100 * self.evaluation_reduction:.0f}% fewer)"
+            )
+        return text
+
+
+@dataclass
+class MultiPeakProblem:
+    """
+    The fit recorded by `multi_fit_all_inelastic`: sum of one lineshape per inelastic peak,
+    on the union of the peak windows, with 4 parameters per peak
+    (offset, amplitude, shift, linewidth) and a single free offset.
+    """
+
+    fit_model: str
+    peaks: np.ndarray
+    peak_index: np.ndarray
+    offset_index: np.ndarray
+    gamma: np.ndarray
+    fit_index: np.ndarray
+    lower: np.ndarray
+    upper: np.ndarray
+    guess_offset: bool
+    _model: object = field(default=None, repr=False)
+
+    @classmethod
+    def from_state(cls, state, frequency: np.ndarray) -> "MultiPeakProblem":
+        """
+        Build the problem from a `TreatState`, for the (sorted) `frequency` axis.
+
+        The peak positions and widths of the default guess are the ones refined and
+        estimated on the average spectrum when the treatment was set up.
+        """
+        steps = [f for f in state.algorithm["functions"] if f["function"] == "multi_fit_all_inelastic"]
+        if not steps:
+            raise ValueError("The warm start only supports treatments fitted with 'multi_fit_all_inelastic'")
+        parameters = steps[-1]["parameters"]
+
+        inelastic = [
+            i for i, point in enumerate(state.points)
+            if point[0].split("_")[0] in ["Anti-Stokes", "Stokes"]
+        ]
+        n_peaks = len(inelastic)
+        bound_shift = parameters.get("bound_shift") or [[-np.inf, np.inf]] * n_peaks
+        bound_linewidth = parameters.get("bound_linewidth") or [[0, np.inf]] * n_peaks
+        if len(state.width_estimator) > 0:
+            gamma = np.array([state.width_estimator[i] for i in inelastic], dtype=float)
+        else:
+            gamma = np.full(n_peaks, float(parameters.get("default_width", 1)))
+
+        lower = np.tile([-np.inf, 0, -np.inf, 0], (n_peaks, 1)).astype(float)
+        upper = np.full((n_peaks, 4), np.inf)
+        lower[:, 2], upper[:, 2] = np.transpose(bound_shift)
+        lower[:, 3], upper[:, 3] = np.transpose(bound_linewidth)
+        # Only the first peak has a free offset
+        lower[1:, 0], upper[1:, 0] = -1e-10, 1e-10
+
+        peaks = np.clip([state.points[i][1] for i in inelastic], lower[:, 2], upper[:, 2])
+        windows = [
+            np.flatnonzero((frequency >= state.windows[i][0]) & (frequency <= state.windows[i][1]))
+            for i in inelastic
+        ]
+        return cls(
+            fit_model=state.fit_model,
+            peaks=peaks,
+            peak_index=np.array([np.argmin(np.abs(frequency - p)) for p in peaks]),
+            offset_index=windows[0],
+            gamma=np.clip(gamma, lower[:, 3], upper[:, 3]),
+            fit_index=np.unique(np.concatenate(windows)),
+            lower=lower.ravel(),
+            upper=upper.ravel(),
+            guess_offset=bool(parameters.get("guess_offset", False)),
+        )
+
+    @property
+    def n_peaks(self) -> int:
+        return len(self.peaks)
+
+    def func(self, x, *p):
+        if self._model is None:
+            self._model = Models().models[self.fit_model]
+        p = np.reshape(p, (-1, 4))
+        return sum(self._model(x, *params) for params in p)
+
+    def default_guess(self, PSD: np.ndarray) -> np.ndarray:
+        """
+        The initial guess of `multi_fit_all_inelastic` for a (n_freq,) spectrum,
+        or for each spectrum of a (..., n_freq) array.
+        """
+        p0 = np.zeros(PSD.shape[:-1] + (self.n_peaks, 4))
+        if self.guess_offset and len(self.offset_index):
+            p0[..., 0, 0] = np.min(PSD[..., self.offset_index], axis=-1)
+        p0[..., 1] = np.maximum(PSD[..., self.peak_index], 0)
+        p0[..., 2] = self.peaks
+        p0[..., 3] = self.gamma
+        return p0.reshape(PSD.shape[:-1] + (4 * self.n_peaks,))
+
+    def fit(self, frequency: np.ndarray, PSD: np.ndarray, p0: np.ndarray):
+        """
+        Fit one spectrum from `p0`.
+
+        Returns
+        -------
+        (popt, std, nfev)
+            `popt` and `std` are None if the fit failed.
+        """
+        p0 = np.clip(p0, self.lower, self.upper)
+        try:
+            popt, pcov, info, _, _ = optimize.curve_fit(
+                self.func,
+                frequency[self.fit_index],
+                PSD[self.fit_index],
+                p0=p0,
+                bounds=(self.lower, self.upper),
+                full_output=True,
+            )
+        except Exception:
+            return None, None, 0
+        if not np.all(np.isfinite(popt)):
+            return None, None, info["nfev"]
+        return popt, np.sqrt(np.diag(pcov)), info["nfev"]
+
+
+def serpentine_order(n_spectra: int, row_length: int) -> np.ndarray:
+    """
+    Order in which a block of `n_spectra` spectra, stored row by row (C order) with
+    rows of `row_length` spectra, is walked: every other row is walked backwards,
+    so that consecutive spectra are always spatial neighbours.
+    """
+    order = np.arange(n_spectra)
+    row_length = max(1, row_length)
+    for start in range(row_length, n_spectra, 2 * row_length):
+        order[start : start + row_length] = order[start : start + row_length][::-1]
+    return order
+
+
+def fit_spectra_warm_start(
+    problem: MultiPeakProblem,
+    frequency: np.ndarray,
+    PSD: np.ndarray,
+    row_length: int = 1,
+) -> tuple[np.ndarray, np.ndarray, WarmStartStats]:
+    """
+    Fit a (n, n_freq) block of spectra, seeding each fit with its fitted neighbours.
+
+    The neighbours of a spectrum are the previous one in the walk and the one above it
+    (same column, previous row). The average of the parameters of the neighbours that
+    were successfully fitted is used as the initial guess; if there are none, or if the
+    warm-started fit fails, the spectrum is fitted from the default guess.
+
+    Returns
+    -------
+    (popt, std, stats)
+        `popt` and `std` are (n, n_peaks, 4) arrays of (offset, amplitude, shift, linewidth)
+        and their standard deviations, NaN where the fit failed.
+    """
+    n_spectra = len(PSD)
+    popt = np.full((n_spectra, problem.n_peaks * 4), np.nan)
+    std = np.full_like(popt, np.nan)
+    fitted = np.zeros(n_spectra, dtype=bool)
+    stats = WarmStartStats()
+
+    previous = None
+    for i in serpentine_order(n_spectra, row_length):
+        neighbours = [j for j in {previous, i - row_length} if j is not None and j >= 0 and fitted[j]]
+        previous = i
+
+        result = None
+        if neighbours:
+            result = problem.fit(frequency, PSD[i], popt[neighbours].mean(axis=0))
+            if result[0] is not None:
+                stats.n_warm += 1
+                stats.nfev_warm += result[2]
+                if stats.n_warm % BASELINE_EVERY == 0:
+                    cold = problem.fit(frequency, PSD[i], problem.default_guess(PSD[i]))
+                    if cold[0] is not None:
+                        stats.n_paired += 1
+                        stats.nfev_paired_warm += result[2]
+                        stats.nfev_paired_cold += cold[2]
+            else:
+                stats.n_fallback += 1
+        if result is None or result[0] is None:
+            result = problem.fit(frequency, PSD[i], problem.default_guess(PSD[i]))
+            stats.n_cold += 1
+            stats.nfev_cold += result[2]
+
+        if result[0] is not None:
+            popt[i], std[i] = result[0], result[1]
+            fitted[i] = True
+
+    popt = popt.reshape(n_spectra, problem.n_peaks, 4)
+    std = std.reshape(n_spectra, problem.n_peaks, 4)
+    # Same convention as HDF5_BLS_treat: the linewidth is positive
+    popt[..., 3] = np.abs(popt[..., 3])
+    return popt, std, stats
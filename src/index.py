@@ -226,9 +226,16 @@ def build_ui():
     DataVisualizer = brimview_widgets.BlsDataVisualizer(FileSelector)
     spectrum_visualizer = brimview_widgets.BlsSpectrumVisualizer(DataVisualizer)
     statistics_widget = brimview_widgets.BlsStatistics(DataVisualizer)
+    label_statistics_widget = brimview_widgets.BlsLabelStatistics(DataVisualizer)
     brim_visualizer = pn.layout.Row(
         pn.layout.FlexBox(DataVisualizer, margin=10),
-        pn.layout.FlexBox(spectrum_visualizer, statistics_widget, margin=10, gap="10px"),
+        pn.layout.FlexBox(
+            spectrum_visualizer,
+            statistics_widget,
+            label_statistics_widget,
+            margin=10,
+            gap="10px",
+        ),
         sizing_mode="stretch_width",
     )
     main_tabs.append((".brim Visualizer", brim_visualizer))